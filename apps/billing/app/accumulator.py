@@ -0,0 +1,121 @@
+"""
+Write-behind accumulator for high-frequency balance debits.
+
+With BALANCE_WRITE_BEHIND=true a completed meeting no longer rewrites the
+user's row. Its deltas are appended to billing_balance_journal (durable,
+no row contention) and summed in memory; every BALANCE_FLUSH_INTERVAL_MS
+one statement claims this process's journal rows and applies the per-user
+sums as increments to public.users.
+
+Crash safety: a journal row is only deleted by the flush that applies it.
+Rows left behind by a process that died are picked up by any later flush
+or by the balance_journal_recover job once they are older than
+JOURNAL_ORPHAN_SECONDS.
+
+Read-through: balance reads in this process add the unflushed deltas
+(``overlay``). Other replicas see a debit once it is flushed, i.e. within
+one flush interval.
+"""
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import db
+from .config import BALANCE_FLUSH_INTERVAL_MS
+
+
+class BalanceAccumulator:
+    def __init__(self, interval: float = BALANCE_FLUSH_INTERVAL_MS / 1000):
+        self.interval = interval
+        # Journal rows written by this process and not yet applied
+        self._entries: List[Tuple[int, str, Dict[str, float]]] = []
+        self._pending: Dict[str, Dict[str, float]] = {}  # email → field → unflushed delta
+        self._task: Optional[asyncio.Task] = None
+        self.debits = 0
+        self.flushes = 0
+        self.rows_applied = 0
+        self.flush_errors = 0
+
+    async def debit(self, user_id: int, email: str, deltas: Dict[str, float]) -> None:
+        """Record deltas durably; they reach public.users on the next flush."""
+        journal_id = await db.journal_balance_deltas(user_id, deltas)
+        self._entries.append((journal_id, email, deltas))
+        pending = self._pending.setdefault(email, {})
+        for field, delta in deltas.items():
+            pending[field] = pending.get(field, 0) + delta
+        self.debits += 1
+
+    def overlay(self, email: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """``data`` with this process's unflushed deltas applied (copy)."""
+        pending = self._pending.get(email)
+        if not pending:
+            return data
+        merged = dict(data)
+        for field, delta in pending.items():
+            merged[field] = (merged.get(field, 0) or 0) + delta
+        return merged
+
+    async def flush(self) -> int:
+        """Apply everything journaled so far; returns the number of journal rows."""
+        if not self._entries:
+            return 0
+        batch, self._entries = self._entries, []
+        try:
+            await db.apply_balance_journal([journal_id for journal_id, _, _ in batch])
+        except Exception as e:
+            self.flush_errors += 1
+            self._entries = batch + self._entries  # rows are still journaled; retry next tick
+            print(f"[ACCUMULATOR] Flush of {len(batch)} debits failed, retrying: {e}")
+            return 0
+        except BaseException:
+            # Cancelled mid-flush: re-applying is safe, the claim is by journal ID
+            self._entries = batch + self._entries
+            raise
+        for _, email, deltas in batch:
+            pending = self._pending.get(email, {})
+            for field, delta in deltas.items():
+                pending[field] = pending.get(field, 0) - delta
+                if abs(pending[field]) < 1e-9:
+                    del pending[field]
+            if not pending:
+                self._pending.pop(email, None)
+        self.flushes += 1
+        self.rows_applied += len(batch)
+        return len(batch)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            print(f"[ACCUMULATOR] Write-behind debits on (flush every {self.interval * 1000:.0f}ms)")
+
+    async def stop(self) -> None:
+        """Stop the flusher and apply whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval_ms": round(self.interval * 1000),
+            "running": self._task is not None,
+            "unflushed_debits": len(self._entries),
+            "users_pending": len(self._pending),
+            "debits": self.debits,
+            "flushes": self.flushes,
+            "rows_applied": self.rows_applied,
+            "flush_errors": self.flush_errors,
+        }
+
+
+accumulator = BalanceAccumulator()
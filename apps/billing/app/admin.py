@@ -1,12 +1,19 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Optional
+import asyncio
+import contextvars
+import time
+from typing import Any, Dict, Optional, Tuple
 
 import httpx
 from fastapi import APIRouter, HTTPException
 
-from .config import ADMIN_API_URL, ADMIN_API_TOKEN, STRIPE_IDS
+from .bulkhead import BulkheadFull
+from .circuit import CircuitOpenError
+from .config import ADMIN_API_URL, ADMIN_API_TOKEN, DATABASE_URL, STATS_CACHE_TTL_SECONDS, STRIPE_IDS
+from .deadline import DeadlineExceeded
 from .models import StatsResponse
+from .singleflight import flights
 
 router = APIRouter()
 
@@ -14,6 +21,7 @@ router = APIRouter()
 # ── Admin API helper ─────────────────────────────────────────────────────────
 
 async def admin_request(method: str, path: str, json_body: Optional[Dict[str, Any]] = None) -> httpx.Response:
+    from . import deadline
     from .retry import with_retry
 
     url = f"{ADMIN_API_URL}{path}"
@@ -21,7 +29,8 @@ async def admin_request(method: str, path: str, json_body: Optional[Dict[str, An
 
     async def _do_request() -> httpx.Response:
         async with httpx.AsyncClient() as client:
-            resp = await client.request(method, url, json=json_body, headers=headers, timeout=30)
+            timeout = deadline.clip(30, f"admin {method} {path}")
+            resp = await client.request(method, url, json=json_body, headers=headers, timeout=timeout)
             resp.raise_for_status()
             return resp
 
@@ -33,19 +42,81 @@ async def admin_request(method: str, path: str, json_body: Optional[Dict[str, An
 
 # ── Endpoints ────────────────────────────────────────────────────────────────
 
+# ── Stats ────────────────────────────────────────────────────────────────────
+# Computed with one SQL aggregate over public.users and cached for
+# STATS_CACHE_TTL_SECONDS. A stale entry is still served while a single
+# background refresh replaces it; only a cold cache makes the caller wait.
+# Without DATABASE_URL the figures come from paging through the Admin API.
+
+_STATS_PAGE_SIZE = 500
+
+_stats_cache: Optional[Tuple[float, Dict[str, int]]] = None
+_stats_refresh: Optional[asyncio.Task] = None
+
+
+async def _stats_from_admin_api() -> Dict[str, int]:
+    """Aggregate page by page so no response holds every user at once."""
+    total_accounts = total_bots = 0
+    skip = 0
+    while True:
+        resp = await admin_request("GET", f"/admin/users?skip={skip}&limit={_STATS_PAGE_SIZE}")
+        if resp.status_code != 200:
+            raise HTTPException(status_code=resp.status_code, detail=f"Admin API failed: {resp.text}")
+        page = resp.json()
+        for u in page:
+            bots = u.get("max_concurrent_bots") or 0
+            if bots > 0:
+                total_accounts += 1
+                total_bots += bots
+        if len(page) < _STATS_PAGE_SIZE:
+            break
+        skip += len(page)
+    return {"total_accounts": total_accounts, "total_contracted_bots": total_bots}
+
+
+async def _compute_stats() -> Dict[str, int]:
+    if DATABASE_URL:
+        from .db import account_stats
+        return await account_stats()
+    return await _stats_from_admin_api()
+
+
+async def _refresh_stats() -> Dict[str, int]:
+    global _stats_cache
+    stats = await flights.do("stats", "all", _compute_stats)
+    _stats_cache = (time.monotonic(), stats)
+    return stats
+
+
+def _log_refresh_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        print(f"[STATS] Background refresh failed, serving cached figures: {task.exception()}")
+
+
+def _refresh_in_background() -> None:
+    global _stats_refresh
+    if _stats_refresh is not None and not _stats_refresh.done():
+        return
+    # Fresh context: the refresh must not inherit this request's deadline
+    loop = asyncio.get_running_loop()
+    _stats_refresh = loop.create_task(_refresh_stats(), context=contextvars.Context())
+    _stats_refresh.add_done_callback(_log_refresh_failure)
+
+
+async def current_stats() -> Dict[str, int]:
+    if _stats_cache is None:
+        return await _refresh_stats()
+    fetched_at, stats = _stats_cache
+    if time.monotonic() - fetched_at >= STATS_CACHE_TTL_SECONDS:
+        _refresh_in_background()
+    return stats
+
+
 @router.get("/v1/stats")
 async def get_current_stats() -> StatsResponse:
     try:
-        resp = await admin_request("GET", "/admin/users?limit=10000")
-        if resp.status_code != 200:
-            raise HTTPException(status_code=resp.status_code, detail=f"Admin API failed: {resp.text}")
-        users_data = resp.json()
-        accounts_with_bots = [u for u in users_data if u.get("max_concurrent_bots", 0) > 0]
-        return StatsResponse(
-            total_accounts=len(accounts_with_bots),
-            total_contracted_bots=sum(u.get("max_concurrent_bots", 0) for u in accounts_with_bots),
-        )
-    except HTTPException:
+        return StatsResponse(**await current_stats())
+    except (HTTPException, BulkheadFull, CircuitOpenError, DeadlineExceeded):
         raise
     except Exception as e:
         print(f"[STATS] Error: {e}")
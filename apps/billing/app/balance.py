@@ -1,14 +1,19 @@
 from __future__ import annotations
 
-from typing import Any, Dict
+import uuid
+from typing import Any, Dict, Optional
 
 import stripe
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 
-from .config import INITIAL_BOT_CREDIT_CENTS, TX_FREE_CREDIT_MINUTES, PORTAL_RETURN_URL
+from .accumulator import accumulator
+from .config import INITIAL_BOT_CREDIT_CENTS, TX_FREE_CREDIT_MINUTES, PORTAL_RETURN_URL, TOPUP_CONFIRMATION_MODE
 from .context import _ensure_customer
-from .db import get_user_data, merge_user_data
+from .db import get_user_by_email, get_user_data, merge_user_data
+from .memo import modify_customer
 from .retry import with_retry
+from .topups import record_topup, submit_in_background
+from .payment_methods import resolve_default_payment_method
 from .models import (
     BalanceCheckRequest, BalanceDeductRequest, BalanceCreditRequest,
     TopupSettingsRequest, TopupRequest, PaymentMethodRequest,
@@ -73,7 +78,7 @@ async def apply_free_credit(email: str) -> Dict[str, Any]:
 @router.post("/v1/balance/check")
 async def balance_check(req: BalanceCheckRequest) -> Dict[str, Any]:
     f = _fields(req.product)
-    data = await get_user_data(req.email)
+    data = accumulator.overlay(req.email, await get_user_data(req.email))
     available = data.get(f["balance"], 0) or 0
     required = req.required or 0
     return {
@@ -112,7 +117,7 @@ async def balance_credit(req: BalanceCreditRequest) -> Dict[str, Any]:
 
 @router.get("/v1/balance/{email}")
 async def get_balances(email: str) -> Dict[str, Any]:
-    data = await get_user_data(email)
+    data = accumulator.overlay(email, await get_user_data(email))
     return {
         "bot": {
             "balance_cents": data.get("bot_balance_cents", 0) or 0,
@@ -156,30 +161,20 @@ async def topup_settings(req: TopupSettingsRequest) -> Dict[str, Any]:
 # ── Manual topup (charge saved card) ────────────────────────────────────────
 
 @router.post("/v1/balance/topup")
-async def manual_topup(req: TopupRequest) -> Dict[str, Any]:
+async def manual_topup(
+    req: TopupRequest, idempotency_header: Optional[str] = Header(None, alias="Idempotency-Key"),
+) -> Dict[str, Any]:
     f = _fields(req.product)
     data = await get_user_data(req.email)
 
     pm_id = data.get("stripe_payment_method_id")
     cust_id = data.get("stripe_customer_id")
 
-    # Try to find payment method from Stripe if not saved locally
+    # Cached on the user row; Stripe is only asked when nothing is stored yet
     if not pm_id and cust_id:
         try:
-            customer = await with_retry(stripe.Customer.retrieve, cust_id, label="stripe retrieve customer")
-            pm_id = (customer.get("invoice_settings") or {}).get("default_payment_method")
-            if not pm_id:
-                pm_id = customer.get("default_source")
-            # Fallback: list all attached cards and use the most recent one
-            if not pm_id:
-                pms = await with_retry(stripe.PaymentMethod.list, customer=cust_id, type="card", limit=1, label="stripe list pms")
-                if pms.data:
-                    pm_id = pms.data[0].id
+            pm_id = await resolve_default_payment_method(cust_id, data)
             if pm_id:
-                try:
-                    await with_retry(stripe.Customer.modify, cust_id, invoice_settings={"default_payment_method": pm_id}, label="stripe set default pm")
-                except stripe.error.StripeError:
-                    pass
                 await merge_user_data(req.email, {"stripe_payment_method_id": pm_id})
         except stripe.error.StripeError:
             pass
@@ -189,7 +184,7 @@ async def manual_topup(req: TopupRequest) -> Dict[str, Any]:
     # If no saved payment method, create a Stripe Checkout session for one-time payment
     if not pm_id or not cust_id:
         if not cust_id:
-            customer = await with_retry(_ensure_customer, req.email, label="stripe ensure customer")
+            customer = await _ensure_customer(req.email)
             cust_id = customer.id
             await merge_user_data(req.email, {"stripe_customer_id": cust_id})
 
@@ -225,7 +220,26 @@ async def manual_topup(req: TopupRequest) -> Dict[str, Any]:
 
         return {"url": session.url, "product": req.product}
 
-    # Charge saved payment method off-session
+    # Webhook confirmation: record the pending credit and return immediately
+    if TOPUP_CONFIRMATION_MODE == "webhook":
+        user = await get_user_by_email(req.email)
+        if not user:
+            raise HTTPException(status_code=404, detail=f"No user for {req.email}")
+        pending = await record_topup(
+            user_id=user["id"], email=req.email, product=req.product, amount_cents=amount_cents,
+            source="manual", customer_id=cust_id, payment_method_id=pm_id,
+        )
+        submit_in_background(pending)
+        return {
+            "pending": True,
+            "topup_id": pending["idempotency_key"],
+            "amount_cents": amount_cents,
+            "product": req.product,
+        }
+
+    # Charge saved payment method off-session. Never retried or abandoned
+    # mid-call; a client retry with the same key gets the same PaymentIntent.
+    client_key = req.idempotency_key or idempotency_header
     try:
         pi = await with_retry(
             stripe.PaymentIntent.create,
@@ -236,11 +250,22 @@ async def manual_topup(req: TopupRequest) -> Dict[str, Any]:
             off_session=True,
             confirm=True,
             description=f"{'Bot' if req.product == 'bot' else 'Transcription'} balance top-up",
+            idempotency_key=f"topup-manual-{client_key or uuid.uuid4().hex}",
+            max_retries=0,  # a charge is not safe to blindly retry
             label="stripe payment intent",
         )
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=f"Payment failed: {str(e)}")
 
+    # A retry that got back an intent we already credited must not credit again
+    if data.get("last_topup_payment_intent_id") == pi.id:
+        return {
+            "charged_cents": amount_cents,
+            "new_balance": data.get(f["balance"], 0) or 0,
+            "product": req.product,
+            "payment_intent_id": pi.id,
+        }
+
     # Credit balance
     current = data.get(f["balance"], 0) or 0
     if req.product == "bot":
@@ -250,7 +275,7 @@ async def manual_topup(req: TopupRequest) -> Dict[str, Any]:
         minutes_per_cent = 1 / 0.2  # 5 minutes per cent
         new_balance = current + (amount_cents * minutes_per_cent)
 
-    await merge_user_data(req.email, {f["balance"]: new_balance})
+    await merge_user_data(req.email, {f["balance"]: new_balance, "last_topup_payment_intent_id": pi.id})
 
     return {
         "charged_cents": amount_cents,
@@ -268,15 +293,14 @@ async def save_payment_method(req: PaymentMethodRequest) -> Dict[str, Any]:
     cust_id = data.get("stripe_customer_id")
 
     if not cust_id:
-        customer = await with_retry(_ensure_customer, req.email, label="stripe ensure customer")
+        customer = await _ensure_customer(req.email)
         cust_id = customer.id
         await merge_user_data(req.email, {"stripe_customer_id": cust_id})
 
     try:
         await with_retry(stripe.PaymentMethod.attach, req.pm_id, customer=cust_id, label="stripe attach pm")
-        await with_retry(
-            stripe.Customer.modify, cust_id,
-            invoice_settings={"default_payment_method": req.pm_id},
+        await modify_customer(
+            cust_id, invoice_settings={"default_payment_method": req.pm_id},
             label="stripe set default pm",
         )
     except stripe.error.StripeError as e:
@@ -0,0 +1,114 @@
+"""
+Bulkheads: per-dependency concurrency limits with bounded queues.
+
+Stripe and the Admin API each get their own slot pool, and blocking Stripe
+SDK calls run on a dedicated thread pool instead of the event loop or the
+default executor. When a dependency slows down, only callers of that
+dependency queue (and, past the queue limit, are rejected with 503); DB-only
+endpoints such as /v1/balance/check keep their latency. The DB is bounded by
+its connection pool (see db.py), which rejects the same way when exhausted.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from . import deadline
+from .config import (
+    ADMIN_BULKHEAD_CONCURRENCY, ADMIN_BULKHEAD_QUEUE, STRIPE_BULKHEAD_CONCURRENCY, STRIPE_BULKHEAD_QUEUE,
+)
+
+
+class BulkheadFull(Exception):
+    """A dependency's concurrency pool and queue are both full."""
+
+    def __init__(self, name: str):
+        super().__init__(f"{name} is saturated, try again shortly")
+        self.name = name
+
+
+class Bulkhead:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, threads: int = 0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self._sem = asyncio.Semaphore(max_concurrent)
+        self.executor: Optional[ThreadPoolExecutor] = (
+            ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"{name}-io") if threads else None
+        )
+        self.active = 0
+        self.queued = 0
+        self.peak_active = 0
+        self.peak_queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    async def acquire(self) -> None:
+        """Take one slot; queue if busy, reject if the queue is full."""
+        if self.active + self.queued >= self.max_concurrent + self.max_queue:
+            self.rejected += 1
+            raise BulkheadFull(self.name)
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        try:
+            left = deadline.remaining()
+            if left is None:
+                await self._sem.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(self._sem.acquire(), timeout=max(left, 0.0))
+                except asyncio.TimeoutError:
+                    raise deadline.DeadlineExceeded(f"Request deadline exceeded waiting for {self.name}") from None
+        finally:
+            self.queued -= 1
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+
+    def release(self) -> None:
+        self.active -= 1
+        self.completed += 1
+        self._sem.release()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold one slot for the duration of the block."""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> asyncio.Future:
+        """Start a blocking call on this bulkhead's own threads."""
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "threads": self.executor._max_workers if self.executor else 0,
+            "active": self.active,
+            "queued": self.queued,
+            "peak_active": self.peak_active,
+            "peak_queued": self.peak_queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+bulkheads: Dict[str, Bulkhead] = {
+    "stripe": Bulkhead("stripe", STRIPE_BULKHEAD_CONCURRENCY, STRIPE_BULKHEAD_QUEUE, threads=STRIPE_BULKHEAD_CONCURRENCY),
+    "admin": Bulkhead("admin", ADMIN_BULKHEAD_CONCURRENCY, ADMIN_BULKHEAD_QUEUE),
+}
+
+
+def bulkhead_stats() -> Dict[str, Any]:
+    from .db import pool_stats
+    return {
+        **{name: b.snapshot() for name, b in bulkheads.items()},
+        "db": pool_stats(),
+    }
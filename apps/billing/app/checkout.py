@@ -9,7 +9,10 @@ from .config import (
     DATABASE_URL, INITIAL_BOT_CREDIT_CENTS, TX_FREE_CREDIT_MINUTES,
     get_price_id, get_product_id,
 )
-from .context import CustomerContext
+from .context import CustomerContext, require_customer
+from .retry import with_retry
+from .sessions import sessions
+from .stripe_reads import cancel_subscription
 
 
 # ── Welcome credit helper ────────────────────────────────────────────────────
@@ -25,11 +28,14 @@ async def _apply_welcome_credit_if_needed(ctx: CustomerContext, plan: str) -> No
 
     if plan == "bot_service" and not ctx.user_data.get("bot_welcome_credit_given"):
         try:
-            stripe.Customer.create_balance_transaction(
+            await with_retry(
+                stripe.Customer.create_balance_transaction,
                 ctx.customer_id,
                 amount=-INITIAL_BOT_CREDIT_CENTS,  # negative = credit
                 currency="usd",
                 description="Welcome credit — Pay-as-you-go ($5)",
+                max_retries=0,  # a retried credit could be granted twice
+                label="stripe welcome credit",
             )
             await merge_user_data(ctx.email, {
                 "bot_welcome_credit_given": True,
@@ -61,8 +67,9 @@ async def new_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
         }
     }
 
-    try:
-        checkout = stripe.checkout.Session.create(
+    async def create() -> str:
+        checkout = await with_retry(
+            stripe.checkout.Session.create,
             mode="subscription",
             customer=ctx.customer_id,
             line_items=line_items,
@@ -71,8 +78,16 @@ async def new_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
             allow_promotion_codes=True,
             payment_method_collection="if_required",
             subscription_data=sub_data,
+            label="stripe checkout session",
+        )
+        return checkout.url
+
+    await require_customer(ctx)
+    try:
+        url = await sessions.get_or_create(
+            ctx.customer_id, "new_checkout", (plan, ctx.success_url, ctx.cancel_url), create,
         )
-        return {"url": checkout.url}
+        return {"url": url}
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=f"Checkout error: {str(e)}")
 
@@ -101,7 +116,8 @@ async def switch(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
         sub_params["items"] = [{"price": new_price_id, "quantity": 1}]
 
     try:
-        new_sub = stripe.Subscription.create(**sub_params)
+        # No retries: a retry after a read timeout could create (and bill) a second sub
+        new_sub = await with_retry(stripe.Subscription.create, **sub_params, max_retries=0, label="stripe create sub")
         print(f"[SWITCH] Created new sub {new_sub.id} for {plan}")
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=f"Failed to create new subscription: {str(e)}")
@@ -109,12 +125,12 @@ async def switch(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
     # Now cancel old — safe because new sub is confirmed
     credit_amount = ""
     try:
-        canceled_sub = stripe.Subscription.cancel(ctx.bot_sub.id, prorate=True, invoice_now=True)
+        canceled_sub = await cancel_subscription(ctx.bot_sub.id, prorate=True, invoice_now=True)
         print(f"[SWITCH] Canceled old sub {ctx.bot_sub.id}")
-        # Extract proration credit from the final invoice
-        if canceled_sub.latest_invoice:
+        # Extract proration credit from the final invoice (expanded on the cancel)
+        invoice = canceled_sub.latest_invoice
+        if invoice:
             try:
-                invoice = stripe.Invoice.retrieve(canceled_sub.latest_invoice)
                 if invoice.total < 0:
                     credit_amount = f"{abs(invoice.total) / 100:.2f}"
                 elif invoice.amount_due < 0:
@@ -136,7 +152,7 @@ async def switch(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
 
 # ── 3. Switch via checkout (no payment method yet) ──────────────────────────
 
-def switch_via_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
+async def switch_via_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
     """User wants to switch but has no card on file — need checkout to collect payment."""
     line_items = []
     if plan == "individual":
@@ -146,8 +162,11 @@ def switch_via_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
     else:
         raise HTTPException(status_code=400, detail=f"Unknown bot plan '{plan}'")
 
-    try:
-        checkout = stripe.checkout.Session.create(
+    replaces_sub = ctx.bot_sub.id if ctx.bot_sub else ""
+
+    async def create() -> str:
+        checkout = await with_retry(
+            stripe.checkout.Session.create,
             mode="subscription",
             customer=ctx.customer_id,
             line_items=line_items,
@@ -158,22 +177,32 @@ def switch_via_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
                 "metadata": {
                     "userEmail": ctx.email,
                     "tier": plan,
-                    "replaces_sub": ctx.bot_sub.id if ctx.bot_sub else "",
+                    "replaces_sub": replaces_sub,
                 }
             },
+            label="stripe checkout session",
         )
-        return {"url": checkout.url}
+        return checkout.url
+
+    await require_customer(ctx)
+    try:
+        url = await sessions.get_or_create(
+            ctx.customer_id, "switch_checkout", (plan, replaces_sub, ctx.success_url, ctx.cancel_url), create,
+        )
+        return {"url": url}
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=f"Checkout error: {str(e)}")
 
 
 # ── 4. Addon checkout ───────────────────────────────────────────────────────
 
-def addon_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
+async def addon_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
     """Add-on product (transcription_api) — always creates new checkout."""
     price_id = get_price_id(plan)
-    try:
-        checkout = stripe.checkout.Session.create(
+
+    async def create() -> str:
+        checkout = await with_retry(
+            stripe.checkout.Session.create,
             mode="subscription",
             customer=ctx.customer_id,
             line_items=[{"price": price_id}],
@@ -186,20 +215,30 @@ def addon_checkout(ctx: CustomerContext, plan: str) -> Dict[str, Any]:
                     "tier": plan,
                 }
             },
+            label="stripe checkout session",
         )
-        return {"url": checkout.url}
+        return checkout.url
+
+    await require_customer(ctx)
+    try:
+        url = await sessions.get_or_create(
+            ctx.customer_id, "addon_checkout", (plan, ctx.success_url, ctx.cancel_url), create,
+        )
+        return {"url": url}
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=f"Checkout error: {str(e)}")
 
 
 # ── 5. One-time payment (consultation) ──────────────────────────────────────
 
-def one_time_checkout(ctx: CustomerContext, plan: str, quantity: int = 1) -> Dict[str, Any]:
+async def one_time_checkout(ctx: CustomerContext, plan: str, quantity: int = 1) -> Dict[str, Any]:
     """Bug fix #3: Consultation always uses mode=payment, checked first in router
     so it never falls through to addon/subscription paths."""
     price_id = get_price_id(plan)
-    try:
-        checkout = stripe.checkout.Session.create(
+
+    async def create() -> str:
+        checkout = await with_retry(
+            stripe.checkout.Session.create,
             mode="payment",
             customer=ctx.customer_id,
             line_items=[{"price": price_id, "quantity": quantity}],
@@ -210,21 +249,41 @@ def one_time_checkout(ctx: CustomerContext, plan: str, quantity: int = 1) -> Dic
                 "userEmail": ctx.email,
                 "tier": plan,
             },
+            label="stripe checkout session",
+        )
+        return checkout.url
+
+    await require_customer(ctx)
+    try:
+        url = await sessions.get_or_create(
+            ctx.customer_id, "payment_checkout", (plan, quantity, ctx.success_url, ctx.cancel_url), create,
         )
-        return {"url": checkout.url}
+        return {"url": url}
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=f"Checkout error: {str(e)}")
 
 
 # ── 6. Portal (manage existing) ─────────────────────────────────────────────
 
-def portal(ctx: CustomerContext) -> Dict[str, Any]:
-    """Send existing subscriber to Stripe Customer Portal."""
-    try:
-        session = stripe.billing_portal.Session.create(
+async def portal(ctx: CustomerContext) -> Dict[str, Any]:
+    """Send existing subscriber to Stripe Customer Portal.
+
+    Without a Stripe customer there is nothing to manage — send them to pricing.
+    """
+    if not ctx.customer_id:
+        return {"url": ctx.pricing_url}
+
+    async def create() -> str:
+        session = await with_retry(
+            stripe.billing_portal.Session.create,
             customer=ctx.customer_id,
             return_url=ctx.return_url,
+            label="stripe portal session",
         )
-        return {"url": session.url}
+        return session.url
+
+    try:
+        url = await sessions.get_or_create(ctx.customer_id, "portal", (ctx.return_url,), create)
+        return {"url": url}
     except stripe.error.StripeError as e:
         raise HTTPException(status_code=400, detail=f"Portal error: {str(e)}")
@@ -0,0 +1,194 @@
+"""
+Per-upstream circuit breakers and a process-wide retry budget.
+
+Each upstream (Stripe, Admin API, DB) has a breaker:
+
+- ``closed``    — calls go through; consecutive transient failures are counted
+- ``open``      — calls fail immediately with CircuitOpenError (→ 503) until
+                  the reset timeout passes
+- ``half_open`` — a single probe call is let through; success closes the
+                  breaker, failure re-opens it
+
+Only failures that say something about upstream health (timeouts, connection
+errors, 5xx/429) count; a 4xx means the upstream answered and is healthy.
+
+The retry budget caps retries to a fraction of recent calls, so a degraded
+upstream sees at most ~(1 + ratio)x normal traffic instead of
+(1 + max_retries)x during an incident.
+"""
+from __future__ import annotations
+
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+from .config import (
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS, RETRY_BUDGET_MIN_PER_WINDOW, RETRY_BUDGET_RATIO,
+)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+_TRANSITION_HISTORY = 20
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.transitions: Dict[str, int] = {}
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=_TRANSITION_HISTORY)
+
+    def _transition(self, new_state: str, reason: str) -> None:
+        key = f"{self.state}->{new_state}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.history.append({"at": time.time(), "from": self.state, "to": new_state, "reason": reason})
+        print(f"[CIRCUIT] {self.name}: {self.state} → {new_state} ({reason})")
+        self.state = new_state
+        if new_state == OPEN:
+            self.opened_at = self._clock()
+
+    def retry_after(self) -> float:
+        if self.state != OPEN or self.opened_at is None:
+            return 0.0
+        return max(self.reset_timeout - (self._clock() - self.opened_at), 0.0)
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError if the call must not be attempted."""
+        if self.state == OPEN:
+            if self.retry_after() > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.retry_after())
+            self._transition(HALF_OPEN, "reset timeout elapsed")
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, 1.0)
+            self._probe_in_flight = True
+        self.calls += 1
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self._transition(CLOSED, "probe succeeded")
+
+    def abandon(self) -> None:
+        """The call was cancelled before finishing; free the probe slot."""
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self._transition(OPEN, "probe failed")
+        elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._transition(OPEN, f"{self.consecutive_failures} consecutive failures")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "retry_after": round(self.retry_after(), 1),
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "reset_timeout": self.reset_timeout,
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "transitions": dict(self.transitions),
+            "history": list(self.history),
+        }
+
+
+class RetryBudget:
+    """Allow retries up to ``ratio`` of calls seen in the last ``window`` seconds.
+
+    ``min_per_window`` keeps retries possible at low traffic.
+    """
+
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_window: int = RETRY_BUDGET_MIN_PER_WINDOW,
+        window: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ratio = ratio
+        self.min_per_window = min_per_window
+        self.window = window
+        self._clock = clock
+        self._calls: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+        self.spent = 0
+        self.exhausted = 0
+
+    def _trim(self, now: float) -> None:
+        for q in (self._calls, self._retries):
+            while q and now - q[0] > self.window:
+                q.popleft()
+
+    def record_call(self) -> None:
+        now = self._clock()
+        self._trim(now)
+        self._calls.append(now)
+
+    def try_spend(self) -> bool:
+        """Take one retry from the budget; False if it's exhausted."""
+        now = self._clock()
+        self._trim(now)
+        allowed = max(self.min_per_window, self.ratio * len(self._calls))
+        if len(self._retries) >= allowed:
+            self.exhausted += 1
+            return False
+        self._retries.append(now)
+        self.spent += 1
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._trim(self._clock())
+        return {
+            "ratio": self.ratio,
+            "min_per_window": self.min_per_window,
+            "window_seconds": self.window,
+            "calls_in_window": len(self._calls),
+            "retries_in_window": len(self._retries),
+            "spent": self.spent,
+            "exhausted": self.exhausted,
+        }
+
+
+UPSTREAMS = ("stripe", "admin", "db")
+
+breakers: Dict[str, CircuitBreaker] = {name: CircuitBreaker(name) for name in UPSTREAMS}
+retry_budget = RetryBudget()
+
+
+def breaker_stats() -> Dict[str, Any]:
+    return {
+        "breakers": {name: b.snapshot() for name, b in breakers.items()},
+        "retry_budget": retry_budget.snapshot(),
+    }
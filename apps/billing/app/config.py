@@ -15,6 +15,86 @@ ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
 PORTAL_RETURN_URL = os.getenv("PORTAL_RETURN_URL")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# "direct": webhook entitlements written straight to public.users in one
+# transaction (Admin API only as fallback). "admin_api": always go through
+# the Admin API. Direct mode needs DATABASE_URL.
+ENTITLEMENT_WRITE_MODE = os.getenv("ENTITLEMENT_WRITE_MODE", "direct").lower()
+
+# "inline": off-session top-ups are credited as soon as the charge returns.
+# "webhook": a pending top-up is recorded, the request returns immediately
+# and the balance is credited by payment_intent.succeeded (the Stripe webhook
+# endpoint must subscribe to payment_intent.* events). Needs DATABASE_URL.
+TOPUP_CONFIRMATION_MODE = os.getenv("TOPUP_CONFIRMATION_MODE", "inline").lower()
+# Pending top-ups older than this are re-checked against Stripe by the sweeper
+TOPUP_SWEEP_AFTER_SECONDS = float(os.getenv("TOPUP_SWEEP_AFTER_SECONDS", "900"))
+
+# Write-behind meeting debits: journaled immediately, applied to public.users
+# in batches every BALANCE_FLUSH_INTERVAL_MS. Needs DATABASE_URL.
+BALANCE_WRITE_BEHIND = os.getenv("BALANCE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+BALANCE_FLUSH_INTERVAL_MS = int(os.getenv("BALANCE_FLUSH_INTERVAL_MS", "250"))
+
+# Upper bound on meetings accepted by one /v1/hooks/meetings-completed call
+MAX_MEETINGS_PER_BATCH = int(os.getenv("MAX_MEETINGS_PER_BATCH", "5000"))
+
+# Run the background job scheduler inside the API process. Set to false when
+# a dedicated worker (python -m app.worker) runs the jobs instead.
+RUN_BACKGROUND_JOBS = os.getenv("RUN_BACKGROUND_JOBS", "true").lower() not in ("0", "false", "no")
+
+# Client-side Stripe request budget for this process (0 disables the limiter).
+# Stripe's live-mode limit is ~100 req/s per account, shared by all replicas.
+STRIPE_RATE_LIMIT_RPS = float(os.getenv("STRIPE_RATE_LIMIT_RPS", "50"))
+STRIPE_RATE_LIMIT_BURST = float(os.getenv("STRIPE_RATE_LIMIT_BURST", str(STRIPE_RATE_LIMIT_RPS or 1)))
+
+# Per-upstream circuit breakers (Stripe, Admin API, DB): open after N
+# consecutive transient failures, probe again after the reset timeout.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# Retries may add at most this fraction of recent calls (10s window), with a
+# small floor so low-traffic processes can still retry.
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_WINDOW = int(os.getenv("RETRY_BUDGET_MIN_PER_WINDOW", "10"))
+
+# Default time budget for an HTTP request (callers can tighten it with the
+# X-Request-Timeout-Ms header). Retries and upstream timeouts are clipped to it.
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+# Ceiling for one /v1/hooks/meetings-completed call. Each request gets a
+# budget scaled to its distinct users (about three Stripe calls each at
+# STRIPE_RATE_LIMIT_RPS); the default covers a full MAX_MEETINGS_PER_BATCH.
+MEETINGS_BATCH_DEADLINE_SECONDS = float(os.getenv(
+    "MEETINGS_BATCH_DEADLINE_SECONDS",
+    str(REQUEST_DEADLINE_SECONDS + (MAX_MEETINGS_PER_BATCH * 3 / STRIPE_RATE_LIMIT_RPS if STRIPE_RATE_LIMIT_RPS > 0 else 0)),
+))
+
+# Bulkheads: concurrent calls per dependency and how many may queue behind
+# them before new callers get a 503. Stripe SDK calls run on their own
+# STRIPE_BULKHEAD_CONCURRENCY threads. The DB is bounded by its pool.
+STRIPE_BULKHEAD_CONCURRENCY = int(os.getenv("STRIPE_BULKHEAD_CONCURRENCY", "16"))
+STRIPE_BULKHEAD_QUEUE = int(os.getenv("STRIPE_BULKHEAD_QUEUE", "64"))
+ADMIN_BULKHEAD_CONCURRENCY = int(os.getenv("ADMIN_BULKHEAD_CONCURRENCY", "16"))
+ADMIN_BULKHEAD_QUEUE = int(os.getenv("ADMIN_BULKHEAD_QUEUE", "64"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+# /v1/stats is served from a cached aggregate. After STATS_CACHE_TTL_SECONDS
+# the cached figures are still returned while one refresh runs behind them.
+STATS_CACHE_TTL_SECONDS = float(os.getenv("STATS_CACHE_TTL_SECONDS", "60"))
+
+# Portal/checkout session URLs are reused per customer for this long
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "60"))
+
+# Mutating endpoints that honor an Idempotency-Key header. The first
+# response per key is stored (in Postgres when available, and in memory)
+# for IDEMPOTENCY_TTL_SECONDS and replayed to retries.
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_PATHS = [
+    p.strip() for p in os.getenv(
+        "IDEMPOTENCY_PATHS",
+        "/v1/balance/deduct,/v1/balance/credit,/v1/balance/topup,/v1/usage,/v1/stripe/resolve-url",
+    ).split(",") if p.strip()
+]
+
 if not STRIPE_SECRET_KEY:
     raise RuntimeError("STRIPE_SECRET_KEY env var is required")
 if not ADMIN_API_URL or not ADMIN_API_TOKEN:
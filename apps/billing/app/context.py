@@ -6,12 +6,14 @@ from typing import Any, Dict, Optional
 import stripe
 
 from .config import BOT_PLANS, DATABASE_URL, PORTAL_RETURN_URL
+from .retry import with_retry
+from .singleflight import flights
 
 
 @dataclass
 class CustomerContext:
     user_id: Optional[int]
-    customer_id: str
+    customer_id: Optional[str]      # None until a checkout/payment needs one
     email: str
     bot_sub: Optional[Any]          # active/trialing/past_due sub in BOT_PLANS
     bot_tier: Optional[str]
@@ -21,18 +23,50 @@ class CustomerContext:
     success_url: str
     cancel_url: str
     return_url: str
+    pricing_url: str
 
 
-def _ensure_customer(email: str) -> Any:
-    customers = stripe.Customer.list(email=email, limit=1)
-    if customers.data:
-        return customers.data[0]
-    return stripe.Customer.create(email=email, metadata={"userEmail": email})
+async def find_customer_id(email: str, user_data: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """Look up the Stripe customer ID for an email — never creates one.
 
+    The ID stored on the user row is used when present; otherwise one
+    Customer.list (shared by concurrent callers).
+    """
+    if user_data and user_data.get("stripe_customer_id"):
+        return user_data["stripe_customer_id"]
 
-def _find_bot_subscription(customer_id: str) -> tuple[Optional[Any], Optional[str]]:
+    async def find() -> Optional[str]:
+        customers = await with_retry(stripe.Customer.list, email=email, limit=1, label="stripe list customers")
+        return customers.data[0].id if customers.data else None
+
+    return await flights.do("find_customer", email, find)
+
+
+async def _ensure_customer(email: str) -> Any:
+    """Find or create the Stripe customer for an email.
+
+    Concurrent calls for the same email share one lookup — which also keeps
+    two simultaneous first requests from creating duplicate customers.
+    """
+    async def find_or_create() -> Any:
+        customers = await with_retry(stripe.Customer.list, email=email, limit=1, label="stripe list customers")
+        if customers.data:
+            return customers.data[0]
+        return await with_retry(
+            stripe.Customer.create, email=email, metadata={"userEmail": email},
+            max_retries=0,  # a retry after a timeout could create a duplicate customer
+            label="stripe create customer",
+        )
+
+    return await flights.do("ensure_customer", email, find_or_create)
+
+
+async def _find_bot_subscription(customer_id: str) -> tuple[Optional[Any], Optional[str]]:
     """Find the best active bot subscription and its tier."""
-    subs = stripe.Subscription.list(customer=customer_id, status="all", limit=50)
+    subs = await with_retry(
+        stripe.Subscription.list, customer=customer_id, status="all", limit=50,
+        label="stripe list subs",
+    )
     for sub in subs.data:
         if sub.status not in ("active", "trialing", "past_due"):
             continue
@@ -42,8 +76,8 @@ def _find_bot_subscription(customer_id: str) -> tuple[Optional[Any], Optional[st
     return None, None
 
 
-def _has_payment_method(customer_id: str) -> tuple[bool, Optional[str]]:
-    pms = stripe.PaymentMethod.list(customer=customer_id, type="card")
+async def _has_payment_method(customer_id: str) -> tuple[bool, Optional[str]]:
+    pms = await with_retry(stripe.PaymentMethod.list, customer=customer_id, type="card", label="stripe list pms")
     if pms.data:
         return True, pms.data[0].id
     return False, None
@@ -53,19 +87,25 @@ async def load(email: str, origin: Optional[str] = None,
                success_url: Optional[str] = None,
                cancel_url: Optional[str] = None,
                return_url: Optional[str] = None) -> CustomerContext:
-    """Build CustomerContext: 3 Stripe calls + 1 DB read."""
-    default_origin = origin or PORTAL_RETURN_URL.rsplit("/", 1)[0]
+    """Build CustomerContext: 1 DB read + up to 3 Stripe reads, no writes.
 
-    # 1. Ensure Stripe customer
-    customer = _ensure_customer(email)
+    Read-only: a visitor without a Stripe customer gets a context with
+    customer_id=None; checkout paths call require_customer() to create it.
+
+    Identical concurrent loads (same email and URLs) share one build.
+    """
+    key = (email, origin, success_url, cancel_url, return_url)
+    return await flights.do(
+        "context_load", key,
+        lambda: _build(email, origin, success_url, cancel_url, return_url),
+    )
 
-    # 2. Find active bot subscription
-    bot_sub, bot_tier = _find_bot_subscription(customer.id)
 
-    # 3. Check payment method
-    has_pm, pm_id = _has_payment_method(customer.id)
+async def _build(email: str, origin: Optional[str], success_url: Optional[str],
+                 cancel_url: Optional[str], return_url: Optional[str]) -> CustomerContext:
+    default_origin = origin or PORTAL_RETURN_URL.rsplit("/", 1)[0]
 
-    # 4. Load DB user data (if DATABASE_URL configured)
+    # 1. Load DB user data (if DATABASE_URL configured)
     user_id = None
     user_data: Dict[str, Any] = {}
     if DATABASE_URL:
@@ -75,10 +115,22 @@ async def load(email: str, origin: Optional[str] = None,
             user_id = db_user.get("id")
             user_data = db_user.get("data") or {}
 
+    # 2. Look up (never create) the Stripe customer
+    customer_id = await find_customer_id(email, user_data)
+
+    bot_sub, bot_tier = None, None
+    has_pm, pm_id = False, None
+    if customer_id:
+        # 3. Find active bot subscription
+        bot_sub, bot_tier = await _find_bot_subscription(customer_id)
+
+        # 4. Check payment method
+        has_pm, pm_id = await _has_payment_method(customer_id)
+
     return CustomerContext(
         user_id=user_id,
-        customer_id=customer.id,
-        email=customer.email or email,
+        customer_id=customer_id,
+        email=email,
         bot_sub=bot_sub,
         bot_tier=bot_tier,
         has_payment_method=has_pm,
@@ -87,4 +139,21 @@ async def load(email: str, origin: Optional[str] = None,
         success_url=success_url or f"{default_origin}/account",
         cancel_url=cancel_url or f"{default_origin}/pricing",
         return_url=return_url or f"{default_origin}/account",
+        pricing_url=f"{default_origin}/pricing",
     )
+
+
+async def require_customer(ctx: CustomerContext) -> str:
+    """Create the Stripe customer now that a checkout or payment needs it."""
+    if ctx.customer_id:
+        return ctx.customer_id
+    customer = await _ensure_customer(ctx.email)
+    ctx.customer_id = customer.id
+    if DATABASE_URL:
+        from .db import merge_user_data
+        try:
+            await merge_user_data(ctx.email, {"stripe_customer_id": customer.id})
+        except Exception as e:
+            print(f"[CONTEXT] Could not store customer ID for {ctx.email}: {e}")
+    print(f"[CONTEXT] Stripe customer {customer.id} ready for {ctx.email}")
+    return customer.id
@@ -1,15 +1,22 @@
 from __future__ import annotations
 
+import asyncio
 import json
-from typing import Any, Dict, Optional
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
 
 import os
 import ssl as _ssl
 
 from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 
-from .config import DATABASE_URL
+from .config import DATABASE_URL, DB_MAX_OVERFLOW, DB_POOL_SIZE, DB_POOL_TIMEOUT, MEETINGS_BATCH_DEADLINE_SECONDS
+from . import memo
+from .singleflight import flights
 
 # ── Engine ───────────────────────────────────────────────────────────────────
 # DATABASE_URL is optional — if not set, DB features are disabled (Phase 1 compat)
@@ -17,6 +24,28 @@ from .config import DATABASE_URL
 
 _engine = None
 _session_factory = None
+_active_mode: Optional[str] = None
+
+
+# DB_CONNECTION_MODE: "direct" | "pgbouncer" | "auto" (default).
+# Transaction-pooling proxies break asyncpg's prepared-statement cache, so
+# auto only enables it when the target doesn't look like a pooler.
+_POOLER_PORTS = {"6432", "6543"}
+_POOLER_HOST_MARKERS = ("pgbouncer", "pooler", "pgpool")
+
+
+def _connection_mode(url: str) -> str:
+    mode = os.environ.get("DB_CONNECTION_MODE", "auto").lower()
+    if mode in ("direct", "pgbouncer"):
+        return mode
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    port = str(parts.port or 5432)
+    if port in _POOLER_PORTS or any(marker in host for marker in _POOLER_HOST_MARKERS):
+        return "pgbouncer"
+    if "pgbouncer=true" in url:
+        return "pgbouncer"
+    return "direct"
 
 
 def _build_url_and_args():
@@ -25,7 +54,7 @@ def _build_url_and_args():
     Handles:
     - DATABASE_URL or individual DB_* env vars
     - SSL via connect_args (asyncpg doesn't accept ssl= in URL)
-    - pgbouncer: statement_cache_size=0
+    - pgbouncer: statement_cache_size=0 (prepared statements only when direct)
     """
     db_host = os.environ.get("DB_HOST")
     db_port = os.environ.get("DB_PORT")
@@ -51,7 +80,9 @@ def _build_url_and_args():
     else:
         raise RuntimeError("DATABASE_URL not configured — DB features unavailable")
 
-    connect_args: dict = {"statement_cache_size": 0}
+    connect_args: dict = {}
+    if _connection_mode(url) == "pgbouncer":
+        connect_args["statement_cache_size"] = 0
     if needs_ssl:
         ctx = _ssl.create_default_context()
         ctx.check_hostname = False
@@ -62,10 +93,17 @@ def _build_url_and_args():
 
 
 def _get_engine():
-    global _engine, _session_factory
+    global _engine, _session_factory, _active_mode
     if _engine is None:
         url, connect_args = _build_url_and_args()
-        _engine = create_async_engine(url, pool_size=5, max_overflow=5, connect_args=connect_args)
+        _active_mode = _connection_mode(url)
+        print(f"[DB] Connection mode: {_active_mode} (prepared statement cache {'on' if _active_mode == 'direct' else 'off'})")
+        # The pool is the DB bulkhead: a short checkout timeout turns
+        # saturation into a fast 503 instead of a 30s stall
+        _engine = create_async_engine(
+            url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+            connect_args=connect_args,
+        )
         _session_factory = async_sessionmaker(_engine, class_=AsyncSession, expire_on_commit=False)
     return _engine, _session_factory
 
@@ -75,19 +113,381 @@ def get_session() -> AsyncSession:
     return factory()
 
 
+# ── Named query registry ─────────────────────────────────────────────────────
+# Every billing query is registered by name and executed through run_query so
+# call count, latency and row counts can be inspected per query.
+
+_LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_QUERIES: Dict[str, TextClause] = {}
+
+
+@dataclass
+class QueryStats:
+    calls: int = 0
+    errors: int = 0
+    rows: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    buckets: List[int] = field(default_factory=lambda: [0] * (len(_LATENCY_BUCKETS_MS) + 1))
+
+    def observe(self, elapsed_ms: float, rows: int) -> None:
+        self.calls += 1
+        self.rows += rows
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for i, bound in enumerate(_LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"le_{b}ms" for b in _LATENCY_BUCKETS_MS] + ["gt_{}ms".format(_LATENCY_BUCKETS_MS[-1])]
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rows": self.rows,
+            "avg_ms": round(self.total_ms / self.calls, 2) if self.calls else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "histogram": dict(zip(labels, self.buckets)),
+        }
+
+
+_QUERY_STATS: Dict[str, QueryStats] = {}
+
+
+def register_query(name: str, sql: str) -> str:
+    """Register a named SQL statement. Returns the name for use with run_query."""
+    _QUERIES[name] = text(sql)
+    _QUERY_STATS.setdefault(name, QueryStats())
+    return name
+
+
+async def run_query(session: AsyncSession, name: str, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Execute a registered query and record its stats.
+
+    Returns the result rows as dicts (empty for statements without RETURNING).
+    Raises CircuitOpenError without touching the pool while the DB breaker
+    is open.
+    """
+    from .bulkhead import BulkheadFull
+    from .circuit import breakers
+
+    breaker = breakers["db"]
+    breaker.before_call()
+    stats = _QUERY_STATS[name]
+    start = time.perf_counter()
+    try:
+        result = await session.execute(_QUERIES[name], params or {})
+        if result.returns_rows:
+            rows = [dict(row) for row in result.mappings().all()]
+            count = len(rows)
+        else:
+            rows = []
+            count = max(result.rowcount or 0, 0)
+    except Exception as e:
+        stats.errors += 1
+        if _is_pool_timeout(e):
+            global _pool_rejections
+            _pool_rejections += 1
+            breaker.abandon()  # saturated, not unhealthy
+            raise BulkheadFull("db") from e
+        if _is_connection_error(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()  # the DB answered; the query was wrong
+        raise
+    except BaseException:
+        breaker.abandon()
+        raise
+    breaker.record_success()
+    stats.observe((time.perf_counter() - start) * 1000, count)
+    return rows
+
+
+_pool_rejections = 0
+
+
+def _is_pool_timeout(exc: Exception) -> bool:
+    from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+    return isinstance(exc, PoolTimeoutError)
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Connection pool usage (the DB bulkhead)."""
+    stats: Dict[str, Any] = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "rejected": _pool_rejections,
+    }
+    if _engine is not None:
+        pool = _engine.pool
+        stats.update(checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+    return stats
+
+
+def _is_connection_error(exc: Exception) -> bool:
+    """Failures that say the DB (or the path to it) is unhealthy."""
+    from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+    if isinstance(exc, (OperationalError, InterfaceError, OSError, asyncio.TimeoutError)):
+        return True
+    return isinstance(exc, DBAPIError) and bool(exc.connection_invalidated)
+
+
+def query_stats() -> Dict[str, Any]:
+    """Per-query stats snapshot, keyed by query name."""
+    return {
+        "connection_mode": _active_mode,
+        "queries": {name: stats.snapshot() for name, stats in sorted(_QUERY_STATS.items())},
+    }
+
+
+_Q_USER_BY_EMAIL = register_query(
+    "user_by_email",
+    "SELECT id, email, data, max_concurrent_bots FROM public.users WHERE email = :email",
+)
+_Q_MERGE_BY_EMAIL = register_query(
+    "merge_user_data",
+    "UPDATE public.users SET data = COALESCE(data, CAST('{}' AS jsonb)) || CAST(:patch AS jsonb) WHERE email = :email RETURNING id, email, data, max_concurrent_bots",
+)
+_Q_MERGE_BY_ID = register_query(
+    "merge_user_data_by_id",
+    "UPDATE public.users SET data = COALESCE(data, CAST('{}' AS jsonb)) || CAST(:patch AS jsonb) WHERE id = :user_id RETURNING id, email, data, max_concurrent_bots",
+)
+_Q_USER_BY_CUSTOMER = register_query("user_by_customer_id", """
+    SELECT u.id, u.email, u.data, u.max_concurrent_bots
+    FROM public.billing_customer_map m JOIN public.users u ON u.id = m.user_id
+    WHERE m.customer_id = :customer_id
+""")
+_Q_MAP_CUSTOMERS = register_query("map_customer_ids", """
+    INSERT INTO public.billing_customer_map (customer_id, user_id)
+    SELECT unnest(CAST(:customer_ids AS text[])), unnest(CAST(:user_ids AS integer[]))
+    ON CONFLICT (customer_id) DO UPDATE
+        SET user_id = EXCLUDED.user_id, updated_at = now()
+        WHERE billing_customer_map.user_id IS DISTINCT FROM EXCLUDED.user_id
+""")
+
+
+# ── Schema ───────────────────────────────────────────────────────────────────
+# Billing-owned tables live next to public.users (owned by the admin API).
+# Statements are idempotent and run once at startup via ensure_schema().
+
+_SCHEMA: List[str] = [
+    # Stripe customer → user row, kept in sync by every write that sets
+    # data.stripe_customer_id. Lets webhooks resolve their target row with
+    # one indexed lookup instead of Customer.retrieve + an email filter.
+    """
+    CREATE TABLE IF NOT EXISTS public.billing_customer_map (
+        customer_id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS billing_customer_map_user_idx ON public.billing_customer_map (user_id)",
+    """
+    INSERT INTO public.billing_customer_map (customer_id, user_id)
+    SELECT data->>'stripe_customer_id', id FROM public.users
+    WHERE data->>'stripe_customer_id' IS NOT NULL
+    ON CONFLICT (customer_id) DO NOTHING
+    """,
+    # Users whose enforcement inputs changed since the last enforcement pass.
+    # UNLOGGED: losing it on a crash only delays enforcement until the next
+    # full sweep, and it saves WAL on every balance write.
+    """
+    CREATE UNLOGGED TABLE IF NOT EXISTS public.billing_dirty_users (
+        user_id INTEGER PRIMARY KEY,
+        marked_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    # Metered usage per subscription item and billing period, incremented
+    # whenever we report a usage record and reconciled against Stripe's
+    # usage summaries by a background job. Serves balance reads locally.
+    """
+    CREATE TABLE IF NOT EXISTS public.billing_usage_totals (
+        subscription_item_id TEXT NOT NULL,
+        period_start BIGINT NOT NULL,
+        subscription_id TEXT NOT NULL,
+        customer_id TEXT,
+        total_usage BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        reconciled_at TIMESTAMPTZ,
+        PRIMARY KEY (subscription_item_id, period_start)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS billing_usage_totals_sub_idx ON public.billing_usage_totals (subscription_id, period_start)",
+    # Off-session top-ups awaiting their payment_intent webhook. The row is
+    # written before the PaymentIntent is created (its key doubles as the
+    # Stripe idempotency key) and credited exactly once when it settles.
+    """
+    CREATE TABLE IF NOT EXISTS public.billing_pending_topups (
+        idempotency_key TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        email TEXT NOT NULL,
+        product TEXT NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        source TEXT NOT NULL,
+        customer_id TEXT NOT NULL,
+        payment_method_id TEXT NOT NULL,
+        payment_intent_id TEXT UNIQUE,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        resolved_at TIMESTAMPTZ
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS billing_pending_topups_open_idx ON public.billing_pending_topups (created_at) WHERE status = 'pending'",
+    # Balance deltas accepted but not yet applied to public.users (see
+    # accumulator.py). Append-only, so concurrent debits never contend on
+    # the user's row; rows are deleted by the flush that applies them.
+    """
+    CREATE TABLE IF NOT EXISTS public.billing_balance_journal (
+        id BIGSERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        deltas JSONB NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS billing_balance_journal_created_idx ON public.billing_balance_journal (created_at)",
+    # Meetings seen by the meeting-completed hooks, keyed by bot-manager's
+    # meeting ID. in_flight marks a delivery being processed right now;
+    # balance_deducted lets a redelivery retry only the Stripe report;
+    # completed_at is set once both steps are done, after which duplicate
+    # deliveries get the stored result back.
+    """
+    CREATE TABLE IF NOT EXISTS public.billing_processed_meetings (
+        meeting_id TEXT PRIMARY KEY,
+        email TEXT NOT NULL,
+        result JSONB,
+        balance_deducted BOOLEAN NOT NULL DEFAULT false,
+        in_flight BOOLEAN NOT NULL DEFAULT true,
+        claimed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        completed_at TIMESTAMPTZ
+    )
+    """,
+    # Responses stored for Idempotency-Key requests (see idempotency.py).
+    # A row without status_code is a request still running; its short
+    # expires_at lets another replica take over if that process died.
+    """
+    CREATE TABLE IF NOT EXISTS public.billing_idempotency_keys (
+        key TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        status_code INTEGER,
+        body BYTEA,
+        headers JSONB,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        expires_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS billing_idempotency_keys_expires_idx ON public.billing_idempotency_keys (expires_at)",
+    # One row per background job that is running somewhere (see tasks.py
+    # _job_lock). The holder renews expires_at while the job runs; a row
+    # left behind by a dead process lapses and the next run takes it over.
+    """
+    CREATE TABLE IF NOT EXISTS public.billing_job_leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at TIMESTAMPTZ NOT NULL
+    )
+    """,
+]
+
+
+_Q_MARK_DIRTY = register_query("mark_users_dirty", """
+    INSERT INTO public.billing_dirty_users (user_id)
+    SELECT unnest(CAST(:user_ids AS integer[]))
+    ON CONFLICT (user_id) DO NOTHING
+""")
+
+# Fields that can flip the enforcement decision (see tasks.py step 3). Any
+# write touching one of them marks the user dirty in the same transaction.
+ENFORCEMENT_FIELDS = frozenset({"bot_balance_cents", "bot_topup_enabled", "subscription_status"})
+
+
+def _touches_enforcement(patch: Dict[str, Any]) -> bool:
+    return not ENFORCEMENT_FIELDS.isdisjoint(patch)
+
+
+async def _mark_dirty(session: AsyncSession, user_ids: List[int]) -> None:
+    if user_ids and _schema_ready:
+        await run_query(session, _Q_MARK_DIRTY, {"user_ids": list(user_ids)})
+
+
+async def mark_users_dirty(user_ids: List[int]) -> None:
+    """Queue users for re-evaluation by the next enforcement pass."""
+    if not user_ids:
+        return
+    async with get_session() as session:
+        await _mark_dirty(session, user_ids)
+        await session.commit()
+
+
+# Set once ensure_schema() succeeds. Until then the billing-owned tables may
+# be missing, and a failed statement would abort the caller's whole
+# transaction (user update included) — so index/dirty writes are skipped,
+# customer lookups fall back to Stripe, and the full enforcement sweep
+# covers what the dirty set would have caught.
+_schema_ready = False
+
+
+def schema_ready() -> bool:
+    return _schema_ready
+
+
+async def ensure_schema() -> None:
+    """Create billing-owned tables/indexes if missing (safe to call repeatedly)."""
+    global _schema_ready
+    async with get_session() as session:
+        for ddl in _SCHEMA:
+            await session.execute(text(ddl))
+        await session.commit()
+    _schema_ready = True
+    print(f"[DB] Schema ensured ({len(_SCHEMA)} statements)")
+
+
+async def _remember_customers(session: AsyncSession, pairs: List[Tuple[str, int]]) -> None:
+    """Upsert customer_id → user_id rows inside the caller's transaction."""
+    if not pairs or not _schema_ready:
+        return
+    await run_query(session, _Q_MAP_CUSTOMERS, {
+        "customer_ids": [customer_id for customer_id, _ in pairs],
+        "user_ids": [user_id for _, user_id in pairs],
+    })
+
+
 # ── Helpers ──────────────────────────────────────────────────────────────────
 
 async def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
-    """Read user row from public.users by email."""
-    async with get_session() as session:
-        result = await session.execute(
-            text("SELECT id, email, data, max_concurrent_bots FROM public.users WHERE email = :email"),
-            {"email": email},
-        )
-        row = result.mappings().first()
-        if row:
-            return dict(row)
-        return None
+    """Read user row from public.users by email.
+
+    Concurrent reads of the same email share one query (see singleflight.py)
+    and repeats within one request are served from the request memo.
+    """
+    async def read() -> Optional[Dict[str, Any]]:
+        async with get_session() as session:
+            rows = await run_query(session, _Q_USER_BY_EMAIL, {"email": email})
+            return rows[0] if rows else None
+
+    return await memo.memoized("user", email, lambda: flights.do("user_by_email", email, read))
+
+
+def _written(rows: List[Dict[str, Any]]) -> None:
+    """After a committed write: later reads must not see the pre-write row.
+
+    Single-row writes return the full row, which becomes this request's
+    memoized copy; bulk writes only return IDs and emails, so they drop it.
+    """
+    for row in rows:
+        email = row.get("email")
+        if not email:
+            continue
+        flights.forget("user_by_email", email)
+        if "data" in row:
+            memo.put("user", email, row)
+        else:
+            memo.invalidate("user", email)
 
 
 async def get_user_data(email: str) -> Dict[str, Any]:
@@ -98,23 +498,647 @@ async def get_user_data(email: str) -> Dict[str, Any]:
     return {}
 
 
+async def get_user_by_customer_id(customer_id: str) -> Optional[Dict[str, Any]]:
+    """Read user row via the Stripe customer → user index (None if unmapped)."""
+    if not _schema_ready:
+        return None
+    async with get_session() as session:
+        rows = await run_query(session, _Q_USER_BY_CUSTOMER, {"customer_id": customer_id})
+        return rows[0] if rows else None
+
+
 async def merge_user_data(email: str, patch: Dict[str, Any]) -> None:
     """Atomic JSONB merge: UPDATE ... SET data = data || $patch.
     No read-modify-write race — Postgres handles the merge atomically.
     """
     async with get_session() as session:
-        await session.execute(
-            text("UPDATE public.users SET data = COALESCE(data, CAST('{}' AS jsonb)) || CAST(:patch AS jsonb) WHERE email = :email"),
-            {"email": email, "patch": json.dumps(patch)},
-        )
+        rows = await run_query(session, _Q_MERGE_BY_EMAIL, {"email": email, "patch": json.dumps(patch)})
+        if patch.get("stripe_customer_id"):
+            await _remember_customers(session, [(patch["stripe_customer_id"], row["id"]) for row in rows])
+        if _touches_enforcement(patch):
+            await _mark_dirty(session, [row["id"] for row in rows])
         await session.commit()
+    _written(rows)
 
 
 async def merge_user_data_by_id(user_id: int, patch: Dict[str, Any]) -> None:
     """Atomic JSONB merge by user ID."""
     async with get_session() as session:
-        await session.execute(
-            text("UPDATE public.users SET data = COALESCE(data, CAST('{}' AS jsonb)) || CAST(:patch AS jsonb) WHERE id = :user_id"),
-            {"user_id": user_id, "patch": json.dumps(patch)},
-        )
+        rows = await run_query(session, _Q_MERGE_BY_ID, {"user_id": user_id, "patch": json.dumps(patch)})
+        if patch.get("stripe_customer_id") and rows:
+            await _remember_customers(session, [(patch["stripe_customer_id"], user_id)])
+        if rows and _touches_enforcement(patch):
+            await _mark_dirty(session, [user_id])
+        await session.commit()
+    _written(rows)
+
+
+_Q_APPLY_ENTITLEMENTS_BY_ID = register_query("apply_entitlements_by_id", """
+    UPDATE public.users SET
+        max_concurrent_bots = CASE
+            WHEN CAST(:max_bots AS integer) IS NULL THEN max_concurrent_bots
+            WHEN CAST(:preserve_higher AS boolean) THEN GREATEST(COALESCE(max_concurrent_bots, 0), CAST(:max_bots AS integer))
+            ELSE CAST(:max_bots AS integer)
+        END,
+        data = COALESCE(data, CAST('{}' AS jsonb)) || CAST(:patch AS jsonb)
+    WHERE id = :user_id
+    RETURNING id, email, data, max_concurrent_bots
+""")
+_Q_APPLY_ENTITLEMENTS_BY_EMAIL = register_query("apply_entitlements_by_email", """
+    UPDATE public.users SET
+        max_concurrent_bots = CASE
+            WHEN CAST(:max_bots AS integer) IS NULL THEN max_concurrent_bots
+            WHEN CAST(:preserve_higher AS boolean) THEN GREATEST(COALESCE(max_concurrent_bots, 0), CAST(:max_bots AS integer))
+            ELSE CAST(:max_bots AS integer)
+        END,
+        data = COALESCE(data, CAST('{}' AS jsonb)) || CAST(:patch AS jsonb)
+    WHERE email = :email
+    RETURNING id, email, data, max_concurrent_bots
+""")
+
+
+async def apply_entitlements(
+    patch: Dict[str, Any],
+    max_bots: Optional[int],
+    preserve_higher: bool = False,
+    user_id: Optional[int] = None,
+    email: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """Write max_concurrent_bots and a data patch in one transaction.
+
+    ``max_bots=None`` leaves the column alone; ``preserve_higher`` keeps a
+    larger existing value (bot_service auto-scaling). Targets the row by
+    ``user_id`` when given, else ``email``. Returns the updated
+    ``{id, max_concurrent_bots}`` or None if no such user row exists.
+    """
+    params = {"max_bots": max_bots, "preserve_higher": preserve_higher, "patch": json.dumps(patch)}
+    async with get_session() as session:
+        if user_id is not None:
+            rows = await run_query(session, _Q_APPLY_ENTITLEMENTS_BY_ID, {**params, "user_id": user_id})
+        else:
+            rows = await run_query(session, _Q_APPLY_ENTITLEMENTS_BY_EMAIL, {**params, "email": email})
+        if rows and patch.get("stripe_customer_id"):
+            await _remember_customers(session, [(patch["stripe_customer_id"], rows[0]["id"])])
+        if rows and (max_bots is not None or _touches_enforcement(patch)):
+            await _mark_dirty(session, [rows[0]["id"]])
+        await session.commit()
+    _written(rows)
+    return rows[0] if rows else None
+
+
+# ── Usage totals ─────────────────────────────────────────────────────────────
+
+_Q_ADD_USAGE = register_query("usage_total_increment", """
+    INSERT INTO public.billing_usage_totals
+        (subscription_item_id, period_start, subscription_id, customer_id, total_usage)
+    VALUES (:item_id, :period_start, :subscription_id, :customer_id, :quantity)
+    ON CONFLICT (subscription_item_id, period_start) DO UPDATE
+        SET total_usage = billing_usage_totals.total_usage + EXCLUDED.total_usage, updated_at = now()
+""")
+
+_Q_SET_USAGE = register_query("usage_total_reconcile", """
+    WITH previous AS (
+        SELECT total_usage FROM public.billing_usage_totals
+        WHERE subscription_item_id = :item_id AND period_start = :period_start
+    )
+    INSERT INTO public.billing_usage_totals
+        (subscription_item_id, period_start, subscription_id, customer_id, total_usage, reconciled_at)
+    VALUES (:item_id, :period_start, :subscription_id, :customer_id, :total_usage, now())
+    ON CONFLICT (subscription_item_id, period_start) DO UPDATE
+        SET total_usage = EXCLUDED.total_usage, reconciled_at = now(), updated_at = now()
+    RETURNING (SELECT total_usage FROM previous) AS previous
+""")
+
+_Q_USAGE_FOR_ITEMS = register_query("usage_totals_for_items", """
+    SELECT subscription_item_id, total_usage FROM public.billing_usage_totals
+    WHERE subscription_item_id = ANY(CAST(:item_ids AS text[])) AND period_start = :period_start
+""")
+
+
+async def add_usage_total(
+    item_id: str, period_start: int, subscription_id: str, customer_id: Optional[str], quantity: int,
+) -> None:
+    """Add reported usage to the local total for an item's billing period."""
+    if not _schema_ready:
+        return
+    async with get_session() as session:
+        await run_query(session, _Q_ADD_USAGE, {
+            "item_id": item_id, "period_start": period_start, "subscription_id": subscription_id,
+            "customer_id": customer_id, "quantity": quantity,
+        })
+        await session.commit()
+
+
+async def set_usage_total(
+    item_id: str, period_start: int, subscription_id: str, customer_id: Optional[str], total_usage: int,
+) -> Optional[int]:
+    """Overwrite the local total with Stripe's figure (reconciliation).
+
+    Returns the total it replaced, or None if there was no local row.
+    """
+    async with get_session() as session:
+        rows = await run_query(session, _Q_SET_USAGE, {
+            "item_id": item_id, "period_start": period_start, "subscription_id": subscription_id,
+            "customer_id": customer_id, "total_usage": total_usage,
+        })
+        await session.commit()
+    previous = rows[0]["previous"] if rows else None
+    return int(previous) if previous is not None else None
+
+
+async def get_item_usage_totals(item_ids: List[str], period_start: int) -> Dict[str, int]:
+    """Local usage per subscription item for one billing period (items without a row are absent)."""
+    async with get_session() as session:
+        rows = await run_query(session, _Q_USAGE_FOR_ITEMS, {"item_ids": list(item_ids), "period_start": period_start})
+    return {row["subscription_item_id"]: int(row["total_usage"]) for row in rows}
+
+
+_Q_ACCOUNT_STATS = register_query("account_stats", """
+    SELECT COUNT(*) AS total_accounts, COALESCE(SUM(max_concurrent_bots), 0) AS total_contracted_bots
+    FROM public.users WHERE max_concurrent_bots > 0
+""")
+
+
+async def account_stats() -> Dict[str, int]:
+    """Accounts with bots and their total contracted bots, aggregated in SQL."""
+    async with get_session() as session:
+        rows = await run_query(session, _Q_ACCOUNT_STATS)
+    row = rows[0]
+    return {
+        "total_accounts": int(row["total_accounts"]),
+        "total_contracted_bots": int(row["total_contracted_bots"]),
+    }
+
+
+# ── Atomic increments ────────────────────────────────────────────────────────
+
+_Q_INCREMENT = register_query("increment_user_data", """
+    UPDATE public.users AS u
+    SET data = COALESCE(u.data, CAST('{}' AS jsonb)) || (
+        SELECT jsonb_object_agg(t.field, COALESCE((u.data->>t.field)::numeric, 0) + t.amount)
+        FROM unnest(CAST(:fields AS text[]), CAST(:amounts AS numeric[])) AS t(field, amount)
+    )
+    WHERE u.id = :user_id
+    RETURNING u.id, u.email, u.data, u.max_concurrent_bots
+""")
+
+
+async def _increment(session: AsyncSession, user_id: int, increments: Dict[str, float]) -> List[Dict[str, Any]]:
+    rows = await run_query(session, _Q_INCREMENT, {
+        "user_id": user_id, "fields": list(increments), "amounts": list(increments.values()),
+    })
+    if rows and _touches_enforcement(increments):
+        await _mark_dirty(session, [user_id])
+    return rows
+
+
+async def increment_user_data(user_id: int, increments: Dict[str, float]) -> Optional[Dict[str, Any]]:
+    """Add to numeric JSONB fields in one statement (no read-modify-write)."""
+    async with get_session() as session:
+        rows = await _increment(session, user_id, increments)
+        await session.commit()
+    _written(rows)
+    return rows[0] if rows else None
+
+
+# ── Balance journal (write-behind debits) ────────────────────────────────────
+
+_Q_JOURNAL_APPEND = register_query("balance_journal_append", """
+    INSERT INTO public.billing_balance_journal (user_id, deltas)
+    VALUES (:user_id, CAST(:deltas AS jsonb))
+    RETURNING id
+""")
+
+# Claim (DELETE) the given journal rows plus any orphaned by a process that
+# died before flushing, sum them per user and field, and apply the sums as
+# increments — all in one statement, so each row is applied exactly once.
+_Q_JOURNAL_APPLY = register_query("balance_journal_apply", """
+    WITH claimed AS (
+        DELETE FROM public.billing_balance_journal
+        WHERE id = ANY(CAST(:ids AS bigint[]))
+           OR created_at < now() - make_interval(secs => CAST(:orphan_after AS float8))
+        RETURNING user_id, deltas
+    ), sums AS (
+        SELECT c.user_id, d.key AS field, SUM(d.value::numeric) AS total
+        FROM claimed c, jsonb_each_text(c.deltas) AS d
+        GROUP BY c.user_id, d.key
+    ), patches AS (
+        SELECT user_id, jsonb_object_agg(field, total) AS deltas FROM sums GROUP BY user_id
+    )
+    UPDATE public.users AS u
+    SET data = COALESCE(u.data, CAST('{}' AS jsonb)) || (
+        SELECT jsonb_object_agg(t.key, COALESCE((u.data->>t.key)::numeric, 0) + t.value::numeric)
+        FROM jsonb_each_text(p.deltas) AS t
+    )
+    FROM patches AS p
+    WHERE u.id = p.user_id
+    RETURNING u.id, u.email
+""")
+
+# Journal rows older than this belong to a process that is gone
+JOURNAL_ORPHAN_SECONDS = 60.0
+
+
+async def journal_balance_deltas(user_id: int, deltas: Dict[str, float]) -> int:
+    """Durably record deltas for a user; returns the journal row ID."""
+    async with get_session() as session:
+        rows = await run_query(session, _Q_JOURNAL_APPEND, {"user_id": user_id, "deltas": json.dumps(deltas)})
+        await session.commit()
+    return rows[0]["id"]
+
+
+async def apply_balance_journal(ids: List[int], orphan_after: float = JOURNAL_ORPHAN_SECONDS) -> List[Dict[str, Any]]:
+    """Apply journal rows ``ids`` (and orphans) to public.users; returns the users updated."""
+    async with get_session() as session:
+        rows = await run_query(session, _Q_JOURNAL_APPLY, {"ids": list(ids), "orphan_after": orphan_after})
+        await _mark_dirty(session, [row["id"] for row in rows])
+        await session.commit()
+    _written(rows)
+    return rows
+
+
+# ── Pending top-ups ──────────────────────────────────────────────────────────
+
+_PENDING_TOPUP_COLUMNS = (
+    "idempotency_key, user_id, email, product, amount_cents, source, customer_id, "
+    "payment_method_id, payment_intent_id, status, created_at"
+)
+
+_Q_CREATE_TOPUP = register_query("pending_topup_create", f"""
+    INSERT INTO public.billing_pending_topups
+        (idempotency_key, user_id, email, product, amount_cents, source, customer_id, payment_method_id)
+    VALUES (:key, :user_id, :email, :product, :amount_cents, :source, :customer_id, :payment_method_id)
+    RETURNING {_PENDING_TOPUP_COLUMNS}
+""")
+
+_Q_ATTACH_TOPUP_INTENT = register_query("pending_topup_attach_intent", """
+    UPDATE public.billing_pending_topups SET payment_intent_id = :payment_intent_id
+    WHERE idempotency_key = :key AND payment_intent_id IS NULL
+""")
+
+_Q_SETTLE_TOPUP = register_query("pending_topup_settle", f"""
+    UPDATE public.billing_pending_topups
+    SET status = :status, error = :error, resolved_at = now(),
+        payment_intent_id = COALESCE(payment_intent_id, :payment_intent_id)
+    WHERE idempotency_key = :key AND status = 'pending'
+    RETURNING {_PENDING_TOPUP_COLUMNS}
+""")
+
+_Q_OPEN_TOPUP_USERS = register_query("pending_topup_open_users", """
+    SELECT DISTINCT user_id, product FROM public.billing_pending_topups WHERE status = 'pending'
+""")
+
+_Q_STALE_TOPUPS = register_query("pending_topup_stale", f"""
+    SELECT {_PENDING_TOPUP_COLUMNS},
+           EXTRACT(EPOCH FROM now() - created_at) AS age_seconds
+    FROM public.billing_pending_topups
+    WHERE status = 'pending' AND created_at < now() - make_interval(secs => :older_than)
+    ORDER BY created_at
+    LIMIT :limit
+""")
+
+
+async def create_pending_topup(
+    key: str, user_id: int, email: str, product: str, amount_cents: int, source: str,
+    customer_id: str, payment_method_id: str,
+) -> Dict[str, Any]:
+    async with get_session() as session:
+        rows = await run_query(session, _Q_CREATE_TOPUP, {
+            "key": key, "user_id": user_id, "email": email, "product": product, "amount_cents": amount_cents,
+            "source": source, "customer_id": customer_id, "payment_method_id": payment_method_id,
+        })
+        await session.commit()
+    return rows[0]
+
+
+async def attach_topup_intent(key: str, payment_intent_id: str) -> None:
+    async with get_session() as session:
+        await run_query(session, _Q_ATTACH_TOPUP_INTENT, {"key": key, "payment_intent_id": payment_intent_id})
+        await session.commit()
+
+
+async def settle_pending_topup(
+    key: str, status: str, credit_for: Optional[Callable[[Dict[str, Any]], Dict[str, float]]] = None,
+    payment_intent_id: Optional[str] = None, error: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """Resolve a pending top-up once, crediting the user in the same transaction.
+
+    ``credit_for`` maps the claimed row to the increments to apply (see
+    topups.py). Returns the claimed row, or None if the top-up was already
+    resolved (duplicate webhook, sweeper race).
+    """
+    async with get_session() as session:
+        claimed = await run_query(session, _Q_SETTLE_TOPUP, {
+            "key": key, "status": status, "error": error, "payment_intent_id": payment_intent_id,
+        })
+        if not claimed:
+            return None
+        row = claimed[0]
+        users: List[Dict[str, Any]] = []
+        if credit_for:
+            users = await _increment(session, row["user_id"], credit_for(row))
+        await session.commit()
+    _written(users)
+    if users:
+        row["user"] = users[0]
+    return row
+
+
+async def open_topup_users() -> Set[Tuple[int, str]]:
+    """(user_id, product) pairs with a top-up still awaiting confirmation."""
+    async with get_session() as session:
+        rows = await run_query(session, _Q_OPEN_TOPUP_USERS)
+    return {(r["user_id"], r["product"]) for r in rows}
+
+
+async def stale_pending_topups(older_than: float, limit: int = 100) -> List[Dict[str, Any]]:
+    async with get_session() as session:
+        return await run_query(session, _Q_STALE_TOPUPS, {"older_than": older_than, "limit": limit})
+
+
+# ── Processed meetings ───────────────────────────────────────────────────────
+
+# An in-flight claim older than this belongs to a process that died
+# mid-hook and may be taken over. Well past the longest batch deadline, so a
+# batch that is still billing is never taken over.
+MEETING_CLAIM_STALE_SECONDS = max(300.0, 2 * MEETINGS_BATCH_DEADLINE_SECONDS)
+# Rows are kept this long; bot-manager never retries older meetings
+MEETING_RETENTION_DAYS = 30
+
+_Q_CLAIM_MEETINGS = register_query("processed_meetings_claim", """
+    INSERT INTO public.billing_processed_meetings AS p (meeting_id, email)
+    SELECT unnest(CAST(:meeting_ids AS text[])), unnest(CAST(:emails AS text[]))
+    ON CONFLICT (meeting_id) DO UPDATE SET in_flight = true, claimed_at = now()
+    WHERE p.completed_at IS NULL
+      AND (NOT p.in_flight OR p.claimed_at < now() - make_interval(secs => CAST(:stale_after AS float8)))
+    RETURNING meeting_id, balance_deducted, result
+""")
+
+_Q_MEETING_RESULTS = register_query("processed_meetings_results", """
+    SELECT meeting_id, result FROM public.billing_processed_meetings
+    WHERE meeting_id = ANY(CAST(:meeting_ids AS text[])) AND completed_at IS NOT NULL
+""")
+
+_Q_SAVE_MEETINGS = register_query("processed_meetings_save", """
+    UPDATE public.billing_processed_meetings AS p
+    SET result = v.result, balance_deducted = true, in_flight = false,
+        completed_at = CASE WHEN v.completed THEN now() END
+    FROM (
+        SELECT unnest(CAST(:meeting_ids AS text[])) AS meeting_id,
+               CAST(unnest(CAST(:results AS text[])) AS jsonb) AS result,
+               unnest(CAST(:completed AS boolean[])) AS completed
+    ) AS v
+    WHERE p.meeting_id = v.meeting_id
+""")
+
+_Q_RELEASE_MEETINGS = register_query("processed_meetings_release", """
+    DELETE FROM public.billing_processed_meetings
+    WHERE meeting_id = ANY(CAST(:meeting_ids AS text[])) AND NOT balance_deducted
+""")
+
+_Q_PRUNE_MEETINGS = register_query("processed_meetings_prune", """
+    DELETE FROM public.billing_processed_meetings
+    WHERE COALESCE(completed_at, claimed_at) < now() - make_interval(days => :days)
+    RETURNING meeting_id
+""")
+
+
+async def claim_meetings(
+    claims: Dict[str, str], stale_after: float = MEETING_CLAIM_STALE_SECONDS,
+) -> Dict[str, Optional[Dict[str, Any]]]:
+    """Claim meeting IDs for billing; returns the ones this caller now owns.
+
+    ``claims`` maps meeting ID → email. The result maps each owned ID to
+    the stored result if its balance was already deducted by an earlier
+    delivery (only the Stripe report is left), else None. IDs that are
+    completed, or claimed by a live caller, are not returned.
+    """
+    if not claims:
+        return {}
+    async with get_session() as session:
+        rows = await run_query(session, _Q_CLAIM_MEETINGS, {
+            "meeting_ids": list(claims), "emails": list(claims.values()), "stale_after": stale_after,
+        })
+        await session.commit()
+    return {row["meeting_id"]: row["result"] if row["balance_deducted"] else None for row in rows}
+
+
+async def processed_meeting_results(meeting_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Stored results of completed meetings by meeting ID (in-flight ones are absent)."""
+    if not meeting_ids:
+        return {}
+    async with get_session() as session:
+        rows = await run_query(session, _Q_MEETING_RESULTS, {"meeting_ids": list(meeting_ids)})
+    return {row["meeting_id"]: row["result"] for row in rows}
+
+
+async def save_meeting_results(results: Dict[str, Dict[str, Any]], completed: Set[str]) -> None:
+    """Store results of claimed meetings whose balance was deducted.
+
+    IDs in ``completed`` are final; the rest are released with the balance
+    step marked done, so a redelivery only retries the Stripe report.
+    """
+    if not results:
+        return
+    async with get_session() as session:
+        await run_query(session, _Q_SAVE_MEETINGS, {
+            "meeting_ids": list(results),
+            "results": [json.dumps(r, default=str) for r in results.values()],
+            "completed": [key in completed for key in results],
+        })
+        await session.commit()
+
+
+async def release_meetings(meeting_ids: List[str]) -> None:
+    """Drop claims whose balance wasn't deducted so a retry can bill them again."""
+    if not meeting_ids:
+        return
+    async with get_session() as session:
+        await run_query(session, _Q_RELEASE_MEETINGS, {"meeting_ids": list(meeting_ids)})
+        await session.commit()
+
+
+async def prune_processed_meetings(days: int = MEETING_RETENTION_DAYS) -> int:
+    """Delete completed meetings older than ``days``; returns the count."""
+    async with get_session() as session:
+        rows = await run_query(session, _Q_PRUNE_MEETINGS, {"days": days})
+        await session.commit()
+    return len(rows)
+
+
+# ── Idempotency keys ─────────────────────────────────────────────────────────
+
+_Q_IDEMPOTENCY_CLAIM = register_query("idempotency_claim", """
+    INSERT INTO public.billing_idempotency_keys AS k (key, fingerprint, expires_at)
+    VALUES (:key, :fingerprint, now() + make_interval(secs => CAST(:lease AS float8)))
+    ON CONFLICT (key) DO UPDATE
+    SET fingerprint = EXCLUDED.fingerprint, status_code = NULL, body = NULL, headers = NULL,
+        created_at = now(), expires_at = EXCLUDED.expires_at
+    WHERE k.expires_at < now()
+    RETURNING key
+""")
+
+_Q_IDEMPOTENCY_GET = register_query("idempotency_get", """
+    SELECT fingerprint, status_code, body, headers, EXTRACT(EPOCH FROM expires_at) AS expires_at
+    FROM public.billing_idempotency_keys
+    WHERE key = :key AND expires_at >= now()
+""")
+
+_Q_IDEMPOTENCY_COMPLETE = register_query("idempotency_complete", """
+    UPDATE public.billing_idempotency_keys
+    SET status_code = :status_code, body = CAST(:body AS bytea), headers = CAST(:headers AS jsonb),
+        expires_at = now() + make_interval(secs => CAST(:ttl AS float8))
+    WHERE key = :key
+""")
+
+_Q_IDEMPOTENCY_RELEASE = register_query("idempotency_release", """
+    DELETE FROM public.billing_idempotency_keys WHERE key = :key AND status_code IS NULL
+""")
+
+_Q_IDEMPOTENCY_PRUNE = register_query("idempotency_prune", """
+    DELETE FROM public.billing_idempotency_keys WHERE expires_at < now() RETURNING key
+""")
+
+
+async def claim_idempotency_key(key: str, fingerprint: str, lease: float) -> Optional[Dict[str, Any]]:
+    """Claim a key for a request about to run.
+
+    Returns None if this caller now owns the key, else the live row
+    (``status_code`` None while its request is still running).
+    """
+    async with get_session() as session:
+        claimed = await run_query(session, _Q_IDEMPOTENCY_CLAIM, {"key": key, "fingerprint": fingerprint, "lease": lease})
+        rows = [] if claimed else await run_query(session, _Q_IDEMPOTENCY_GET, {"key": key})
+        await session.commit()
+    if claimed:
+        return None
+    # Expired between the two statements: report it as running, the retry will claim it
+    return rows[0] if rows else {"fingerprint": fingerprint, "status_code": None}
+
+
+async def complete_idempotency_key(
+    key: str, status_code: int, body: bytes, headers: Dict[str, str], ttl: float,
+) -> None:
+    async with get_session() as session:
+        await run_query(session, _Q_IDEMPOTENCY_COMPLETE, {
+            "key": key, "status_code": status_code, "body": body, "headers": json.dumps(headers), "ttl": ttl,
+        })
+        await session.commit()
+
+
+async def release_idempotency_key(key: str) -> None:
+    """Drop a claim whose request produced nothing worth replaying."""
+    async with get_session() as session:
+        await run_query(session, _Q_IDEMPOTENCY_RELEASE, {"key": key})
+        await session.commit()
+
+
+async def prune_idempotency_keys() -> int:
+    """Delete expired keys; returns the count."""
+    async with get_session() as session:
+        rows = await run_query(session, _Q_IDEMPOTENCY_PRUNE)
+        await session.commit()
+    return len(rows)
+
+
+# ── Bulk helpers ─────────────────────────────────────────────────────────────
+# One statement per chunk instead of one round trip per user. Chunking keeps
+# the bound arrays (and the statement's memory footprint) bounded.
+
+BULK_CHUNK_SIZE = 1000
+
+_Q_MERGE_BULK = register_query("merge_user_data_bulk", """
+    UPDATE public.users AS u
+    SET data = COALESCE(u.data, CAST('{}' AS jsonb)) || v.patch
+    FROM (
+        SELECT unnest(CAST(:ids AS integer[])) AS id,
+               CAST(unnest(CAST(:patches AS text[])) AS jsonb) AS patch
+    ) AS v
+    WHERE u.id = v.id
+    RETURNING u.id, u.email
+""")
+
+
+_Q_INCREMENT_BULK_BY_EMAIL = register_query("increment_user_data_bulk_by_email", """
+    UPDATE public.users AS u
+    SET data = COALESCE(u.data, CAST('{}' AS jsonb)) || (
+        SELECT jsonb_object_agg(t.key, COALESCE((u.data->>t.key)::numeric, 0) + t.value::numeric)
+        FROM jsonb_each_text(v.deltas) AS t
+    )
+    FROM (
+        SELECT unnest(CAST(:emails AS text[])) AS email,
+               CAST(unnest(CAST(:deltas AS text[])) AS jsonb) AS deltas
+    ) AS v
+    WHERE u.email = v.email
+    RETURNING u.id, u.email, u.data, u.max_concurrent_bots
+""")
+
+
+def _chunks(items: List[Tuple[int, Dict[str, Any]]], size: int) -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def merge_user_data_bulk(
+    patches: Dict[int, Dict[str, Any]],
+    chunk_size: int = BULK_CHUNK_SIZE,
+) -> List[int]:
+    """Apply a different JSONB patch to each user in one statement per chunk.
+
+    ``patches`` maps user ID → patch. Each row gets the same atomic
+    ``data || patch`` merge as ``merge_user_data_by_id``. Returns the IDs
+    that matched a row (unknown IDs are silently skipped).
+    """
+    if not patches:
+        return []
+    items = list(patches.items())
+    updated: List[int] = []
+    written: List[Dict[str, Any]] = []
+    async with get_session() as session:
+        for chunk in _chunks(items, chunk_size):
+            rows = await run_query(session, _Q_MERGE_BULK, {
+                "ids": [user_id for user_id, _ in chunk],
+                "patches": [json.dumps(patch) for _, patch in chunk],
+            })
+            updated.extend(row["id"] for row in rows)
+            written.extend(rows)
+        matched = set(updated)
+        await _remember_customers(session, [
+            (patch["stripe_customer_id"], user_id) for user_id, patch in items
+            if patch.get("stripe_customer_id") and user_id in matched
+        ])
+        await _mark_dirty(session, [
+            user_id for user_id, patch in items
+            if user_id in matched and _touches_enforcement(patch)
+        ])
+        await session.commit()
+    _written(written)
+    return updated
+
+
+async def increment_user_data_bulk_by_email(
+    increments: Dict[str, Dict[str, float]],
+    chunk_size: int = BULK_CHUNK_SIZE,
+) -> Dict[str, Dict[str, Any]]:
+    """Add per-user deltas to numeric JSONB fields, all in one transaction.
+
+    ``increments`` maps email → {field: delta}. Returns email → updated row
+    for the emails that matched a user.
+    """
+    if not increments:
+        return {}
+    items = list(increments.items())
+    written: List[Dict[str, Any]] = []
+    async with get_session() as session:
+        for i in range(0, len(items), chunk_size):
+            chunk = items[i:i + chunk_size]
+            written.extend(await run_query(session, _Q_INCREMENT_BULK_BY_EMAIL, {
+                "emails": [email for email, _ in chunk],
+                "deltas": [json.dumps(deltas) for _, deltas in chunk],
+            }))
+        await _mark_dirty(session, [
+            row["id"] for row in written if _touches_enforcement(increments.get(row["email"], {}))
+        ])
         await session.commit()
+    _written(written)
+    return {row["email"]: row for row in written}
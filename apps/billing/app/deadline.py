@@ -0,0 +1,91 @@
+"""
+Request deadlines carried through a contextvar.
+
+Every HTTP request gets a deadline: the caller's ``X-Request-Timeout-Ms``
+header or the route's default, whichever is tighter. ``with_retry`` and
+``admin_request`` read it to clip per-attempt timeouts and skip retries
+that can't finish in time, and raise DeadlineExceeded (→ 504) instead of
+doing work the caller has already given up on.
+
+Background jobs run without a deadline.
+"""
+from __future__ import annotations
+
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from .config import MEETINGS_BATCH_DEADLINE_SECONDS, REQUEST_DEADLINE_SECONDS
+
+DEADLINE_HEADER = "X-Request-Timeout-Ms"
+
+# Routes whose budget differs from the default
+_ROUTE_DEADLINES = {
+    "/v1/balance/check": 3.0,  # bot-manager calls this before every bot launch
+    # Ceiling only; the handler tightens it to the batch's size (see hooks.py)
+    "/v1/hooks/meetings-completed": MEETINGS_BATCH_DEADLINE_SECONDS,
+}
+
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before the work could finish."""
+
+
+def route_budget(path: str, header_value: Optional[str]) -> float:
+    """Seconds allowed for a request: route default, tightened by the header."""
+    budget = _ROUTE_DEADLINES.get(path, REQUEST_DEADLINE_SECONDS)
+    if header_value:
+        try:
+            budget = min(budget, max(float(header_value), 0.0) / 1000)
+        except ValueError:
+            pass
+    return budget
+
+
+@contextmanager
+def deadline_scope(seconds: float) -> Iterator[None]:
+    """Run a block under a deadline (nested scopes can only tighten it)."""
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def without_deadline() -> Iterator[None]:
+    """Run bookkeeping that must complete even after the request's deadline passed."""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline (None = no deadline)."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check(what: str = "") -> None:
+    """Raise DeadlineExceeded if the current deadline has passed."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Request deadline exceeded{f' before {what}' if what else ''}")
+
+
+def clip(timeout: float, what: str = "") -> float:
+    """Clip a timeout to the remaining budget (raises if nothing is left)."""
+    check(what)
+    left = remaining()
+    return timeout if left is None else min(timeout, left)
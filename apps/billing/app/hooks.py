@@ -4,34 +4,55 @@ Receiver for post-meeting hooks from bot-manager.
 Bot-manager sends: POST /v1/hooks/meeting-completed
 with meeting data (duration, user, platform, etc.)
 
+Backfills and catch-up after an outage use POST /v1/hooks/meetings-completed
+with many meetings at once: one balance transaction for the whole batch and
+one Stripe usage record per subscription item instead of per meeting.
+
 This is the billing side of the generic hook system.
 Bot-manager doesn't know about billing — it just fires hooks.
+
+Bot-manager retries deliveries, so each meeting ID is claimed in
+billing_processed_meetings before it is billed. Once both the balance
+deduction and the Stripe report are done the result is final, and a
+duplicate gets it back without touching the balance or Stripe. If only the
+deduction went through, a redelivery retries just the Stripe report. A
+delivery that races one still in flight gets 409 and is retried.
 """
 from __future__ import annotations
 
-from typing import Any, Dict
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import stripe
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse
 
-from .config import get_price_id
-from .context import _ensure_customer
-from .db import get_user_data, merge_user_data
+from .accumulator import accumulator
+from .config import (
+    BALANCE_WRITE_BEHIND, MAX_MEETINGS_PER_BATCH, REQUEST_DEADLINE_SECONDS, STRIPE_BULKHEAD_CONCURRENCY,
+    STRIPE_RATE_LIMIT_RPS, get_price_id,
+)
+from .context import find_customer_id
+from .deadline import deadline_scope, without_deadline
+from .db import (
+    claim_meetings, get_user_by_email, increment_user_data, increment_user_data_bulk_by_email,
+    processed_meeting_results, release_meetings, save_meeting_results, schema_ready,
+)
 from .retry import with_retry
+from .usage import record_usage_total
 
 router = APIRouter()
 
 
-@router.post("/v1/hooks/meeting-completed")
-async def handle_meeting_completed(payload: Dict[str, Any]):
-    meeting = payload.get("meeting", {})
+def _meeting_cost(meeting: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Cost breakdown for one meeting, or None if it can't be billed."""
     email = meeting.get("user_email")
-    duration_seconds = meeting.get("duration_seconds", 0)
-    meeting_id = meeting.get("id")
+    duration_seconds = meeting.get("duration_seconds", 0) or 0
     transcription_enabled = meeting.get("transcription_enabled", False)
-
     if not email or duration_seconds <= 0:
-        return {"skipped": True, "reason": "missing email or non-positive duration"}
+        return None
 
     duration_hours = duration_seconds / 3600.0
     duration_minutes = duration_seconds / 60.0
@@ -39,64 +60,173 @@ async def handle_meeting_completed(payload: Dict[str, Any]):
     # $0.30/hr bot + $0.10/hr transcription (if enabled)
     bot_cost_cents = int(duration_hours * 30 + 0.5)
     tx_cost_cents = int(duration_hours * 10 + 0.5) if transcription_enabled else 0
-    total_cost_cents = bot_cost_cents + tx_cost_cents
 
-    result = {
-        "meeting_id": meeting_id,
+    return {
+        "meeting_id": meeting.get("id"),
         "email": email,
         "duration_minutes": round(duration_minutes, 1),
         "bot_cost_cents": bot_cost_cents,
         "tx_cost_cents": tx_cost_cents,
-        "total_cost_cents": total_cost_cents,
+        "total_cost_cents": bot_cost_cents + tx_cost_cents,
         "transcription_enabled": transcription_enabled,
     }
 
-    # 1. Deduct from prepaid bot balance
-    # Balance CAN go negative — we never cut a meeting short.
+
+def _usage_quantity(duration_seconds: float) -> int:
+    """Metered minutes reported to Stripe for one meeting."""
+    return max(1, int(duration_seconds / 60.0 + 0.5))
+
+
+async def _find_usage_item(customer_id: Optional[str]) -> Tuple[Any, Any]:
+    """(subscription, item) carrying the bot_service metered price, or (None, None)."""
+    subs = await with_retry(
+        stripe.Subscription.list, customer=customer_id, status="active", limit=50,
+        label="stripe list subs",
+    ) if customer_id else None
+
+    price_id = get_price_id("bot_service")
+    for sub in (subs.data if subs else []):
+        for item in (sub.get("items") or {}).get("data", []):
+            item_price = item.get("price", {})
+            if (item_price.get("id") if isinstance(item_price, dict) else item.get("price")) == price_id:
+                return sub, item
+    return None, None
+
+
+def _meeting_key(meeting_id: Any) -> Optional[str]:
+    """Dedupe key for a meeting, or None if it can't be deduped (no ID or no DB)."""
+    if meeting_id is None or meeting_id == "" or not schema_ready():
+        return None
+    return str(meeting_id)
+
+
+async def _duplicate_results(meeting_ids: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Responses for meetings we couldn't claim (key → meeting ID).
+
+    The stored result if the meeting is completed, else an in-progress
+    marker: another delivery is billing it right now.
+    """
+    stored = await processed_meeting_results(list(meeting_ids))
+    responses = {}
+    for key, meeting_id in meeting_ids.items():
+        result = stored.get(key)
+        responses[key] = {**result, "duplicate": True} if result else {
+            "meeting_id": meeting_id, "duplicate": True, "in_progress": True,
+        }
+    return responses
+
+
+def _usage_settled(result: Dict[str, Any]) -> bool:
+    """Stripe needs nothing more for this meeting (reported, or no metered item)."""
+    return bool(result.get("stripe_reported") or result.get("stripe_reason"))
+
+
+async def _finish_claims(claimed: Dict[str, Dict[str, Any]]) -> None:
+    """Record claimed meetings: final once both steps are done.
+
+    Deducted but unreported meetings keep their balance step marked done so
+    a redelivery only retries Stripe; meetings whose deduction failed are
+    released entirely.
+    """
+    deducted = {key: result for key, result in claimed.items() if result.get("balance_deducted")}
+    completed = {key for key, result in deducted.items() if _usage_settled(result)}
     try:
-        data = await get_user_data(email)
-        current = data.get("bot_balance_cents", 0) or 0
-        new_balance = current - total_cost_cents  # allow negative
-        await merge_user_data(email, {
-            "bot_balance_cents": new_balance,
-            "bot_monthly_spent_cents": (data.get("bot_monthly_spent_cents", 0) or 0) + total_cost_cents,
-        })
-        result["balance_deducted"] = True
-        result["new_balance_cents"] = new_balance
+        # Must land even if the request ran out of time: an unrecorded
+        # deduction would be billed again once the claim goes stale
+        with without_deadline():
+            await save_meeting_results(deducted, completed)
+            await release_meetings([key for key in claimed if key not in deducted])
     except Exception as e:
-        result["balance_deducted"] = False
-        result["balance_error"] = str(e)
+        print(f"[HOOKS] Could not record {len(claimed)} processed meetings: {e}")
 
-    # 2. Report metered usage to Stripe (for PAYG subscribers)
+
+@router.post("/v1/hooks/meeting-completed")
+async def handle_meeting_completed(payload: Dict[str, Any]):
+    meeting = payload.get("meeting", {})
+    result = _meeting_cost(meeting)
+    if result is None:
+        return {"skipped": True, "reason": "missing email or non-positive duration"}
+
+    key = _meeting_key(result["meeting_id"])
+    if key is None:
+        return await _bill_meeting(meeting, result)
+    owned = await claim_meetings({key: result["email"]})
+    if key not in owned:
+        response = (await _duplicate_results({key: result["meeting_id"]}))[key]
+        if response.get("in_progress"):
+            raise HTTPException(
+                status_code=409, detail="Meeting is being billed by another delivery", headers={"Retry-After": "5"},
+            )
+        return response
     try:
-        customer = await with_retry(_ensure_customer, email, label="stripe ensure customer")
-        subs = await with_retry(
-            stripe.Subscription.list, customer=customer.id, status="active", limit=50,
-            label="stripe list subs",
-        )
+        return await _bill_meeting(meeting, result, owned[key])
+    finally:
+        await _finish_claims({key: result})
+
+
+async def _deduct_balance(email: str, total_cost_cents: int) -> float:
+    """Debit one meeting's cost; returns the new bot balance."""
+    user = await get_user_by_email(email)
+    if user is None:
+        raise LookupError("user not found")
+    increments = {"bot_balance_cents": -total_cost_cents, "bot_monthly_spent_cents": total_cost_cents}
+    if BALANCE_WRITE_BEHIND and schema_ready():
+        # Write-behind: journal the deltas, the row is updated on the next flush
+        await accumulator.debit(user["id"], email, increments)
+        return accumulator.overlay(email, user.get("data") or {}).get("bot_balance_cents", 0)
+    # Atomic increment: concurrent meetings and top-ups for the user can't be lost
+    updated = await increment_user_data(user["id"], increments)
+    if updated is None:
+        raise LookupError("user not found")
+    return (updated["data"] or {}).get("bot_balance_cents", 0)
+
+
+def _carry_deduction(result: Dict[str, Any], prior: Dict[str, Any]) -> None:
+    """Take the balance outcome from an earlier delivery that already deducted it."""
+    result["balance_deducted"] = True
+    result["new_balance_cents"] = prior.get("new_balance_cents")
+
+
+async def _bill_meeting(
+    meeting: Dict[str, Any], result: Dict[str, Any], prior: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Deduct one meeting from the balance and report it to Stripe; fills in ``result``.
+
+    ``prior`` is the stored result of an earlier delivery whose deduction
+    went through; only the Stripe report is retried then.
+    """
+    email = result["email"]
+    meeting_id = result["meeting_id"]
+    total_cost_cents = result["total_cost_cents"]
 
-        price_id = get_price_id("bot_service")
-        target_item = None
-        for sub in subs.data:
-            for item in (sub.get("items") or {}).get("data", []):
-                item_price = item.get("price", {})
-                if (item_price.get("id") if isinstance(item_price, dict) else item.get("price")) == price_id:
-                    target_item = item
-                    break
-            if target_item:
-                break
+    # 1. Deduct from prepaid bot balance
+    # Balance CAN go negative — we never cut a meeting short.
+    if prior is not None:
+        _carry_deduction(result, prior)
+    else:
+        try:
+            new_balance = await _deduct_balance(email, total_cost_cents)
+            result["balance_deducted"] = True
+            result["new_balance_cents"] = new_balance
+        except Exception as e:
+            result["balance_deducted"] = False
+            result["balance_error"] = str(e)
 
+    # 2. Report metered usage to Stripe (for PAYG subscribers)
+    try:
+        target_sub, target_item = await _find_usage_item(await find_customer_id(email))
         if target_item:
-            import time
+            quantity = _usage_quantity(meeting.get("duration_seconds", 0))
             await with_retry(
                 stripe.SubscriptionItem.create_usage_record,
                 target_item["id"],
-                quantity=max(1, int(duration_minutes + 0.5)),
+                quantity=quantity,
                 timestamp=int(time.time()),
                 action="increment",
                 idempotency_key=f"meeting-{meeting_id}" if meeting_id else None,
                 label="stripe usage record",
             )
+            await record_usage_total(target_sub, target_item, quantity)
             result["stripe_reported"] = True
         else:
             result["stripe_reported"] = False
@@ -107,3 +237,191 @@ async def handle_meeting_completed(payload: Dict[str, Any]):
         result["stripe_error"] = str(e)
 
     return result
+
+
+def _batch_usage_key(meeting_ids: List[Any]) -> Optional[str]:
+    """Stripe idempotency key for one grouped usage record.
+
+    Derived from the meeting IDs it covers, so a retried batch can't report
+    the same minutes twice. None if any meeting lacks an ID.
+    """
+    if not meeting_ids or any(not meeting_id for meeting_id in meeting_ids):
+        return None
+    digest = hashlib.sha256(",".join(sorted(str(m) for m in meeting_ids)).encode()).hexdigest()
+    return f"meetings-{digest[:40]}"
+
+
+async def _report_batch_usage(
+    email: str, user_data: Optional[Dict[str, Any]], results: List[Dict[str, Any]], quantities: List[int],
+) -> None:
+    """Report one user's meetings as one usage record per subscription item."""
+    try:
+        target_sub, target_item = await _find_usage_item(await find_customer_id(email, user_data))
+        if not target_item:
+            for result in results:
+                result["stripe_reported"] = False
+                result["stripe_reason"] = "no active bot_service subscription"
+            return
+        quantity = sum(quantities)
+        await with_retry(
+            stripe.SubscriptionItem.create_usage_record,
+            target_item["id"],
+            quantity=quantity,
+            timestamp=int(time.time()),
+            action="increment",
+            idempotency_key=_batch_usage_key([result["meeting_id"] for result in results]),
+            label="stripe usage record",
+        )
+        await record_usage_total(target_sub, target_item, quantity)
+        for result in results:
+            result["stripe_reported"] = True
+    except Exception as e:
+        for result in results:
+            result["stripe_reported"] = False
+            result["stripe_error"] = str(e)
+
+
+# Stripe calls to report one user's batch: customer lookup, subscriptions, usage record
+_STRIPE_CALLS_PER_USER = 3
+
+
+def _batch_budget(user_count: int) -> float:
+    """Request deadline for a batch: the default plus its users' Stripe calls at the rate limit."""
+    if STRIPE_RATE_LIMIT_RPS <= 0:
+        return REQUEST_DEADLINE_SECONDS
+    return REQUEST_DEADLINE_SECONDS + user_count * _STRIPE_CALLS_PER_USER / STRIPE_RATE_LIMIT_RPS
+
+
+# A batch entry: (result, usage quantity, prior result if already deducted)
+_BatchEntry = Tuple[Dict[str, Any], int, Optional[Dict[str, Any]]]
+
+
+async def _bill_batch(by_email: Dict[str, List[_BatchEntry]]) -> None:
+    """Deduct and report a batch's meetings (grouped by email); fills in each result."""
+    # 1. Deduct every meeting's cost in one transaction (balances may go negative).
+    # Meetings deducted by an earlier delivery only carry that outcome over.
+    to_deduct: Dict[str, List[Dict[str, Any]]] = {}
+    for billed in by_email.values():
+        for result, _, prior in billed:
+            if prior is not None:
+                _carry_deduction(result, prior)
+            else:
+                to_deduct.setdefault(result["email"], []).append(result)
+    increments = {
+        email: {
+            "bot_balance_cents": -sum(r["total_cost_cents"] for r in pending),
+            "bot_monthly_spent_cents": sum(r["total_cost_cents"] for r in pending),
+        }
+        for email, pending in to_deduct.items()
+    }
+    rows: Dict[str, Dict[str, Any]] = {}
+    try:
+        rows = await increment_user_data_bulk_by_email(increments)
+        for email, pending in to_deduct.items():
+            row = rows.get(email)
+            if row is None:
+                for result in pending:
+                    result["balance_deducted"] = False
+                    result["balance_error"] = "user not found"
+                continue
+            # Running balance after each meeting, as if they had arrived one by one
+            balance = (row["data"] or {}).get("bot_balance_cents", 0) - increments[email]["bot_balance_cents"]
+            for result in pending:
+                balance -= result["total_cost_cents"]
+                result["balance_deducted"] = True
+                result["new_balance_cents"] = int(balance)
+    except Exception as e:
+        for pending in to_deduct.values():
+            for result in pending:
+                result["balance_deducted"] = False
+                result["balance_error"] = str(e)
+
+    # 2. One usage record per user's bot_service item, within the Stripe bulkhead
+    slots = asyncio.Semaphore(STRIPE_BULKHEAD_CONCURRENCY)
+
+    async def report(email: str, billed: List[_BatchEntry]) -> None:
+        async with slots:
+            await _report_batch_usage(
+                email, (rows.get(email) or {}).get("data"),
+                [result for result, _, _ in billed], [quantity for _, quantity, _ in billed],
+            )
+
+    await asyncio.gather(*(report(email, billed) for email, billed in by_email.items()))
+
+
+@router.post("/v1/hooks/meetings-completed")
+async def handle_meetings_completed(payload: Dict[str, Any]):
+    """Bill many completed meetings at once (backfill / catch-up).
+
+    Same costs and result fields as /v1/hooks/meeting-completed, one result
+    per input meeting in input order. All balance deductions commit in one
+    transaction as atomic increments; Stripe usage is summed per user into
+    one usage record on their bot_service item. Meetings completed before
+    (by either hook) come back with their stored result and
+    ``duplicate: true``. If any meeting is still being billed by another
+    delivery the response is 409 (with the same body) so the batch is
+    resent; everything else in it is a duplicate by then.
+
+    The deadline scales with the batch's distinct users (capped at
+    MEETINGS_BATCH_DEADLINE_SECONDS). Meetings whose usage report didn't
+    finish in time come back with ``stripe_error`` and stay open; a resend
+    retries only their Stripe report.
+    """
+    meetings = payload.get("meetings") or []
+    if not isinstance(meetings, list):
+        raise HTTPException(status_code=400, detail="meetings must be a list")
+    if len(meetings) > MAX_MEETINGS_PER_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_MEETINGS_PER_BATCH} meetings per batch")
+
+    results: List[Dict[str, Any]] = []
+    billable: List[Tuple[int, Optional[str], Dict[str, Any], int]] = []  # (index in results, key, result, quantity)
+    claims: Dict[str, str] = {}
+    for meeting in meetings:
+        result = _meeting_cost(meeting if isinstance(meeting, dict) else {})
+        if result is None:
+            results.append({
+                "meeting_id": meeting.get("id") if isinstance(meeting, dict) else None,
+                "skipped": True, "reason": "missing email or non-positive duration",
+            })
+            continue
+        key = _meeting_key(result["meeting_id"])
+        if key is not None and key in claims:
+            results.append({"meeting_id": result["meeting_id"], "skipped": True, "reason": "duplicate meeting in batch"})
+            continue
+        if key is not None:
+            claims[key] = result["email"]
+        billable.append((len(results), key, result, _usage_quantity(meeting["duration_seconds"])))
+        results.append(result)
+
+    owned = await claim_meetings(claims)
+    duplicates = await _duplicate_results({
+        key: result["meeting_id"] for _, key, result, _ in billable if key is not None and key not in owned
+    })
+    by_email: Dict[str, List[_BatchEntry]] = {}
+    for index, key, result, quantity in billable:
+        if key in duplicates:
+            results[index] = duplicates[key]
+            continue
+        by_email.setdefault(result["email"], []).append((result, quantity, owned.get(key) if key else None))
+
+    try:
+        with deadline_scope(_batch_budget(len(by_email))):
+            await _bill_batch(by_email)
+    finally:
+        await _finish_claims({
+            key: result for _, key, result, _ in billable if key is not None and key in owned
+        })
+
+    billed_count = sum(len(billed) for billed in by_email.values())
+    print(f"[HOOKS] Billed {billed_count}/{len(meetings)} meetings for {len(by_email)} users in one batch")
+    in_progress = sum(1 for d in duplicates.values() if d.get("in_progress"))
+    body = {
+        "processed": billed_count,
+        "duplicates": len(duplicates) - in_progress,
+        "in_progress": in_progress,
+        "skipped": len(meetings) - billed_count - len(duplicates),
+        "results": results,
+    }
+    if in_progress:
+        return JSONResponse(status_code=409, content=body, headers={"Retry-After": "5"})
+    return body
@@ -0,0 +1,174 @@
+"""
+Idempotency-Key replay for retried mutating requests.
+
+The webapp and bot-manager retry deductions, credits, top-ups, usage reports
+and resolve-url calls on network errors. A request to one of
+IDEMPOTENCY_PATHS that carries an ``Idempotency-Key`` header runs once; its
+status, headers and body are stored for IDEMPOTENCY_TTL_SECONDS and replayed
+to every retry with ``Idempotent-Replayed: true``.
+
+- Memory front: replays from this process never touch the DB.
+- Postgres (billing_idempotency_keys): replays across replicas; a key whose
+  request is still running elsewhere gets 409 and the caller retries.
+- Concurrent duplicates in this process collapse onto the first execution
+  (see singleflight.py) and get its response.
+
+Keys are scoped to method + path. Reusing a key with a different body is
+rejected with 422. 5xx, 409 and 429 responses aren't stored, so the retry
+runs again.
+"""
+from __future__ import annotations
+
+import hashlib
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from . import db
+from .config import DATABASE_URL, IDEMPOTENCY_PATHS, IDEMPOTENCY_TTL_SECONDS, REQUEST_DEADLINE_SECONDS
+from .singleflight import flights
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+_MAX_ENTRIES = 10000
+_UNSTORED_STATUSES = (409, 429)
+# Response headers that describe one transmission, not the response
+_SKIP_HEADERS = ("content-length", "transfer-encoding", "connection")
+# How long another replica waits on a running request before taking the key over
+_CLAIM_LEASE_SECONDS = REQUEST_DEADLINE_SECONDS * 2
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request body."""
+
+
+class IdempotencyInProgress(Exception):
+    """The key's first request is still running on another replica."""
+
+
+@dataclass
+class StoredResponse:
+    fingerprint: str
+    status_code: int
+    body: bytes
+    headers: Dict[str, str] = field(default_factory=dict)
+    expires_at: float = 0.0
+
+
+def fingerprint(method: str, path: str, query: str, body: bytes) -> str:
+    """Digest identifying the request a key was first used for."""
+    digest = hashlib.sha256(f"{method} {path}?{query}\n".encode())
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def storable_headers(headers: List[Tuple[str, str]]) -> Dict[str, str]:
+    return {name: value for name, value in headers if name.lower() not in _SKIP_HEADERS}
+
+
+class IdempotencyStore:
+    def __init__(
+        self, paths: List[str] = IDEMPOTENCY_PATHS, ttl: float = IDEMPOTENCY_TTL_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.paths = set(paths)
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: Dict[str, StoredResponse] = {}
+        self.executions = 0
+        self.memory_replays = 0
+        self.db_replays = 0
+        self.conflicts = 0
+        self.in_progress = 0
+
+    def applies(self, method: str, path: str) -> bool:
+        return method in ("POST", "PUT", "PATCH", "DELETE") and path in self.paths
+
+    def _remember(self, key: str, stored: StoredResponse) -> None:
+        now = self._clock()
+        for k in [k for k, entry in self._entries.items() if entry.expires_at <= now]:
+            del self._entries[k]
+        while len(self._entries) >= _MAX_ENTRIES:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = stored
+
+    async def execute(
+        self, method: str, path: str, idempotency_key: str, request_fingerprint: str,
+        run: Callable[[], Awaitable[StoredResponse]],
+    ) -> Tuple[StoredResponse, bool]:
+        """The response for this key: (response, replayed).
+
+        ``run`` executes the request and returns its response (fingerprint
+        unset). Raises IdempotencyConflict or IdempotencyInProgress.
+        """
+        key = hashlib.sha256(f"{method} {path} {idempotency_key}".encode()).hexdigest()
+        stored = self._entries.get(key)
+        if stored is not None and stored.expires_at > self._clock():
+            self.memory_replays += 1
+            replayed = True
+        else:
+            stored, replayed = await flights.do(
+                "idempotency", key, lambda: self._first(key, request_fingerprint, run),
+            )
+        if stored.fingerprint != request_fingerprint:
+            self.conflicts += 1
+            raise IdempotencyConflict(f"{IDEMPOTENCY_HEADER} was already used for a different request")
+        return stored, replayed
+
+    async def _first(
+        self, key: str, request_fingerprint: str, run: Callable[[], Awaitable[StoredResponse]],
+    ) -> Tuple[StoredResponse, bool]:
+        use_db = bool(DATABASE_URL) and db.schema_ready()
+        if use_db:
+            row = await db.claim_idempotency_key(key, request_fingerprint, _CLAIM_LEASE_SECONDS)
+            if row is not None:
+                if row["status_code"] is None:
+                    self.in_progress += 1
+                    raise IdempotencyInProgress(f"A request with this {IDEMPOTENCY_HEADER} is still in progress")
+                stored = StoredResponse(
+                    row["fingerprint"], row["status_code"], bytes(row["body"] or b""),
+                    row["headers"] or {}, float(row["expires_at"]),
+                )
+                self._remember(key, stored)
+                self.db_replays += 1
+                return stored, True
+
+        self.executions += 1
+        try:
+            response = await run()
+        except BaseException:
+            if use_db:
+                await db.release_idempotency_key(key)
+            raise
+        response.fingerprint = request_fingerprint
+        response.expires_at = self._clock() + self.ttl
+        if response.status_code >= 500 or response.status_code in _UNSTORED_STATUSES:
+            if use_db:
+                await db.release_idempotency_key(key)
+            return response, False
+
+        self._remember(key, response)
+        if use_db:
+            try:
+                await db.complete_idempotency_key(key, response.status_code, response.body, response.headers, self.ttl)
+            except Exception as e:
+                # The claim lapses after its lease; until then retries elsewhere get 409
+                print(f"[IDEMPOTENCY] Could not store response for {key[:12]}: {e}")
+        return response, False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "paths": sorted(self.paths),
+            "ttl_seconds": self.ttl,
+            "entries": len(self._entries),
+            "executions": self.executions,
+            "memory_replays": self.memory_replays,
+            "db_replays": self.db_replays,
+            "conflicts": self.conflicts,
+            "in_progress": self.in_progress,
+            "collapsed": flights.stats()["operations"].get("idempotency", {}).get("coalesced", 0),
+        }
+
+
+idempotency = IdempotencyStore()
@@ -0,0 +1,74 @@
+"""
+Email → Admin API user ID identity map.
+
+The Admin API only hands out user IDs through its upsert endpoint
+(POST /admin/users), which costs a round trip per lookup. User IDs never
+change for an email, so they're cached in a bounded in-process LRU and,
+when DATABASE_URL is set, read from public.users.id (the Admin API's own
+table). The upsert only runs for genuinely new users.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import HTTPException, status
+
+from .config import DATABASE_URL
+
+_MAX_ENTRIES = 10000
+
+_cache: "OrderedDict[str, int]" = OrderedDict()
+_stats = {"hits": 0, "db_hits": 0, "upserts": 0}
+
+
+def remember(email: str, user_id: int) -> None:
+    _cache[email] = user_id
+    _cache.move_to_end(email)
+    if len(_cache) > _MAX_ENTRIES:
+        _cache.popitem(last=False)
+
+
+def forget(email: str) -> None:
+    _cache.pop(email, None)
+
+
+async def lookup_user_id(email: str) -> Optional[int]:
+    """Cached/DB lookup only — never creates a user. None on a miss."""
+    user_id = _cache.get(email)
+    if user_id is not None:
+        _cache.move_to_end(email)
+        _stats["hits"] += 1
+        return user_id
+    if DATABASE_URL:
+        from .db import get_user_by_email
+        row = await get_user_by_email(email)
+        if row:
+            _stats["db_hits"] += 1
+            remember(email, row["id"])
+            return row["id"]
+    return None
+
+
+async def upsert_user(email: str) -> Tuple[int, Dict[str, Any]]:
+    """Create-or-fetch the user through the Admin API and cache its ID.
+
+    Returns (user_id, user payload from the Admin API).
+    """
+    from .admin import admin_request
+
+    resp = await admin_request("POST", "/admin/users", {"email": email})
+    if resp.status_code not in (200, 201):
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Admin API user upsert failed: {resp.text}",
+        )
+    _stats["upserts"] += 1
+    user_data = resp.json()
+    user_id = user_data.get("id") or (user_data.get("data") or {}).get("id")
+    remember(email, user_id)
+    return user_id, user_data
+
+
+def identity_stats() -> Dict[str, Any]:
+    return {"size": len(_cache), **_stats}
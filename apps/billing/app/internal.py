@@ -0,0 +1,100 @@
+"""
+Internal operational endpoints (metrics and diagnostics).
+
+Not part of the public billing API — meant for operators and dashboards
+inside the private network.
+"""
+from __future__ import annotations
+
+from typing import Any, Dict
+
+from fastapi import APIRouter, HTTPException
+
+router = APIRouter(prefix="/internal")
+
+
+@router.get("/db/queries")
+async def db_query_stats() -> Dict[str, Any]:
+    """Per-query call count, latency histogram and rows returned."""
+    from .db import query_stats
+    return query_stats()
+
+
+@router.get("/identity")
+async def identity_map_stats() -> Dict[str, Any]:
+    """Email → user ID cache size and hit/upsert counters."""
+    from .identity import identity_stats
+    return identity_stats()
+
+
+@router.get("/jobs")
+async def job_stats() -> Dict[str, Any]:
+    """Registered background jobs: schedule, last run, duration, outcome."""
+    from .scheduler import scheduler
+    return scheduler.stats()
+
+
+@router.post("/jobs/{name}/run")
+async def run_job(name: str) -> Dict[str, Any]:
+    """Run a job now (waits for it). Overlapping runs are refused as 'skipped'.
+
+    Cron jobs (e.g. monthly_reset) are not idempotent between their
+    scheduled times and can't be run by hand.
+    """
+    from .scheduler import scheduler
+    if name not in scheduler.jobs:
+        raise HTTPException(status_code=404, detail=f"Unknown job '{name}'")
+    cron = scheduler.jobs[name].cron
+    if cron is not None:
+        raise HTTPException(status_code=409, detail=f"Job '{name}' only runs on its schedule ({cron.expr})")
+    outcome = await scheduler.run_now(name)
+    return {"job": name, "outcome": outcome, **scheduler.jobs[name].snapshot()}
+
+
+@router.get("/stripe/limiter")
+async def stripe_limiter_stats() -> Dict[str, Any]:
+    """Stripe token bucket: tokens left, per-lane throttle counts and waits."""
+    from .ratelimit import stripe_limiter
+    return stripe_limiter.snapshot()
+
+
+@router.get("/breakers")
+async def circuit_breaker_stats() -> Dict[str, Any]:
+    """Per-upstream breaker state, transition counts and retry budget usage."""
+    from .circuit import breaker_stats
+    return breaker_stats()
+
+
+@router.get("/bulkheads")
+async def bulkhead_stats() -> Dict[str, Any]:
+    """Per-dependency active/queued calls, peaks and rejections."""
+    from .bulkhead import bulkhead_stats as stats
+    return stats()
+
+
+@router.get("/singleflight")
+async def singleflight_stats() -> Dict[str, Any]:
+    """Coalesced vs executed calls per operation (hit rate)."""
+    from .singleflight import flights
+    return flights.stats()
+
+
+@router.get("/sessions")
+async def session_cache_stats() -> Dict[str, Any]:
+    """Reused portal/checkout sessions: entries, hit rate, invalidations."""
+    from .sessions import sessions
+    return sessions.stats()
+
+
+@router.get("/accumulator")
+async def accumulator_stats() -> Dict[str, Any]:
+    """Write-behind debits: unflushed count, flushes, rows applied, errors."""
+    from .accumulator import accumulator
+    return accumulator.stats()
+
+
+@router.get("/idempotency")
+async def idempotency_stats() -> Dict[str, Any]:
+    """Idempotency-Key requests: executions, replays (memory/DB), conflicts."""
+    from .idempotency import idempotency
+    return idempotency.stats()
@@ -1,27 +1,128 @@
 from __future__ import annotations
 
 from contextlib import asynccontextmanager
+from typing import Any, Dict
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
 
-from .config import DATABASE_URL  # noqa: F401 — validates env on import
+from .config import BALANCE_WRITE_BEHIND, DATABASE_URL, RUN_BACKGROUND_JOBS  # validates env on import
 from .router import router as resolve_router
 from .webhook import router as webhook_router
 from .usage import router as usage_router
 from .admin import router as admin_router
 from .balance import router as balance_router
-from .tasks import router as tasks_router, start_background_tasks
+from .tasks import router as tasks_router, start_background_tasks, stop_background_tasks
 from .hooks import router as hooks_router
+from .internal import router as internal_router
+from .accumulator import accumulator
+from .bulkhead import BulkheadFull
+from .circuit import CircuitOpenError
+from .deadline import DEADLINE_HEADER, DeadlineExceeded, deadline_scope, route_budget
+from .idempotency import (
+    IDEMPOTENCY_HEADER, REPLAYED_HEADER, IdempotencyConflict, IdempotencyInProgress, StoredResponse,
+    fingerprint, idempotency, storable_headers,
+)
+from .memo import request_memo
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    start_background_tasks()
+    if DATABASE_URL:
+        from .db import ensure_schema
+        try:
+            await ensure_schema()
+        except Exception as e:
+            # Serve anyway: user writes still commit, customer lookups fall
+            # back to Stripe and enforcement relies on the full sweep.
+            print(f"[BILLING] WARNING: schema setup failed, billing tables disabled: {e}")
+    if RUN_BACKGROUND_JOBS:
+        start_background_tasks()
+    else:
+        print("[BILLING] Background jobs disabled in API process (RUN_BACKGROUND_JOBS=false)")
+    if BALANCE_WRITE_BEHIND and DATABASE_URL:
+        accumulator.start()
     yield
+    await accumulator.stop()
+    await stop_background_tasks()
 
 
 app = FastAPI(title="Billing Service", version="0.4.0", lifespan=lifespan)
 
+
+@app.middleware("http")
+async def request_deadline(request: Request, call_next):
+    """Give every request a deadline that retries and upstream calls honor."""
+    budget = route_budget(request.url.path, request.headers.get(DEADLINE_HEADER))
+    if budget <= 0:
+        return JSONResponse(status_code=504, content={"detail": "Request deadline already exceeded"})
+    with deadline_scope(budget):
+        return await call_next(request)
+
+
+@app.middleware("http")
+async def request_scoped_memo(request: Request, call_next):
+    """Memoize Stripe/DB reads per request; report the calls it saved."""
+    with request_memo() as memo:
+        response = await call_next(request)
+    if memo.saved_calls:
+        response.headers["X-Billing-Saved-Calls"] = str(memo.saved_calls)
+        print(f"[MEMO] {request.method} {request.url.path}: saved {memo.saved_calls} calls ({memo.summary()})")
+    return response
+
+
+@app.middleware("http")
+async def idempotent_requests(request: Request, call_next):
+    """Run a request with an Idempotency-Key once; replay its response to retries."""
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key or not idempotency.applies(request.method, request.url.path):
+        return await call_next(request)
+    body = await request.body()
+
+    async def run() -> StoredResponse:
+        response = await call_next(request)
+        content = b"".join([chunk async for chunk in response.body_iterator])
+        return StoredResponse("", response.status_code, content, storable_headers(response.headers.items()))
+
+    try:
+        stored, replayed = await idempotency.execute(
+            request.method, request.url.path, key,
+            fingerprint(request.method, request.url.path, request.url.query, body), run,
+        )
+    except IdempotencyConflict as e:
+        return JSONResponse(status_code=422, content={"detail": str(e)})
+    except IdempotencyInProgress as e:
+        return JSONResponse(status_code=409, content={"detail": str(e)}, headers={"Retry-After": "1"})
+    headers = dict(stored.headers)
+    if replayed:
+        headers[REPLAYED_HEADER] = "true"
+    return Response(content=stored.body, status_code=stored.status_code, headers=headers)
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, exc: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+
+@app.exception_handler(BulkheadFull)
+async def bulkhead_full_handler(request: Request, exc: BulkheadFull):
+    """Only endpoints that need the saturated dependency are shed."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "dependency": exc.name},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    """Fail fast with 503 while an upstream's breaker is open."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "upstream": exc.upstream},
+        headers={"Retry-After": str(max(int(exc.retry_after + 0.999), 1))},
+    )
+
 # Mount all routers
 app.include_router(resolve_router)
 app.include_router(webhook_router)
@@ -30,49 +131,101 @@ app.include_router(admin_router)
 app.include_router(balance_router)
 app.include_router(tasks_router)
 app.include_router(hooks_router)
+app.include_router(internal_router)
 
 # Bot balance — kept for backward compat until frontend migrates to /v1/balance/
 from .models import BotBalanceRequest
+from .retry import with_retry
 import stripe
 
 
+# Subscription statuses that still count as "has a PAYG subscription"
+_BOT_BALANCE_SUB_STATUSES = ("active", "past_due", "scheduled_to_cancel")
+_NO_BOT_SUBSCRIPTION = {"balance_cents": 0, "initial_credit_cents": 0, "usage_cents": 0, "has_subscription": False}
+
+
+def _bot_balance_payload(initial_credit: int, total_usage: int) -> Dict[str, Any]:
+    usage_cents = int(total_usage * 30)  # $0.30/hr
+    balance_cents = initial_credit - usage_cents
+    return {
+        "balance_cents": balance_cents,
+        "initial_credit_cents": initial_credit,
+        "usage_cents": usage_cents,
+        "has_subscription": True,
+        "balance_usd": f"-${abs(balance_cents) / 100:.2f}" if balance_cents < 0 else f"${balance_cents / 100:.2f}",
+        "usage_usd": f"${usage_cents / 100:.2f}",
+        "initial_credit_usd": f"${initial_credit / 100:.2f}",
+    }
+
+
 @app.post("/v1/stripe/bot-balance")
 async def get_bot_balance(req: BotBalanceRequest):
-    """Legacy bot balance endpoint — kept for backward compat."""
-    customers = stripe.Customer.list(email=req.email, limit=1)
-    if not customers.data:
-        return {"balance_cents": 0, "initial_credit_cents": 0, "usage_cents": 0, "has_subscription": False}
+    """Legacy bot balance endpoint — kept for backward compat.
+
+    Served from the subscription fields webhooks keep in users.data and the
+    local usage totals (see tasks.reconcile_usage_totals) — no Stripe calls.
+    Subscribers without stored items or a local total for the current
+    period (created before totals existed, not yet reconciled) are read
+    from Stripe instead.
+    """
+    if not DATABASE_URL:
+        return await _bot_balance_from_stripe(req.email)
+
+    from .db import get_item_usage_totals, get_user_by_email
+    user = await get_user_by_email(req.email)
+    data = (user or {}).get("data") or {}
+    sub_id = data.get("stripe_subscription_id")
+    if (
+        not sub_id
+        or data.get("subscription_tier") != "bot_service"
+        or data.get("subscription_status") not in _BOT_BALANCE_SUB_STATUSES
+    ):
+        return dict(_NO_BOT_SUBSCRIPTION)
+
+    item_ids = data.get("subscription_item_ids")
+    period_start = data.get("subscription_current_period_start")
+    totals = (
+        await get_item_usage_totals(item_ids, int(period_start))
+        if isinstance(item_ids, list) and item_ids and period_start else {}
+    )
+    # Same item as the Stripe read: the last one with a usage figure
+    item_id = next((i for i in reversed(item_ids or []) if i in totals), None)
+    if item_id is None:
+        return await _bot_balance_from_stripe(req.email)
+
+    initial_credit = int(data.get("subscription_initial_credit_cents", 500) or 0)
+    return _bot_balance_payload(initial_credit, totals[item_id])
 
-    customer = customers.data[0]
-    subs = stripe.Subscription.list(customer=customer.id, status="all", limit=50)
+
+async def _bot_balance_from_stripe(email: str) -> Dict[str, Any]:
+    """Stripe read: deployments without DATABASE_URL, and subscribers without local totals."""
+    from .stripe_reads import customer_with_subscriptions
+
+    customer = await customer_with_subscriptions(email)
+    if not customer:
+        return dict(_NO_BOT_SUBSCRIPTION)
+
+    subs = (customer.get("subscriptions") or {}).get("data") or []
     active_sub = next(
-        (s for s in subs.data if s.status in ("active", "past_due") and s.metadata.get("tier") == "bot_service"),
+        (s for s in subs if s.status in ("active", "past_due") and s.metadata.get("tier") == "bot_service"),
         None,
     )
     if not active_sub:
-        return {"balance_cents": 0, "initial_credit_cents": 0, "usage_cents": 0, "has_subscription": False}
+        return dict(_NO_BOT_SUBSCRIPTION)
 
     initial_credit = int(active_sub.metadata.get("initial_credit_cents", "500"))
-    usage_cents = 0
+    total_usage = 0
     for item in active_sub["items"]["data"]:
         try:
-            summaries = stripe.SubscriptionItem.list_usage_record_summaries(item.id, limit=1)
+            summaries = await with_retry(
+                stripe.SubscriptionItem.list_usage_record_summaries, item.id, limit=1,
+                label="stripe usage summaries",
+            )
             if summaries.data:
                 total_usage = summaries.data[0].total_usage
-                usage_cents = int(total_usage * 30)  # $0.30/hr
         except Exception as e:
             print(f"[BOT-BALANCE] Error getting usage for {item.id}: {e}")
-
-    balance_cents = initial_credit - usage_cents
-    return {
-        "balance_cents": balance_cents,
-        "initial_credit_cents": initial_credit,
-        "usage_cents": usage_cents,
-        "has_subscription": True,
-        "balance_usd": f"-${abs(balance_cents) / 100:.2f}" if balance_cents < 0 else f"${balance_cents / 100:.2f}",
-        "usage_usd": f"${usage_cents / 100:.2f}",
-        "initial_credit_usd": f"${initial_credit / 100:.2f}",
-    }
+    return _bot_balance_payload(initial_credit, total_usage)
 
 
 @app.get("/")
@@ -0,0 +1,110 @@
+"""
+Request-scoped read memo for Stripe objects and DB user rows.
+
+One HTTP request (including one webhook event) gets one memo. Reads go
+through ``memoized(kind, key, fn)``: the first read calls ``fn``, repeats in
+the same request return a copy of that result. Writes made by the same
+request either replace the entry with the row they returned (``put``) or
+drop it (``invalidate``), so a request always reads its own writes.
+
+Outside a request (background jobs) there is no memo and every read goes
+to the source. ``None`` results are not memoized: a missing row or object
+may be created later in the same request through a path we don't see.
+"""
+from __future__ import annotations
+
+import contextvars
+import copy
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class RequestMemo:
+    def __init__(self) -> None:
+        self._values: Dict[Tuple[str, Hashable], Any] = {}
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+
+    @property
+    def saved_calls(self) -> int:
+        return sum(self.hits.values())
+
+    def summary(self) -> str:
+        return ", ".join(f"{kind}={n}" for kind, n in sorted(self.hits.items()))
+
+
+_current: contextvars.ContextVar[Optional[RequestMemo]] = contextvars.ContextVar("request_memo", default=None)
+
+
+@contextmanager
+def request_memo() -> Iterator[RequestMemo]:
+    """Open a memo for the duration of one request."""
+    memo = RequestMemo()
+    token = _current.set(memo)
+    try:
+        yield memo
+    finally:
+        _current.reset(token)
+
+
+async def memoized(kind: str, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+    memo = _current.get()
+    if memo is None:
+        return await fn()
+    entry = (kind, key)
+    if entry in memo._values:
+        memo.hits[kind] += 1
+        return copy.deepcopy(memo._values[entry])
+    memo.misses[kind] += 1
+    value = await fn()
+    if value is not None:
+        memo._values[entry] = copy.deepcopy(value)
+    return value
+
+
+def put(kind: str, key: Hashable, value: Any) -> None:
+    """Record a value this request just wrote (write-through)."""
+    memo = _current.get()
+    if memo is not None and value is not None:
+        memo._values[(kind, key)] = copy.deepcopy(value)
+
+
+def invalidate(kind: str, key: Hashable) -> None:
+    memo = _current.get()
+    if memo is not None:
+        memo._values.pop((kind, key), None)
+
+
+# ── Stripe customers ─────────────────────────────────────────────────────────
+
+# Every retrieve expands the default payment method/source, so one memo entry
+# serves both plain reads and payment-method resolution. Readers must accept
+# either an expanded object or an ID there (stripe_reads.default_payment_method_id).
+CUSTOMER_EXPAND = ["invoice_settings.default_payment_method", "default_source"]
+
+
+async def retrieve_customer(customer_id: str, label: str = "stripe retrieve customer") -> Any:
+    """Customer.retrieve, at most once per request."""
+    import stripe
+
+    from .retry import with_retry
+
+    return await memoized(
+        "stripe_customer", customer_id,
+        lambda: with_retry(stripe.Customer.retrieve, customer_id, expand=CUSTOMER_EXPAND, label=label),
+    )
+
+
+async def modify_customer(customer_id: str, label: str = "stripe modify customer", **params: Any) -> Any:
+    """Customer.modify; the returned customer replaces any memoized copy."""
+    import stripe
+
+    from .retry import with_retry
+
+    invalidate("stripe_customer", customer_id)
+    customer = await with_retry(stripe.Customer.modify, customer_id, label=label, **params)
+    put("stripe_customer", customer_id, customer)
+    return customer
@@ -69,6 +69,7 @@ class TopupRequest(BaseModel):
     email: EmailStr
     amount_cents: Optional[int] = None  # override topup amount
     origin: Optional[str] = None  # for Checkout redirect URLs
+    idempotency_key: Optional[str] = None  # same key on retries → charged once
 
 
 class PaymentMethodRequest(BaseModel):
@@ -0,0 +1,84 @@
+"""
+Default payment method resolution, cached on the user row.
+
+Off-session charges (manual and auto top-ups) need the customer's default
+payment method. It is kept in ``users.data.stripe_payment_method_id`` and
+only looked up in Stripe when that is empty:
+
+1. customer with ``invoice_settings.default_payment_method`` and
+   ``default_source`` expanded (one call, see stripe_reads.py)
+2. otherwise the most recent attached card, which is then made the
+   customer's default so later lookups find it in step 1
+
+Webhooks keep the cached value current: ``payment_method.attached`` fills
+an empty slot, ``payment_method.detached`` clears a removed card and
+``customer.updated`` follows changes to the default.
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, Optional
+
+import stripe
+
+from .memo import modify_customer
+from .retry import with_retry
+from .stripe_reads import customer_with_payment_method, default_payment_method_id
+
+PM_FIELD = "stripe_payment_method_id"
+
+
+async def resolve_default_payment_method(
+    customer_id: str, user_data: Optional[Dict[str, Any]] = None,
+) -> Optional[str]:
+    """Cached default payment method, else looked up (and made default) in Stripe.
+
+    Storing a looked-up value is left to the caller, which usually has a
+    patch for the same row to write anyway.
+    """
+    cached = (user_data or {}).get(PM_FIELD)
+    if cached:
+        return cached
+
+    customer = await customer_with_payment_method(customer_id)
+    pm_id = default_payment_method_id(customer)
+    if pm_id:
+        return pm_id
+
+    pms = await with_retry(
+        stripe.PaymentMethod.list, customer=customer_id, type="card", limit=1,
+        label="stripe list payment methods",
+    )
+    if not pms.data:
+        return None
+    pm_id = pms.data[0].id
+    try:
+        await modify_customer(customer_id, invoice_settings={"default_payment_method": pm_id}, label="stripe set default pm")
+    except stripe.error.StripeError:
+        pass
+    return pm_id
+
+
+def payment_method_patch(event_type: str, obj: Dict[str, Any], previous: Dict[str, Any], cached: Optional[str]) -> Optional[Dict[str, Any]]:
+    """users.data patch for a payment-method webhook, or None if nothing changes.
+
+    ``previous`` is the event's ``data.previous_attributes``.
+    """
+    if event_type == "payment_method.attached":
+        if not cached and obj.get("type") == "card":
+            return {PM_FIELD: obj.get("id")}
+    elif event_type == "payment_method.detached":
+        if cached and cached == obj.get("id"):
+            return {PM_FIELD: None}
+    elif event_type == "customer.updated":
+        if "invoice_settings" in previous or "default_source" in previous:
+            pm_id = default_payment_method_id(obj)
+            if pm_id != cached:
+                return {PM_FIELD: pm_id}
+    return None
+
+
+def event_customer_id(event_type: str, obj: Dict[str, Any], previous: Dict[str, Any]) -> Optional[str]:
+    """Customer a payment-method webhook is about (detached cards no longer carry it)."""
+    if event_type == "customer.updated":
+        return obj.get("id")
+    return obj.get("customer") or previous.get("customer")
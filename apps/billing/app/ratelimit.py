@@ -0,0 +1,162 @@
+"""
+Process-wide token bucket in front of Stripe, with priority lanes.
+
+Every Stripe attempt made through ``retry.with_retry`` takes one token.
+Callers are tagged with a lane via a contextvar:
+
+- ``interactive`` (default) — user-facing requests (resolve-url, topup, ...)
+- ``webhook``               — Stripe webhook processing
+- ``background``            — scheduled jobs and reconciliation
+
+Waiters are served strictly by lane priority, and lower lanes may not
+drain the bucket below a reserved floor, so a background burst can't make
+interactive requests wait behind it (or eat our account's 429 budget).
+
+The limit is per process: with N replicas, set STRIPE_RATE_LIMIT_RPS to
+roughly account_limit / N.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterator, Optional
+
+from .config import STRIPE_RATE_LIMIT_BURST, STRIPE_RATE_LIMIT_RPS
+
+LANES = ("interactive", "webhook", "background")  # highest priority first
+
+# Fraction of bucket capacity a lane must leave untouched for higher lanes
+_LANE_RESERVE = {"interactive": 0.0, "webhook": 0.1, "background": 0.3}
+
+_lane: contextvars.ContextVar[str] = contextvars.ContextVar("stripe_lane", default="interactive")
+
+
+def current_lane() -> str:
+    return _lane.get()
+
+
+@contextmanager
+def stripe_lane(lane: str) -> Iterator[None]:
+    """Tag Stripe calls made inside this block with a priority lane."""
+    if lane not in LANES:
+        raise ValueError(f"Unknown Stripe lane '{lane}'")
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+@dataclass
+class LaneStats:
+    acquired: int = 0
+    throttled: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+    def observe(self, waited: float) -> None:
+        self.acquired += 1
+        if waited > 0:
+            self.throttled += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(burst, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {lane: deque() for lane in LANES}
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.stats: Dict[str, LaneStats] = {lane: LaneStats() for lane in LANES}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _floor(self, lane: str) -> float:
+        # Never reserve so much that a lane could need more than a full bucket
+        return min(_LANE_RESERVE[lane] * self.capacity, self.capacity - 1)
+
+    def _queued_at_or_above(self, lane: str) -> bool:
+        for other in LANES:
+            if any(not f.done() for f in self._waiters[other]):
+                return True
+            if other == lane:
+                return False
+        return False
+
+    async def acquire(self, lane: Optional[str] = None) -> float:
+        """Take one token, waiting if needed. Returns seconds waited."""
+        lane = lane or current_lane()
+        if not self.enabled:
+            self.stats[lane].observe(0.0)
+            return 0.0
+        self._refill()
+        if not self._queued_at_or_above(lane) and self._tokens - 1 >= self._floor(lane):
+            self._tokens -= 1
+            self.stats[lane].observe(0.0)
+            return 0.0
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(fut)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        start = time.monotonic()
+        await fut
+        waited = time.monotonic() - start
+        self.stats[lane].observe(waited)
+        return waited
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._refill()
+            head_lane = None
+            for lane in LANES:
+                queue = self._waiters[lane]
+                while queue and queue[0].done():  # cancelled waiters
+                    queue.popleft()
+                if queue:
+                    head_lane = lane
+                    break
+            if head_lane is None:
+                return
+            needed = 1 + self._floor(head_lane) - self._tokens
+            if needed <= 0:
+                self._tokens -= 1
+                self._waiters[head_lane].popleft().set_result(None)
+                continue
+            await asyncio.sleep(needed / self.rate)
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "enabled": self.enabled,
+            "rate_per_second": self.rate,
+            "burst": self.capacity,
+            "tokens": round(self._tokens, 2),
+            "lanes": {
+                lane: {
+                    "queued": sum(1 for f in self._waiters[lane] if not f.done()),
+                    "acquired": s.acquired,
+                    "throttled": s.throttled,
+                    "wait_seconds": round(s.wait_seconds, 3),
+                    "max_wait_seconds": round(s.max_wait_seconds, 3),
+                }
+                for lane, s in self.stats.items()
+            },
+        }
+
+
+stripe_limiter = TokenBucket(STRIPE_RATE_LIMIT_RPS, STRIPE_RATE_LIMIT_BURST)
@@ -1,9 +1,19 @@
-"""Exponential backoff retry for async operations."""
+"""Exponential backoff retry for async operations.
+
+Calls to a known upstream (inferred from the label prefix) go through that
+upstream's circuit breaker and bulkhead, and every retry is paid for from the
+process-wide retry budget (see circuit.py). Server hints win over our own
+backoff: ``Stripe-Should-Retry`` decides whether to retry at all, and
+``Retry-After`` sets the minimum wait.
+"""
 from __future__ import annotations
 
 import asyncio
+import functools
 import random
-from typing import TypeVar, Callable, Any
+from typing import TypeVar, Callable, Any, Mapping, Optional
+
+from .bulkhead import Bulkhead, BulkheadFull
 
 T = TypeVar("T")
 
@@ -11,6 +21,10 @@ MAX_RETRIES = 3
 BASE_DELAY = 1.0  # seconds
 MAX_DELAY = 10.0
 
+# Upstreams recognised from the label prefix ("stripe list subs" → stripe,
+# "admin PATCH /admin/users/1" → admin)
+_UPSTREAMS = {"stripe", "admin", "db"}
+
 # Exceptions worth retrying (transient network / rate-limit errors)
 _RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
@@ -35,12 +49,123 @@ def _is_retryable(exc: Exception) -> bool:
     return False
 
 
+def _response_headers(exc: Exception) -> Mapping[str, str]:
+    """Response headers carried by an httpx or Stripe error, if any."""
+    response = getattr(exc, "response", None)
+    if response is not None and getattr(response, "headers", None) is not None:
+        return response.headers
+    return getattr(exc, "headers", None) or {}
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[str]:
+    lowered = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lowered:
+            return value
+    return None
+
+
+def _server_retry_hint(exc: Exception) -> tuple[Optional[bool], Optional[float]]:
+    """(should_retry, retry_after_seconds) from response headers; None = no hint."""
+    headers = _response_headers(exc)
+    should_retry = None
+    hint = _header(headers, "Stripe-Should-Retry")
+    if hint is not None:
+        should_retry = hint.strip().lower() == "true"
+    retry_after = None
+    raw = _header(headers, "Retry-After")
+    if raw is not None:
+        try:
+            retry_after = max(float(raw), 0.0)
+        except ValueError:
+            retry_after = None  # HTTP-date form — fall back to our own backoff
+    return should_retry, retry_after
+
+
+def _counts_against_upstream(exc: Exception) -> bool:
+    """Whether a failure says the upstream is unhealthy (vs. our request being bad)."""
+    import httpx
+    import stripe
+
+    if _is_retryable(exc):
+        return True
+    if isinstance(exc, (httpx.TransportError, stripe.error.APIConnectionError, asyncio.TimeoutError, OSError)):
+        return True
+    if isinstance(exc, stripe.error.APIError) and (getattr(exc, "http_status", None) or 500) >= 500:
+        return True
+    return False
+
+
+def _release_when_done(thread_call: asyncio.Future, release: Callable[[], None]) -> None:
+    """Free a bulkhead slot once an abandoned thread call actually finishes."""
+    def done(future: asyncio.Future) -> None:
+        release()
+        if not future.cancelled():
+            future.exception()  # nobody awaits it any more; don't log it as unretrieved
+
+    thread_call.add_done_callback(done)
+
+
+async def _invoke(
+    fn: Callable[..., Any], args: tuple, kwargs: dict, clip: bool, label: str, bulkhead: Optional[Bulkhead],
+) -> Any:
+    """Call ``fn`` once inside the upstream's bulkhead.
+
+    With ``clip``, stop waiting when the request deadline passes. A thread
+    can't be stopped, so a call we stop waiting for keeps its slot until the
+    thread returns; the slot count stays an honest bound on running calls
+    (and on the bulkhead's executor queue).
+    """
+    from . import deadline
+
+    if bulkhead is not None:
+        await bulkhead.acquire()
+    release = bulkhead.release if bulkhead is not None else None
+    try:
+        left = deadline.remaining() if clip else None
+        if asyncio.iscoroutinefunction(fn):
+            pending = fn(*args, **kwargs)
+        elif bulkhead is not None and bulkhead.executor is not None:
+            # Blocking SDK call on the dependency's own threads, off the loop
+            pending = bulkhead.submit(fn, *args, **kwargs)
+        elif left is not None:
+            pending = asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+        else:
+            result = fn(*args, **kwargs)
+            return await result if asyncio.iscoroutine(result) else result
+        if not isinstance(pending, asyncio.Future):
+            if left is None:
+                return await pending
+            try:
+                return await asyncio.wait_for(pending, timeout=max(left, 0.0))
+            except asyncio.TimeoutError:
+                raise deadline.DeadlineExceeded(f"Request deadline exceeded during {label or 'call'}") from None
+        try:
+            waiter = asyncio.shield(pending)
+            return await (waiter if left is None else asyncio.wait_for(waiter, timeout=max(left, 0.0)))
+        except asyncio.TimeoutError:
+            raise deadline.DeadlineExceeded(f"Request deadline exceeded during {label or 'call'}") from None
+        finally:
+            if release is not None and not pending.done():
+                _release_when_done(pending, release)
+                release = None
+    finally:
+        if release is not None:
+            release()
+
+
+def _upstream_for(label: str) -> Optional[str]:
+    prefix = label.split(" ", 1)[0].lower() if label else ""
+    return prefix if prefix in _UPSTREAMS else None
+
+
 async def with_retry(
     fn: Callable[..., Any],
     *args: Any,
     max_retries: int = MAX_RETRIES,
     base_delay: float = BASE_DELAY,
     label: str = "",
+    upstream: Optional[str] = None,
     **kwargs: Any,
 ) -> Any:
     """Call an async or sync function with exponential backoff.
@@ -50,21 +175,77 @@ async def with_retry(
         max_retries: Maximum number of retry attempts.
         base_delay: Initial delay in seconds (doubles each retry + jitter).
         label: Label for log messages.
+        upstream: Upstream name (default: inferred from label prefix).
+            Known upstreams go through their circuit breaker; "stripe"
+            attempts also take a token from the process-wide rate limiter.
+
+    Raises CircuitOpenError (without calling ``fn``) while the upstream's
+    breaker is open.
+
+    Under a request deadline (see deadline.py) no attempt starts after the
+    deadline, and a retry whose backoff would overrun it raises
+    DeadlineExceeded instead. Retry-safe calls (max_retries > 0) also have
+    each attempt's wait clipped to the remaining budget; single-shot writes
+    are never abandoned once started, so their outcome is always known.
     """
+    from . import deadline
+    from .bulkhead import bulkheads
+    from .circuit import OPEN, breakers, retry_budget
+
+    upstream = upstream or _upstream_for(label)
+    breaker = breakers.get(upstream) if upstream else None
+    bulkhead = bulkheads.get(upstream) if upstream else None
+    tag = f" [{label}]" if label else ""
+    retry_budget.record_call()
     last_exc = None
     for attempt in range(max_retries + 1):
+        deadline.check(label or "upstream call")
+        if breaker is not None:
+            breaker.before_call()
         try:
-            result = fn(*args, **kwargs)
-            if asyncio.iscoroutine(result):
-                result = await result
-            return result
+            if upstream == "stripe":
+                from .ratelimit import stripe_limiter
+                await stripe_limiter.acquire()
+            result = await _invoke(fn, args, kwargs, clip=max_retries > 0, label=label, bulkhead=bulkhead)
+        except (deadline.DeadlineExceeded, BulkheadFull):
+            if breaker is not None:
+                breaker.abandon()  # our budget / capacity ran out; says nothing about the upstream
+            raise
         except Exception as e:
             last_exc = e
-            if attempt < max_retries and _is_retryable(e):
-                delay = min(base_delay * (2 ** attempt) + random.uniform(0, 0.5), MAX_DELAY)
-                tag = f" [{label}]" if label else ""
-                print(f"[RETRY]{tag} Attempt {attempt + 1}/{max_retries + 1} failed: {e}. Retrying in {delay:.1f}s...")
-                await asyncio.sleep(delay)
-            else:
+            if breaker is not None:
+                if _counts_against_upstream(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            should_retry, retry_after = _server_retry_hint(e)
+            retryable = _is_retryable(e) if should_retry is None else should_retry
+            if attempt >= max_retries or not retryable:
+                raise
+            if breaker is not None and breaker.state == OPEN:
+                raise  # this failure tripped the breaker — don't wait to be refused
+            delay = min(base_delay * (2 ** attempt) + random.uniform(0, 0.5), MAX_DELAY)
+            if retry_after is not None:
+                if retry_after > MAX_DELAY:
+                    print(f"[RETRY]{tag} Server asked to wait {retry_after:.0f}s, giving up")
+                    raise
+                delay = max(delay, retry_after)
+            left = deadline.remaining()
+            if left is not None and delay >= left:
+                raise deadline.DeadlineExceeded(
+                    f"Request deadline exceeded: no time left to retry {label or 'call'} ({e})"
+                ) from e
+            if not retry_budget.try_spend():
+                print(f"[RETRY]{tag} Retry budget exhausted, not retrying: {e}")
                 raise
+            print(f"[RETRY]{tag} Attempt {attempt + 1}/{max_retries + 1} failed: {e}. Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            if breaker is not None:
+                breaker.abandon()  # cancelled mid-call: no verdict on upstream health
+            raise
+        if breaker is not None:
+            breaker.record_success()
+        return result
     raise last_exc  # unreachable, but satisfies type checker
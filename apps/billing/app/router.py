@@ -32,29 +32,29 @@ async def resolve_billing_url(req: ResolveUrlRequest) -> Dict[str, Any]:
 
     # 1. One-time products — checked first (bug fix #3: consultation never hits addon path)
     if plan in ONETIME:
-        return one_time_checkout(ctx, plan, req.quantity or 1)
+        return await one_time_checkout(ctx, plan, req.quantity or 1)
 
     # 2. Add-on products — always create checkout
     if plan in ADDON:
-        return addon_checkout(ctx, plan)
+        return await addon_checkout(ctx, plan)
 
     # 3. Bot plans — new, switch, or portal
     if plan in BOT_PLANS:
         if not ctx.bot_sub:
             return await new_checkout(ctx, plan)
         if ctx.bot_tier == plan:
-            return portal(ctx)
+            return await portal(ctx)
         if ctx.has_payment_method:
             return await switch(ctx, plan)
-        return switch_via_checkout(ctx, plan)
+        return await switch_via_checkout(ctx, plan)
 
     # 4. No plan specified — portal if subscribed, else pricing
     if ctx.bot_sub:
-        return portal(ctx)
+        return await portal(ctx)
     return {"url": f"{origin}/pricing"}
 
 
 @router.post("/v1/portal/session")
 async def create_portal_session(req: PortalRequest) -> Dict[str, Any]:
     ctx = await load(req.email, return_url=req.returnUrl)
-    return portal(ctx)
+    return await portal(ctx)
@@ -0,0 +1,313 @@
+"""
+Background job scheduler.
+
+Jobs register with either a fixed interval (seconds) or a 5-field cron
+expression (UTC), plus a maximum runtime and concurrency. Each run is
+launched as its own task, so a slow pass never pushes back the schedule:
+if the previous run is still going when the next one is due, that tick is
+skipped and counted instead of overlapping.
+
+Jobs that move money register with ``cancellable=False``: exceeding
+max_runtime is logged and counted as an overrun instead of cancelling the
+run mid-charge, and ``stop()`` waits for them to finish. Such jobs should
+check ``scheduler.stopping`` between units of work so shutdown stays quick.
+
+Tests (and operators, via /internal/jobs/{name}/run) can trigger a job
+deterministically with ``scheduler.run_now(name)``.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+JobFn = Callable[[], Awaitable[Any]]
+
+_HISTORY_SIZE = 20
+
+
+# ── Cron ─────────────────────────────────────────────────────────────────────
+
+def _parse_field(expr: str, lo: int, hi: int) -> Set[int]:
+    values: Set[int] = set()
+    for part in expr.split(","):
+        step = 1
+        if "/" in part:
+            part, step_s = part.split("/", 1)
+            step = int(step_s)
+        if part in ("*", ""):
+            start, end = lo, hi
+        elif "-" in part:
+            a, b = part.split("-", 1)
+            start, end = int(a), int(b)
+        else:
+            start = int(part)
+            end = hi if step > 1 else start
+        if start < lo or end > hi or start > end or step < 1:
+            raise ValueError(f"Cron field '{expr}' out of range {lo}-{hi}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSpec:
+    """Minimal cron: ``minute hour day-of-month month day-of-week`` (UTC).
+
+    Supports ``*``, numbers, lists, ranges and ``/step``. Day-of-week uses
+    0-6 with 0 = Sunday (7 is accepted as Sunday too).
+    """
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields, got '{expr}'")
+        self.expr = expr
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12)
+        self.weekdays = {d % 7 for d in _parse_field(fields[4], 0, 7)}
+        self._dom_any = fields[2] == "*"
+        self._dow_any = fields[4] == "*"
+
+    def _day_matches(self, dt: datetime) -> bool:
+        dom = dt.day in self.days
+        dow = (dt.weekday() + 1) % 7 in self.weekdays  # Python Monday=0 → cron Sunday=0
+        if self._dom_any or self._dow_any:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, dt: datetime) -> datetime:
+        """First matching minute strictly after ``dt``."""
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+                continue
+            if not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+                continue
+            if t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+                continue
+            return t
+        raise ValueError(f"Cron expression '{self.expr}' never fires")
+
+
+# ── Jobs ─────────────────────────────────────────────────────────────────────
+
+@dataclass
+class Job:
+    name: str
+    fn: JobFn
+    interval: Optional[float] = None
+    cron: Optional[CronSpec] = None
+    max_runtime: float = 300.0
+    max_concurrency: int = 1
+    jitter: float = 0.0
+    run_at_start: bool = True
+    cancellable: bool = True
+
+    running: int = 0
+    runs: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    overruns: int = 0
+    skipped_overlaps: int = 0
+    last_started: Optional[float] = None
+    last_duration: Optional[float] = None
+    last_outcome: Optional[str] = None
+    last_error: Optional[str] = None
+    next_run: Optional[float] = None
+    history: Deque[Dict[str, Any]] = field(default_factory=lambda: deque(maxlen=_HISTORY_SIZE))
+
+    def seconds_until_next(self, now: float) -> float:
+        """Wall-clock seconds until the next scheduled fire time."""
+        if self.cron is not None:
+            current = datetime.fromtimestamp(now, tz=timezone.utc)
+            return (self.cron.next_after(current) - current).total_seconds()
+        return float(self.interval or 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "schedule": self.cron.expr if self.cron else f"every {self.interval:g}s",
+            "max_runtime": self.max_runtime,
+            "max_concurrency": self.max_concurrency,
+            "cancellable": self.cancellable,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "overruns": self.overruns,
+            "skipped_overlaps": self.skipped_overlaps,
+            "last_started": self.last_started,
+            "last_duration": round(self.last_duration, 3) if self.last_duration is not None else None,
+            "last_outcome": self.last_outcome,
+            "last_error": self.last_error,
+            "next_run": self.next_run,
+            "history": list(self.history),
+        }
+
+
+class Scheduler:
+    def __init__(self) -> None:
+        self.jobs: Dict[str, Job] = {}
+        self._drivers: List[asyncio.Task] = []
+        self._runs: Dict[asyncio.Task, Job] = {}
+        self._stopping = False
+
+    def register(
+        self,
+        name: str,
+        fn: JobFn,
+        *,
+        interval: Optional[float] = None,
+        cron: Optional[str] = None,
+        max_runtime: float = 300.0,
+        max_concurrency: int = 1,
+        jitter: float = 0.0,
+        run_at_start: bool = True,
+        cancellable: bool = True,
+    ) -> Job:
+        if (interval is None) == (cron is None):
+            raise ValueError(f"Job '{name}' needs exactly one of interval or cron")
+        if name in self.jobs:
+            raise ValueError(f"Job '{name}' already registered")
+        job = Job(
+            name=name, fn=fn, interval=interval,
+            cron=CronSpec(cron) if cron else None,
+            max_runtime=max_runtime, max_concurrency=max_concurrency,
+            jitter=jitter, run_at_start=run_at_start and cron is None,
+            cancellable=cancellable,
+        )
+        self.jobs[name] = job
+        return job
+
+    @property
+    def started(self) -> bool:
+        return bool(self._drivers)
+
+    @property
+    def stopping(self) -> bool:
+        """True once stop() was called — long jobs should wind down."""
+        return self._stopping
+
+    def start(self) -> None:
+        """Launch one driver task per registered job (idempotent)."""
+        if self._drivers:
+            return
+        self._stopping = False
+        for job in self.jobs.values():
+            self._drivers.append(asyncio.create_task(self._drive(job), name=f"job-driver:{job.name}"))
+        print(f"[SCHEDULER] Started {len(self._drivers)} jobs: {', '.join(self.jobs)}")
+
+    async def stop(self) -> None:
+        """Stop scheduling; cancel cancellable runs and wait for the rest."""
+        self._stopping = True
+        for task in self._drivers:
+            task.cancel()
+        runs = dict(self._runs)
+        waiting = [job.name for task, job in runs.items() if not job.cancellable]
+        for task, job in runs.items():
+            if job.cancellable:
+                task.cancel()
+        if waiting:
+            print(f"[SCHEDULER] Waiting for {', '.join(waiting)} to finish before shutdown")
+        await asyncio.gather(*self._drivers, *runs, return_exceptions=True)
+        self._drivers.clear()
+        self._runs.clear()
+
+    async def run_now(self, name: str) -> str:
+        """Run a job immediately and wait for it. Returns the outcome."""
+        return await self._execute(self.jobs[name])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "jobs": {name: job.snapshot() for name, job in self.jobs.items()},
+        }
+
+    # ── internals ────────────────────────────────────────────────────────
+
+    async def _drive(self, job: Job) -> None:
+        if not job.run_at_start:
+            await self._sleep_until_next(job)
+        while True:
+            if job.running >= job.max_concurrency:
+                job.skipped_overlaps += 1
+                print(f"[SCHEDULER] {job.name}: previous run still active, skipping tick")
+            else:
+                task = asyncio.create_task(self._execute(job), name=f"job:{job.name}")
+                self._runs[task] = job
+                task.add_done_callback(lambda t: self._runs.pop(t, None))
+            await self._sleep_until_next(job)
+
+    async def _sleep_until_next(self, job: Job) -> None:
+        delay = job.seconds_until_next(time.time())
+        if job.jitter:
+            delay += random.uniform(0, job.jitter)
+        job.next_run = time.time() + delay
+        await asyncio.sleep(delay)
+
+    async def _execute(self, job: Job) -> str:
+        if job.running >= job.max_concurrency:
+            job.skipped_overlaps += 1
+            return "skipped"
+        job.running += 1
+        job.last_started = time.time()
+        start = time.perf_counter()
+        error: Optional[str] = None
+        overran = False
+        try:
+            if job.cancellable:
+                await asyncio.wait_for(job.fn(), timeout=job.max_runtime)
+            else:
+                overran = await self._run_to_completion(job)
+            outcome = "ok"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            job.timeouts += 1
+            error = f"exceeded max_runtime {job.max_runtime:g}s"
+        except Exception as e:
+            outcome = "error"
+            job.failures += 1
+            error = str(e)
+            print(f"[SCHEDULER] {job.name} failed: {e}\n{traceback.format_exc()}")
+        finally:
+            job.running -= 1
+        duration = time.perf_counter() - start
+        job.runs += 1
+        job.last_duration = duration
+        job.last_outcome = outcome
+        job.last_error = error
+        job.history.append({
+            "started": job.last_started,
+            "duration": round(duration, 3),
+            "outcome": outcome,
+            "error": error,
+            "overran": overran,
+        })
+        return outcome
+
+    async def _run_to_completion(self, job: Job) -> bool:
+        """Run a non-cancellable job; returns True if it overran max_runtime."""
+        task = asyncio.ensure_future(job.fn())
+        done, _ = await asyncio.wait({task}, timeout=job.max_runtime)
+        overran = not done
+        if overran:
+            job.overruns += 1
+            print(f"[SCHEDULER] {job.name} exceeded max_runtime {job.max_runtime:g}s — letting it finish")
+        # Shielded: even if this run is cancelled, the job itself keeps going
+        await asyncio.shield(task)
+        return overran
+
+
+scheduler = Scheduler()
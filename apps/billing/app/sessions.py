@@ -0,0 +1,94 @@
+"""
+Short-lived reuse of Stripe portal and checkout sessions.
+
+Every click on "Manage billing" or "Upgrade" used to create a new
+billing_portal.Session / checkout.Session. Stripe keeps those URLs valid far
+longer than a user takes to click twice, so the URL is cached per
+(customer, kind, plan, URLs) for SESSION_CACHE_TTL_SECONDS and concurrent
+clicks share one create call (see singleflight.py).
+
+Subscription webhooks and checkout completion drop a customer's entries:
+once their plan changes, the next click must route (and create) afresh.
+The cache is per process; on other replicas the TTL bounds staleness.
+"""
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from .config import SESSION_CACHE_TTL_SECONDS
+from .singleflight import flights
+
+_MAX_ENTRIES = 10000
+
+
+class SessionCache:
+    def __init__(self, ttl: float = SESSION_CACHE_TTL_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: Dict[Tuple[Hashable, ...], Tuple[float, str]] = {}
+        # Set on invalidation (from one increasing sequence) so a create that
+        # started before it is neither cached nor joined by later callers.
+        # LRU-bounded; an evicted customer reads the highest evicted value,
+        # which is still newer than anything captured before the eviction.
+        self._generations: "OrderedDict[str, int]" = OrderedDict()
+        self._generation_seq = 0
+        self._evicted_generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _prune(self) -> None:
+        now = self._clock()
+        for key in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        while len(self._entries) >= _MAX_ENTRIES:
+            del self._entries[next(iter(self._entries))]
+
+    def _generation(self, customer_id: str) -> int:
+        return self._generations.get(customer_id, self._evicted_generation)
+
+    async def get_or_create(
+        self, customer_id: str, kind: str, params: Tuple[Hashable, ...], create: Callable[[], Awaitable[str]],
+    ) -> str:
+        """Return a live session URL for this key, creating one if needed."""
+        key = (customer_id, kind, *params)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > self._clock():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        generation = self._generation(customer_id)
+        url = await flights.do("stripe_session", (key, generation), create)
+        if self._generation(customer_id) == generation:
+            self._prune()
+            self._entries[key] = (self._clock() + self.ttl, url)
+        return url
+
+    def invalidate(self, customer_id: str) -> None:
+        """Forget every cached session for a customer."""
+        self._generation_seq += 1
+        self._generations[customer_id] = self._generation_seq
+        self._generations.move_to_end(customer_id)
+        if len(self._generations) > _MAX_ENTRIES:
+            _, evicted = self._generations.popitem(last=False)
+            self._evicted_generation = max(self._evicted_generation, evicted)
+        for key in [k for k in self._entries if k[0] == customer_id]:
+            del self._entries[key]
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "ttl_seconds": self.ttl,
+            "entries": len(self._entries),
+            "invalidated_customers": len(self._generations),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+sessions = SessionCache()
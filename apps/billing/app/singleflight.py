@@ -0,0 +1,94 @@
+"""
+Single-flight coalescing of concurrent identical lookups.
+
+A dashboard page load fires balance, resolve-url and portal calls for the
+same email at once; without this each runs its own Customer.list /
+Subscription.list / user read. With ``flights.do(op, key, fn)`` the first
+caller (the leader) starts ``fn`` and concurrent callers with the same
+(op, key) await that same call. Nothing is cached: once the call finishes,
+the next caller starts a fresh one.
+
+The shared call runs as its own task, so a leader that gives up (client
+disconnect, deadline) doesn't fail the followers. Followers get a deep copy
+of the result so no caller can mutate another's view.
+"""
+from __future__ import annotations
+
+import asyncio
+import copy
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class FlightStats:
+    calls: int = 0
+    executions: int = 0
+    coalesced: int = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.coalesced / self.calls, 3) if self.calls else 0.0,
+        }
+
+
+def _consume_exception(task: asyncio.Task) -> None:
+    # Everyone may have stopped waiting; don't log "exception never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._inflight: Dict[Tuple[str, Hashable], asyncio.Task] = {}
+        self._stats: Dict[str, FlightStats] = {}
+
+    def _forget(self, key: Tuple[str, Hashable], task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def do(self, op: str, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run ``fn`` unless an identical (op, key) call is already in flight."""
+        stats = self._stats.setdefault(op, FlightStats())
+        stats.calls += 1
+        flight_key = (op, key)
+        task = self._inflight.get(flight_key)
+        if task is not None and not task.done():
+            stats.coalesced += 1
+            return copy.deepcopy(await asyncio.shield(task))
+
+        stats.executions += 1
+        task = asyncio.ensure_future(fn())
+        self._inflight[flight_key] = task
+        task.add_done_callback(lambda t: self._forget(flight_key, t))
+        task.add_done_callback(_consume_exception)
+        return await asyncio.shield(task)
+
+    def forget(self, op: str, key: Hashable) -> None:
+        """Detach an in-flight call so later callers start a fresh one.
+
+        Used after writes: a read that began before the write must not be
+        handed to callers who expect to see it. Current waiters still get
+        the detached call's result.
+        """
+        self._inflight.pop((op, key), None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = FlightStats()
+        for s in self._stats.values():
+            total.calls += s.calls
+            total.executions += s.executions
+            total.coalesced += s.coalesced
+        return {
+            "in_flight": len(self._inflight),
+            "total": total.snapshot(),
+            "operations": {op: s.snapshot() for op, s in sorted(self._stats.items())},
+        }
+
+
+flights = SingleFlight()
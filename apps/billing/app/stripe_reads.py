@@ -0,0 +1,62 @@
+"""
+Consolidated Stripe reads.
+
+Paths that need an object together with its related objects fetch the whole
+graph in one request with ``expand=`` instead of one call per object:
+
+- customer + default payment method / source      (manual top-up)
+- customer + its subscriptions                    (bot-balance fallback)
+- cancelled subscription + its final invoice      (plan switch)
+
+Usage record summaries are a sub-resource of the subscription item and
+can't be expanded; they still cost one call per item.
+"""
+from __future__ import annotations
+
+from typing import Any, Optional
+
+import stripe
+
+from . import memo
+from .retry import with_retry
+
+
+def _object_id(value: Any) -> Optional[str]:
+    """ID of a field that may be an expanded object or a bare ID."""
+    if not value:
+        return None
+    if isinstance(value, str):
+        return value
+    return value.get("id")
+
+
+async def customer_with_payment_method(customer_id: str) -> Any:
+    """Customer with its default payment method and source expanded (one call).
+
+    Shares the request memo entry with memo.retrieve_customer, which always
+    expands the same fields.
+    """
+    return await memo.retrieve_customer(customer_id)
+
+
+def default_payment_method_id(customer: Any) -> Optional[str]:
+    """The customer's default payment method, else its default source."""
+    pm_id = _object_id((customer.get("invoice_settings") or {}).get("default_payment_method"))
+    return pm_id or _object_id(customer.get("default_source"))
+
+
+async def customer_with_subscriptions(email: str) -> Optional[Any]:
+    """First customer for an email with its (non-cancelled) subscriptions expanded."""
+    customers = await with_retry(
+        stripe.Customer.list, email=email, limit=1, expand=["data.subscriptions"],
+        label="stripe list customers",
+    )
+    return customers.data[0] if customers.data else None
+
+
+async def cancel_subscription(subscription_id: str, **params: Any) -> Any:
+    """Cancel a subscription and get its final invoice back in the same call."""
+    return await with_retry(
+        stripe.Subscription.cancel, subscription_id, expand=["latest_invoice"], **params,
+        label="stripe cancel sub",
+    )
@@ -1,17 +1,123 @@
 from __future__ import annotations
 
 import asyncio
-import time
-from typing import Any, Dict
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 import stripe
 from fastapi import APIRouter
 
-from .config import DATABASE_URL, ADMIN_API_URL, ADMIN_API_TOKEN
-from .db import get_session, merge_user_data_by_id
+from .config import DATABASE_URL, ADMIN_API_URL, ADMIN_API_TOKEN, TOPUP_CONFIRMATION_MODE
+from .db import (
+    get_session, increment_user_data, mark_users_dirty, merge_user_data_bulk, open_topup_users, register_query,
+    run_query, schema_ready,
+)
+from .ratelimit import stripe_lane
+from .retry import with_retry
+from .scheduler import scheduler
+from .topups import record_topup, submit_topup, sweep_pending_topups
 
 router = APIRouter()
 
+# Max dirty users claimed per enforcement pass
+ENFORCEMENT_DIRTY_BATCH = 5000
+
+
+# ── Queries ──────────────────────────────────────────────────────────────────
+
+_Q_BOT_TOPUP = register_query("auto_topup_bot_candidates", """
+    SELECT id, email, data, max_concurrent_bots FROM public.users
+    WHERE (data->>'bot_topup_enabled')::boolean = true
+      AND (COALESCE((data->>'bot_balance_cents')::numeric, 0))
+          < (COALESCE((data->>'bot_topup_threshold_cents')::numeric, 100))
+      AND data->>'stripe_customer_id' IS NOT NULL
+      AND data->>'stripe_payment_method_id' IS NOT NULL
+""")
+
+_Q_TX_TOPUP = register_query("auto_topup_tx_candidates", """
+    SELECT id, email, data FROM public.users
+    WHERE (data->>'tx_topup_enabled')::boolean = true
+      AND (COALESCE((data->>'tx_balance_minutes')::numeric, 0))
+          < (COALESCE((data->>'tx_topup_threshold_min')::numeric, 60))
+      AND data->>'stripe_customer_id' IS NOT NULL
+      AND data->>'stripe_payment_method_id' IS NOT NULL
+""")
+
+# Users whose bots should be blocked: balance exhausted, no auto-topup,
+# no active subscription.
+_EXHAUSTED_PREDICATE = """
+      (data->>'bot_topup_enabled')::boolean IS NOT true
+      AND COALESCE((data->>'bot_balance_cents')::numeric, 0) <= 0
+      AND max_concurrent_bots > 0
+      AND (data->>'subscription_status') IS DISTINCT FROM 'active'
+"""
+
+_Q_ENFORCE = register_query("enforce_exhausted_candidates", f"""
+    SELECT id, email, data, max_concurrent_bots FROM public.users
+    WHERE {_EXHAUSTED_PREDICATE}
+""")
+
+# Claims (deletes) a batch of dirty users and returns those that now match
+# the predicate. Rows marked again while we work are simply re-inserted.
+_Q_ENFORCE_DIRTY = register_query("enforce_dirty_candidates", f"""
+    WITH claimed AS (
+        DELETE FROM public.billing_dirty_users
+        WHERE user_id IN (
+            SELECT user_id FROM public.billing_dirty_users
+            ORDER BY marked_at
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING user_id
+    )
+    SELECT u.id, u.email, u.data, u.max_concurrent_bots
+    FROM public.users u JOIN claimed c ON c.user_id = u.id
+    WHERE {_EXHAUSTED_PREDICATE}
+""")
+
+_Q_USAGE_RECONCILE = register_query("usage_reconcile_candidates", """
+    SELECT id, email,
+           data->>'stripe_customer_id' AS customer_id,
+           data->>'stripe_subscription_id' AS subscription_id,
+           data->'subscription_item_ids' AS item_ids
+    FROM public.users
+    WHERE data->>'subscription_tier' = 'bot_service'
+      AND data->>'subscription_status' IN ('active', 'past_due', 'scheduled_to_cancel')
+      AND data->>'stripe_subscription_id' IS NOT NULL
+""")
+
+# Job leases: only one process — API or worker replica — runs a given job
+# at a time. Each statement commits on its own, so a running job doesn't pin
+# a pooled connection; the holder renews the lease until the job finishes.
+_Q_JOB_LEASE_ACQUIRE = register_query("job_lease_acquire", """
+    INSERT INTO public.billing_job_leases AS l (name, holder, expires_at)
+    VALUES (:name, :holder, now() + make_interval(secs => CAST(:lease AS float8)))
+    ON CONFLICT (name) DO UPDATE
+        SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at
+        WHERE l.expires_at < now()
+    RETURNING name
+""")
+
+_Q_JOB_LEASE_RENEW = register_query("job_lease_renew", """
+    UPDATE public.billing_job_leases
+    SET expires_at = now() + make_interval(secs => CAST(:lease AS float8))
+    WHERE name = :name AND holder = :holder
+    RETURNING name
+""")
+
+_Q_JOB_LEASE_RELEASE = register_query("job_lease_release", """
+    DELETE FROM public.billing_job_leases WHERE name = :name AND holder = :holder
+""")
+
+_Q_MONTHLY_RESET = register_query("monthly_spend_reset", """
+    UPDATE public.users
+    SET data = data || '{"bot_monthly_spent_cents": 0}'::jsonb
+    WHERE (data->>'bot_monthly_spent_cents')::numeric > 0
+""")
+
 
 # ── Admin API helper ─────────────────────────────────────────────────────────
 
@@ -32,143 +138,371 @@ async def _patch_max_bots(user_id: int, max_bots: int) -> bool:
         return False
 
 
-# ── Background auto-topup + enforcement loop ────────────────────────────────
+# ── Auto-topup ───────────────────────────────────────────────────────────────
+
+def _bot_topup_amount(row: Dict[str, Any]) -> Optional[int]:
+    """Top-up amount for a bot candidate, or None if it would exceed the monthly cap."""
+    data = row["data"] or {}
+    cap = data.get("bot_monthly_cap_cents")
+    spent = data.get("bot_monthly_spent_cents", 0) or 0
+    amount = int(data.get("bot_topup_amount_cents", 500) or 500)
+    if cap and (spent + amount) > cap:
+        print(f"[AUTO-TOPUP] Skipping {row['email']} — would exceed monthly cap ({spent}+{amount} > {cap})")
+        return None
+    return amount
+
+
+async def restore_bots_after_topup(row: Dict[str, Any]) -> None:
+    """Restore max_bots zeroed by enforcement once the balance is topped up."""
+    if row.get("max_concurrent_bots", 0) != 0:
+        return
+    tier = (row.get("data") or {}).get("subscription_tier")
+    restore_to = 1 if tier in ("individual", "bot_service") else 0
+    if restore_to > 0:
+        await _patch_max_bots(row["id"], restore_to)
+        print(f"[AUTO-TOPUP] Restored max_bots={restore_to} for {row['email']}")
 
-async def _auto_topup_loop():
-    """Every 60s: auto-topup low balances, enforce max_bots when broke."""
+
+async def _queue_auto_topups(bot_rows: List[Dict[str, Any]], tx_rows: List[Dict[str, Any]]) -> None:
+    """Webhook confirmation mode: record and submit pending top-ups.
+
+    Users with a top-up still awaiting confirmation are skipped, so a slow
+    webhook never leads to a second charge on the next tick.
+    """
+    open_topups = await open_topup_users()
+    candidates = [("bot", row, _bot_topup_amount(row)) for row in bot_rows]
+    candidates += [("tx", row, int((row["data"] or {}).get("tx_topup_amount_cents", 500) or 500)) for row in tx_rows]
+    for product, row, amount in candidates:
+        if scheduler.stopping:
+            print("[AUTO-TOPUP] Shutdown requested — stopping before the next charge")
+            return
+        if amount is None or (row["id"], product) in open_topups:
+            continue
+        data = row["data"] or {}
+        pending = await record_topup(
+            user_id=row["id"], email=row["email"], product=product, amount_cents=amount, source="auto",
+            customer_id=data["stripe_customer_id"], payment_method_id=data["stripe_payment_method_id"],
+        )
+        status = await submit_topup(pending)
+        print(f"[AUTO-TOPUP] Submitted {product} top-up {amount}c for {row['email']} ({status or 'pending retry'})")
+
+
+async def auto_topup_pass() -> None:
+    """Charge saved cards for users whose bot/TX balance fell below threshold."""
     if not DATABASE_URL:
         return
 
-    while True:
+    async with get_session() as db:
+        bot_rows = await run_query(db, _Q_BOT_TOPUP)
+        tx_rows = await run_query(db, _Q_TX_TOPUP)
+
+    if TOPUP_CONFIRMATION_MODE == "webhook":
+        await _queue_auto_topups(bot_rows, tx_rows)
+        return
+
+    # Each user is credited in its own transaction right after their charge
+    # succeeds, so an interrupted pass never leaves a charged user uncredited
+    # (and re-charged on the next tick).
+
+    # ── 1. Bot auto-topup ────────────────────────────────────────────────
+    for row in bot_rows:
+        if scheduler.stopping:
+            print("[AUTO-TOPUP] Shutdown requested — stopping before the next charge")
+            return
+        data = row["data"] or {}
+        amount = _bot_topup_amount(row)
+        if amount is None:
+            continue
         try:
-            from sqlalchemy import text
-            async with get_session() as db:
-                # ── 1. Bot auto-topup ────────────────────────────────────
-                result = await db.execute(text("""
-                    SELECT id, email, data, max_concurrent_bots FROM public.users
-                    WHERE (data->>'bot_topup_enabled')::boolean = true
-                      AND (COALESCE((data->>'bot_balance_cents')::numeric, 0))
-                          < (COALESCE((data->>'bot_topup_threshold_cents')::numeric, 100))
-                      AND data->>'stripe_customer_id' IS NOT NULL
-                      AND data->>'stripe_payment_method_id' IS NOT NULL
-                """))
-                for row in result.mappings().all():
-                    data = row["data"] or {}
-                    # Check monthly spending cap
-                    cap = data.get("bot_monthly_cap_cents")
-                    spent = data.get("bot_monthly_spent_cents", 0) or 0
-                    amount = int(data.get("bot_topup_amount_cents", 500) or 500)
-                    if cap and (spent + amount) > cap:
-                        print(f"[AUTO-TOPUP] Skipping {row['email']} — would exceed monthly cap ({spent}+{amount} > {cap})")
-                        continue
-                    try:
-                        stripe.PaymentIntent.create(
-                            amount=amount,
-                            currency="usd",
-                            customer=data["stripe_customer_id"],
-                            payment_method=data["stripe_payment_method_id"],
-                            off_session=True,
-                            confirm=True,
-                            description="Bot balance auto top-up",
-                        )
-                        current = data.get("bot_balance_cents", 0) or 0
-                        new_balance = current + amount
-                        patch: Dict[str, Any] = {
-                            "bot_balance_cents": new_balance,
-                            "bot_monthly_spent_cents": spent + amount,
-                        }
-                        await merge_user_data_by_id(row["id"], patch)
-                        # Restore max_bots if it was zeroed
-                        if row.get("max_concurrent_bots", 0) == 0:
-                            tier = data.get("subscription_tier")
-                            restore_to = 1 if tier in ("individual", "bot_service") else 0
-                            if restore_to > 0:
-                                await _patch_max_bots(row["id"], restore_to)
-                                print(f"[AUTO-TOPUP] Restored max_bots={restore_to} for {row['email']}")
-                        print(f"[AUTO-TOPUP] Charged {amount}c for {row['email']}, new balance={new_balance}c")
-                    except Exception as e:
-                        print(f"[AUTO-TOPUP] Failed for {row['email']}: {e}")
-
-                # ── 2. TX auto-topup ─────────────────────────────────────
-                result2 = await db.execute(text("""
-                    SELECT id, email, data FROM public.users
-                    WHERE (data->>'tx_topup_enabled')::boolean = true
-                      AND (COALESCE((data->>'tx_balance_minutes')::numeric, 0))
-                          < (COALESCE((data->>'tx_topup_threshold_min')::numeric, 60))
-                      AND data->>'stripe_customer_id' IS NOT NULL
-                      AND data->>'stripe_payment_method_id' IS NOT NULL
-                """))
-                for row in result2.mappings().all():
-                    data = row["data"] or {}
-                    amount_cents = int(data.get("tx_topup_amount_cents", 500) or 500)
-                    try:
-                        stripe.PaymentIntent.create(
-                            amount=amount_cents,
-                            currency="usd",
-                            customer=data["stripe_customer_id"],
-                            payment_method=data["stripe_payment_method_id"],
-                            off_session=True,
-                            confirm=True,
-                            description="Transcription balance auto top-up",
-                        )
-                        current = data.get("tx_balance_minutes", 0) or 0
-                        minutes_per_cent = 1 / 0.2  # $0.002/min = 0.2 cents/min → 5 min/cent
-                        new_balance = current + (amount_cents * minutes_per_cent)
-                        await merge_user_data_by_id(row["id"], {"tx_balance_minutes": new_balance})
-                        print(f"[AUTO-TOPUP] TX charged {amount_cents}c for {row['email']}, new balance={new_balance:.0f}min")
-                    except Exception as e:
-                        print(f"[AUTO-TOPUP] TX failed for {row['email']}: {e}")
-
-                # ── 3. Enforce: zero max_bots when bot balance exhausted ─
-                # For users with no subscription and no auto-topup, block bots
-                result3 = await db.execute(text("""
-                    SELECT id, email, data, max_concurrent_bots FROM public.users
-                    WHERE (data->>'bot_topup_enabled')::boolean IS NOT true
-                      AND COALESCE((data->>'bot_balance_cents')::numeric, 0) <= 0
-                      AND max_concurrent_bots > 0
-                      AND (data->>'subscription_status') IS DISTINCT FROM 'active'
-                """))
-                for row in result3.mappings().all():
-                    await _patch_max_bots(row["id"], 0)
-                    print(f"[ENFORCE] Set max_bots=0 for {row['email']} — balance exhausted, no auto-topup, no active subscription")
+            await with_retry(
+                stripe.PaymentIntent.create,
+                amount=amount,
+                currency="usd",
+                customer=data["stripe_customer_id"],
+                payment_method=data["stripe_payment_method_id"],
+                off_session=True,
+                confirm=True,
+                description="Bot balance auto top-up",
+                max_retries=0,  # a charge is not safe to blindly retry
+                label="stripe auto-topup charge",
+            )
+        except Exception as e:
+            print(f"[AUTO-TOPUP] Failed for {row['email']}: {e}")
+            continue
+        # Increments, not absolutes: a deduction since the candidate query isn't overwritten
+        updated = await increment_user_data(row["id"], {
+            "bot_balance_cents": amount,
+            "bot_monthly_spent_cents": amount,
+        })
+        new_balance = ((updated or {}).get("data") or {}).get("bot_balance_cents")
+        print(f"[AUTO-TOPUP] Charged {amount}c for {row['email']}, new balance={new_balance}c")
+        await restore_bots_after_topup(row)
 
+    # ── 2. TX auto-topup ─────────────────────────────────────────────────
+    for row in tx_rows:
+        if scheduler.stopping:
+            print("[AUTO-TOPUP] Shutdown requested — stopping before the next charge")
+            return
+        data = row["data"] or {}
+        amount_cents = int(data.get("tx_topup_amount_cents", 500) or 500)
+        try:
+            await with_retry(
+                stripe.PaymentIntent.create,
+                amount=amount_cents,
+                currency="usd",
+                customer=data["stripe_customer_id"],
+                payment_method=data["stripe_payment_method_id"],
+                off_session=True,
+                confirm=True,
+                description="Transcription balance auto top-up",
+                max_retries=0,
+                label="stripe auto-topup charge",
+            )
         except Exception as e:
-            print(f"[AUTO-TOPUP] Loop error: {e}")
+            print(f"[AUTO-TOPUP] TX failed for {row['email']}: {e}")
+            continue
+        minutes_per_cent = 1 / 0.2  # $0.002/min = 0.2 cents/min → 5 min/cent
+        updated = await increment_user_data(row["id"], {"tx_balance_minutes": amount_cents * minutes_per_cent})
+        new_balance = ((updated or {}).get("data") or {}).get("tx_balance_minutes", 0)
+        print(f"[AUTO-TOPUP] TX charged {amount_cents}c for {row['email']}, new balance={float(new_balance):.0f}min")
 
-        await asyncio.sleep(60)
 
+# ── Enforcement ──────────────────────────────────────────────────────────────
 
-# ── Monthly spending reset (runs daily) ──────────────────────────────────────
+async def enforce_pass(full_sweep: bool = False) -> None:
+    """Zero max_bots for users with no balance, no auto-topup and no active sub.
 
-async def _monthly_reset_loop():
-    """At the start of each month, reset bot_monthly_spent_cents to 0."""
+    Normally only users whose inputs changed (dirty set) are re-evaluated;
+    the full sweep is the consistency backstop.
+    """
     if not DATABASE_URL:
         return
-    last_reset_month = time.gmtime().tm_mon
+    if not full_sweep and not schema_ready():
+        return  # no dirty set yet — the full sweep still runs
 
-    while True:
-        current_month = time.gmtime().tm_mon
-        if current_month != last_reset_month:
+    async with get_session() as db:
+        if full_sweep:
+            exhausted_rows = await run_query(db, _Q_ENFORCE)
+        else:
+            exhausted_rows = await run_query(db, _Q_ENFORCE_DIRTY, {"limit": ENFORCEMENT_DIRTY_BATCH})
+            await db.commit()
+    failed: List[int] = []
+    for row in exhausted_rows:
+        if await _patch_max_bots(row["id"], 0):
+            print(f"[ENFORCE] Set max_bots=0 for {row['email']} — balance exhausted, no auto-topup, no active subscription")
+        else:
+            failed.append(row["id"])
+    if failed and not full_sweep:
+        await mark_users_dirty(failed)  # retry next pass
+
+
+async def enforce_full_sweep() -> None:
+    await enforce_pass(full_sweep=True)
+
+
+# ── Balance journal recovery ─────────────────────────────────────────────────
+
+async def recover_balance_journal() -> None:
+    """Apply write-behind debits left in the journal by a process that died."""
+    if not DATABASE_URL or not schema_ready():
+        return
+    from .db import apply_balance_journal
+    rows = await apply_balance_journal([])
+    if rows:
+        print(f"[JOURNAL] Applied orphaned balance debits for {len(rows)} users")
+
+
+# ── Retention ────────────────────────────────────────────────────────────────
+
+async def prune_processed_meetings() -> None:
+    """Forget billed meetings old enough that bot-manager no longer retries them."""
+    if not DATABASE_URL or not schema_ready():
+        return
+    from .db import prune_processed_meetings as prune
+    deleted = await prune()
+    if deleted:
+        print(f"[HOOKS] Pruned {deleted} processed meetings")
+
+
+async def prune_idempotency_keys() -> None:
+    """Delete stored Idempotency-Key responses past their TTL."""
+    if not DATABASE_URL or not schema_ready():
+        return
+    from .db import prune_idempotency_keys as prune
+    deleted = await prune()
+    if deleted:
+        print(f"[IDEMPOTENCY] Pruned {deleted} expired keys")
+
+
+# ── Usage reconciliation ─────────────────────────────────────────────────────
+
+async def _backfill_subscription_items(row: Dict[str, Any], backfills: Dict[int, Dict[str, Any]]) -> List[str]:
+    """Item IDs for a subscriber whose row predates them; queues the patch storing them."""
+    try:
+        sub = await with_retry(stripe.Subscription.retrieve, row["subscription_id"], label="stripe retrieve sub")
+    except Exception as e:
+        print(f"[USAGE-RECONCILE] Could not backfill items for {row['email']}: {e}")
+        return []
+    item_ids = [item["id"] for item in (sub.get("items") or {}).get("data") or [] if item.get("id")]
+    backfills[row["id"]] = {
+        "subscription_item_ids": item_ids,
+        "subscription_current_period_start": sub.get("current_period_start"),
+    }
+    return item_ids
+
+
+async def reconcile_usage_totals() -> None:
+    """Overwrite local usage totals with Stripe's current-period summaries.
+
+    The bot-balance endpoint reads the local totals; this job bounds how
+    far they can drift (failed local writes, usage reported elsewhere) and
+    seeds them for subscribers whose rows predate stored item IDs.
+    """
+    if not DATABASE_URL or not schema_ready():
+        return
+    from .db import set_usage_total
+
+    async with get_session() as db:
+        rows = await run_query(db, _Q_USAGE_RECONCILE)
+    checked = drifted = 0
+    backfills: Dict[int, Dict[str, Any]] = {}
+    for row in rows:
+        item_ids = row["item_ids"]
+        if not isinstance(item_ids, list):
+            item_ids = await _backfill_subscription_items(row, backfills)
+        for item_id in item_ids:
             try:
-                from sqlalchemy import text
-                async with get_session() as db:
-                    await db.execute(text("""
-                        UPDATE public.users
-                        SET data = data || '{"bot_monthly_spent_cents": 0}'::jsonb
-                        WHERE (data->>'bot_monthly_spent_cents')::numeric > 0
-                    """))
-                    await db.commit()
-                    print(f"[MONTHLY-RESET] Reset bot_monthly_spent_cents for all users")
+                summaries = await with_retry(
+                    stripe.SubscriptionItem.list_usage_record_summaries, item_id, limit=1,
+                    label="stripe usage summaries",
+                )
             except Exception as e:
-                print(f"[MONTHLY-RESET] Error: {e}")
-            last_reset_month = current_month
+                print(f"[USAGE-RECONCILE] Failed to read usage for {item_id}: {e}")
+                continue
+            if not summaries.data:
+                continue
+            summary = summaries.data[0]
+            total = int(summary["total_usage"] or 0)
+            previous = await set_usage_total(
+                item_id, int(summary["period"]["start"]), row["subscription_id"], row["customer_id"], total,
+            )
+            checked += 1
+            if (previous or 0) != total:
+                drifted += 1
+                print(f"[USAGE-RECONCILE] {row['email']} {item_id}: local {previous} → Stripe {total}")
+    if backfills:
+        # One statement per chunk instead of a round trip per subscriber
+        updated = await merge_user_data_bulk(backfills)
+        print(f"[USAGE-RECONCILE] Backfilled subscription items for {len(updated)} users")
+    print(f"[USAGE-RECONCILE] Checked {checked} items, corrected {drifted}")
+
+
+# ── Monthly spending reset ───────────────────────────────────────────────────
+
+async def monthly_reset() -> None:
+    """Reset bot_monthly_spent_cents to 0 (scheduled for the 1st, 00:00 UTC)."""
+    if not DATABASE_URL:
+        return
+    async with get_session() as db:
+        await run_query(db, _Q_MONTHLY_RESET)
+        await db.commit()
+    print("[MONTHLY-RESET] Reset bot_monthly_spent_cents for all users")
+
+
+# ── Registration ─────────────────────────────────────────────────────────────
+
+# Job leases outlive a crashed holder by at most this long
+JOB_LEASE_SECONDS = 60.0
+_HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _job_setting(name: str, key: str, default: Any) -> Any:
+    """Per-job override from env, e.g. JOB_AUTO_TOPUP_INTERVAL=30."""
+    raw = os.getenv(f"JOB_{name.upper()}_{key}")
+    if raw is None:
+        return default
+    return type(default)(raw)
+
 
-        await asyncio.sleep(3600)  # check hourly
+async def _lease_query(query: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    async with get_session() as db:
+        rows = await run_query(db, query, params)
+        await db.commit()
+    return rows
+
+
+async def _renew_lease(params: Dict[str, Any]) -> None:
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            if not await _lease_query(_Q_JOB_LEASE_RENEW, params):
+                print(f"[TASKS] {params['name']}: job lease was taken over")
+        except Exception as e:
+            print(f"[TASKS] {params['name']}: could not renew job lease: {e}")
+
+
+@asynccontextmanager
+async def _job_lock(name: str) -> AsyncIterator[bool]:
+    """Yield True if this process won the cross-process lease for ``name``."""
+    if not DATABASE_URL:
+        yield True
+        return
+    if not schema_ready():
+        # Without the lease table replicas can't coordinate; don't risk a double run
+        print(f"[TASKS] {name}: billing schema not ready, cannot take the job lease")
+        yield False
+        return
+    params = {"name": name, "holder": f"{_HOLDER}:{uuid.uuid4().hex[:8]}", "lease": JOB_LEASE_SECONDS}
+    if not await _lease_query(_Q_JOB_LEASE_ACQUIRE, params):
+        yield False
+        return
+    renewer = asyncio.create_task(_renew_lease(params))
+    try:
+        yield True
+    finally:
+        renewer.cancel()
+        try:
+            await _lease_query(_Q_JOB_LEASE_RELEASE, params)
+        except Exception as e:
+            # Lapses after JOB_LEASE_SECONDS; the next run takes it over then
+            print(f"[TASKS] {name}: could not release job lease: {e}")
+
+
+def _register(name: str, fn, cancellable: bool = True, **defaults: Any) -> None:
+    settings = {key: _job_setting(name, key.upper(), value) for key, value in defaults.items()}
+
+    async def run_in_background_lane() -> None:
+        async with _job_lock(name) as locked:
+            if not locked:
+                print(f"[TASKS] {name}: another process holds the job lease, skipping this run")
+                return
+            # Jobs yield Stripe capacity to interactive traffic
+            with stripe_lane("background"):
+                await fn()
+
+    scheduler.register(name, run_in_background_lane, cancellable=cancellable, **settings)
+
+
+# auto_topup charges cards: never cancel it between a charge and its credit
+_register("auto_topup", auto_topup_pass, cancellable=False, interval=60.0, max_runtime=300.0, jitter=5.0)
+_register("enforce_dirty", enforce_pass, interval=60.0, max_runtime=120.0, jitter=5.0)
+_register("enforce_full_sweep", enforce_full_sweep, interval=3600.0, max_runtime=900.0)
+_register("topup_sweep", sweep_pending_topups, cancellable=False, interval=300.0, max_runtime=240.0, jitter=10.0)
+_register("balance_journal_recover", recover_balance_journal, interval=60.0, max_runtime=60.0, jitter=5.0)
+_register("processed_meetings_prune", prune_processed_meetings, interval=86400.0, max_runtime=600.0, jitter=300.0)
+_register("idempotency_prune", prune_idempotency_keys, interval=3600.0, max_runtime=300.0, jitter=60.0)
+_register("usage_reconcile", reconcile_usage_totals, interval=3600.0, max_runtime=900.0, jitter=60.0)
+_register("monthly_reset", monthly_reset, cron="0 0 1 * *", max_runtime=600.0)
 
 
 def start_background_tasks():
-    """Called from main.py startup to launch background loops."""
+    """Called from main.py startup to launch the job scheduler."""
     if DATABASE_URL:
-        asyncio.create_task(_auto_topup_loop())
-        asyncio.create_task(_monthly_reset_loop())
-        print("[TASKS] Background tasks started (auto-topup + monthly reset)")
+        scheduler.start()
+        print(f"[TASKS] Background jobs started ({', '.join(scheduler.jobs)})")
+
+
+async def stop_background_tasks():
+    """Stop jobs on shutdown (waits for in-flight auto-topup charges)."""
+    if scheduler.started:
+        await scheduler.stop()
@@ -0,0 +1,161 @@
+"""
+Pending top-ups confirmed by payment_intent webhooks.
+
+With TOPUP_CONFIRMATION_MODE=webhook an off-session top-up is:
+
+1. recorded in billing_pending_topups; its key is also the Stripe
+   idempotency key, so submitting it again can never charge twice
+2. submitted as a PaymentIntent off the request path
+3. credited exactly once when it settles: from the create response if the
+   charge already succeeded, otherwise from payment_intent.succeeded /
+   payment_intent.payment_failed, otherwise by the sweeper — whichever
+   comes first wins the claim in settle_pending_topup
+
+Manual top-ups return right after step 1. The auto-topup job submits
+without holding a DB session and skips users with a top-up still pending.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import uuid
+from typing import Any, Dict, Optional, Set
+
+import stripe
+
+from . import db
+from .config import TOPUP_SWEEP_AFTER_SECONDS
+from .retry import with_retry
+
+MINUTES_PER_CENT = 5  # $0.002/min = 0.2 cents/min
+
+# Stripe keeps idempotency keys for 24h; never re-submit a key near that age
+_RESUBMIT_WINDOW_SECONDS = 23 * 3600
+_FAILED_STATUSES = ("requires_payment_method", "canceled")
+
+_background: Set[asyncio.Task] = set()
+
+
+def credit_increments(row: Dict[str, Any]) -> Dict[str, float]:
+    """Balance increments for a settled top-up row."""
+    amount = row["amount_cents"]
+    if row["product"] == "bot":
+        increments: Dict[str, float] = {"bot_balance_cents": amount}
+        if row["source"] == "auto":
+            increments["bot_monthly_spent_cents"] = amount
+        return increments
+    return {"tx_balance_minutes": amount * MINUTES_PER_CENT}
+
+
+async def record_topup(
+    *, user_id: int, email: str, product: str, amount_cents: int, source: str,
+    customer_id: str, payment_method_id: str,
+) -> Dict[str, Any]:
+    key = f"topup-{source}-{uuid.uuid4().hex}"
+    return await db.create_pending_topup(
+        key, user_id, email, product, amount_cents, source, customer_id, payment_method_id,
+    )
+
+
+async def settle_topup(
+    key: str, succeeded: bool, payment_intent_id: Optional[str] = None, error: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """Credit (or fail) a pending top-up; None if it was already settled."""
+    row = await db.settle_pending_topup(
+        key, "succeeded" if succeeded else "failed",
+        credit_for=credit_increments if succeeded else None,
+        payment_intent_id=payment_intent_id, error=error,
+    )
+    if row is None:
+        return None
+    if not succeeded:
+        print(f"[TOPUP] {row['product']} top-up {key} for {row['email']} failed: {error}")
+        return row
+    print(f"[TOPUP] Credited {row['product']} top-up {key} ({row['amount_cents']}c) for {row['email']}")
+    user = row.get("user")
+    if user and row["source"] == "auto" and row["product"] == "bot":
+        from .tasks import restore_bots_after_topup
+        await restore_bots_after_topup(user)
+    return row
+
+
+async def submit_topup(row: Dict[str, Any]) -> Optional[str]:
+    """Create the PaymentIntent for a pending top-up; returns its status.
+
+    Safe to call again for the same row: the idempotency key makes Stripe
+    return the original intent. None means it couldn't be submitted and the
+    sweeper will try again.
+    """
+    key = row["idempotency_key"]
+    product_label = "Bot" if row["product"] == "bot" else "Transcription"
+    try:
+        pi = await with_retry(
+            stripe.PaymentIntent.create,
+            amount=row["amount_cents"],
+            currency="usd",
+            customer=row["customer_id"],
+            payment_method=row["payment_method_id"],
+            off_session=True,
+            confirm=True,
+            description=f"{product_label} balance {'auto ' if row['source'] == 'auto' else ''}top-up",
+            metadata={"topup_key": key, "topup_product": row["product"], "userEmail": row["email"]},
+            idempotency_key=key,
+            label="stripe topup charge",
+        )
+    except stripe.error.CardError as e:
+        await settle_topup(key, False, error=e.user_message or str(e))
+        return "failed"
+    except Exception as e:
+        print(f"[TOPUP] Could not submit {key}, the sweeper will retry: {e}")
+        return None
+
+    await db.attach_topup_intent(key, pi.id)
+    if pi.status == "succeeded":
+        await settle_topup(key, True, pi.id)
+    elif pi.status in _FAILED_STATUSES:
+        await settle_topup(key, False, pi.id, error=f"payment intent {pi.status}")
+    return pi.status
+
+
+def submit_in_background(row: Dict[str, Any]) -> None:
+    """Submit off the request path (fresh context: no request deadline or memo)."""
+    task = asyncio.get_running_loop().create_task(submit_topup(row), context=contextvars.Context())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def handle_payment_intent_event(event_type: str, intent: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Settle the pending top-up a payment_intent webhook refers to (if any)."""
+    key = (intent.get("metadata") or {}).get("topup_key")
+    if not key:
+        return None
+    if event_type == "payment_intent.succeeded":
+        return await settle_topup(key, True, intent.get("id"))
+    error = (intent.get("last_payment_error") or {}).get("message") or event_type
+    return await settle_topup(key, False, intent.get("id"), error=error)
+
+
+async def sweep_pending_topups() -> None:
+    """Resolve top-ups whose webhook never arrived (or that were never submitted)."""
+    if not db.schema_ready():
+        return
+    rows = await db.stale_pending_topups(TOPUP_SWEEP_AFTER_SECONDS)
+    for row in rows:
+        key = row["idempotency_key"]
+        if not row.get("payment_intent_id"):
+            if float(row["age_seconds"]) > _RESUBMIT_WINDOW_SECONDS:
+                await settle_topup(key, False, error="never submitted")
+            else:
+                await submit_topup(row)
+            continue
+        try:
+            pi = await with_retry(stripe.PaymentIntent.retrieve, row["payment_intent_id"], label="stripe retrieve intent")
+        except Exception as e:
+            print(f"[TOPUP] Sweeper could not check {key}: {e}")
+            continue
+        if pi.status == "succeeded":
+            await settle_topup(key, True, pi.id)
+        elif pi.status in _FAILED_STATUSES:
+            await settle_topup(key, False, pi.id, error=f"payment intent {pi.status}")
+        else:
+            print(f"[TOPUP] {key} still {pi.status} after {float(row['age_seconds']):.0f}s")
@@ -1,37 +1,60 @@
 from __future__ import annotations
 
 import time
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import stripe
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 
-from .config import get_price_id
-from .context import _ensure_customer
+from .config import DATABASE_URL, get_price_id
+from .context import find_customer_id
 from .models import UsageReport
+from .retry import with_retry
 
 router = APIRouter()
 
 
+async def record_usage_total(sub: Dict[str, Any], item: Dict[str, Any], quantity: int) -> None:
+    """Mirror a usage record we just sent to Stripe into the local totals.
+
+    Best effort: the reconcile job corrects any drift from Stripe's summaries.
+    """
+    if not DATABASE_URL:
+        return
+    period_start = sub.get("current_period_start") or item.get("current_period_start")
+    if not period_start:
+        return
+    from .db import add_usage_total
+    try:
+        await add_usage_total(item["id"], int(period_start), sub["id"], sub.get("customer"), quantity)
+    except Exception as e:
+        print(f"[USAGE] Failed to record local usage total for {item['id']}: {e}")
+
+
 @router.post("/v1/usage")
-async def report_usage(req: UsageReport) -> Dict[str, Any]:
+async def report_usage(
+    req: UsageReport, idempotency_header: Optional[str] = Header(None, alias="Idempotency-Key"),
+) -> Dict[str, Any]:
     """Report metered usage for a customer's subscription."""
     if req.plan_type not in ("bot_service", "transcription_api"):
         raise HTTPException(status_code=400, detail=f"Invalid plan_type '{req.plan_type}'")
 
     price_id = get_price_id(req.plan_type)
-    customer = _ensure_customer(req.email)
+    customer_id = await find_customer_id(req.email)
 
     # Find active subscription with this price
-    subs = stripe.Subscription.list(customer=customer.id, status="active", limit=50)
-    target_item = None
-    for sub in subs.data:
+    subs = await with_retry(
+        stripe.Subscription.list, customer=customer_id, status="active", limit=50,
+        label="stripe list subs",
+    ) if customer_id else None
+    target_item = target_sub = None
+    for sub in (subs.data if subs else []):
         items = (sub.get("items") or {}).get("data") or []
         for item in items:
             item_price = item.get("price", {})
             item_price_id = item_price.get("id") if isinstance(item_price, dict) else item.get("price")
             if item_price_id == price_id:
-                target_item = item
+                target_item, target_sub = item, sub
                 break
         if target_item:
             break
@@ -53,10 +76,18 @@ async def report_usage(req: UsageReport) -> Dict[str, Any]:
         "timestamp": ts,
         "action": "increment",
     }
-    if req.idempotency_key:
-        create_kwargs["idempotency_key"] = req.idempotency_key
+    client_key = req.idempotency_key or idempotency_header
+    if client_key:
+        create_kwargs["idempotency_key"] = client_key
 
-    usage_record = stripe.SubscriptionItem.create_usage_record(**create_kwargs)
+    # An increment is only safe to retry when Stripe can dedupe it by key;
+    # without one a lost response would double-count the usage.
+    usage_record = await with_retry(
+        stripe.SubscriptionItem.create_usage_record, **create_kwargs,
+        max_retries=3 if client_key else 0,
+        label="stripe usage record",
+    )
+    await record_usage_total(target_sub, target_item, usage_quantity)
     print(f"[USAGE] Reported {usage_quantity} {req.plan_type} for {req.email}")
 
     return {
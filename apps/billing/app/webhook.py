@@ -1,14 +1,21 @@
 from __future__ import annotations
 
 import time
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import stripe
 from fastapi import APIRouter, HTTPException, Request, status
 
-from .config import STRIPE_WEBHOOK_SECRET, STRIPE_IDS, BOT_PLANS, ADDON, DATABASE_URL, INITIAL_BOT_CREDIT_CENTS, TX_FREE_CREDIT_MINUTES
+from .config import (
+    STRIPE_WEBHOOK_SECRET, STRIPE_IDS, BOT_PLANS, ADDON, DATABASE_URL, INITIAL_BOT_CREDIT_CENTS, TX_FREE_CREDIT_MINUTES,
+    ENTITLEMENT_WRITE_MODE,
+)
 from .admin import admin_request
+from .memo import retrieve_customer
+from .payment_methods import event_customer_id, payment_method_patch, resolve_default_payment_method
+from .ratelimit import stripe_lane
 from .retry import with_retry
+from .sessions import sessions
 
 router = APIRouter()
 
@@ -57,6 +64,49 @@ def _extract_email(sub: Dict[str, Any]) -> Optional[str]:
     return None
 
 
+async def _lookup_by_customer(cust_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    """User row via the customer → user index; None if unmapped or the lookup fails."""
+    if not (DATABASE_URL and cust_id):
+        return None
+    from .db import get_user_by_customer_id
+    try:
+        return await get_user_by_customer_id(cust_id)
+    except Exception as e:
+        print(f"[WEBHOOK] Customer index lookup failed for {cust_id}: {e}")
+        return None
+
+
+async def _resolve_user(obj: Dict[str, Any]) -> Tuple[Optional[str], Optional[int]]:
+    """Resolve (email, user_id) for a Stripe object carrying a customer ID.
+
+    Known customers resolve through the customer → user index (one indexed
+    query, no Stripe call). Otherwise fall back to metadata email, and only
+    for unknown customers without one, to Customer.retrieve.
+    """
+    cust_id = obj.get("customer")
+    user = await _lookup_by_customer(cust_id)
+    if user:
+        return user["email"], user["id"]
+
+    email = _extract_email(obj)
+    if not email and cust_id:
+        try:
+            customer = await retrieve_customer(cust_id, label="stripe retrieve customer for email")
+            email = customer.get("email")
+        except stripe.error.StripeError:
+            email = None
+    return email, None
+
+
+async def _merge_user(email: str, user_id: Optional[int], patch: Dict[str, Any]) -> None:
+    """JSONB merge by primary key when the row is known, else by email."""
+    from .db import merge_user_data, merge_user_data_by_id
+    if user_id is not None:
+        await merge_user_data_by_id(user_id, patch)
+    else:
+        await merge_user_data(email, patch)
+
+
 def _identify_plan(sub: Dict[str, Any]) -> str:
     items = (sub.get("items") or {}).get("data") or []
     for item in items:
@@ -98,7 +148,7 @@ def _compute_entitlements(sub: Dict[str, Any]) -> Dict[str, Any]:
         else:
             max_bots = 0
 
-    return {
+    entitlements: Dict[str, Any] = {
         f"{prefix}_status": normalized_status,
         f"{prefix}_tier": plan_type,
         f"{prefix}_cancel_at_period_end": scheduled_to_cancel,
@@ -110,15 +160,70 @@ def _compute_entitlements(sub: Dict[str, Any]) -> Dict[str, Any]:
         f"{prefix}_current_period_start": sub.get("current_period_start"),
         f"{prefix}_trial_end": sub.get("trial_end"),
         f"{prefix}_trial_start": sub.get("trial_start"),
+        # Lets balance reads and usage reconciliation work without Stripe
+        f"{prefix}_item_ids": [item["id"] for item in (sub.get("items") or {}).get("data") or [] if item.get("id")],
         "max_concurrent_bots": max_bots,
         "_plan_type": plan_type,
         "_is_addon": is_addon,
     }
+    if plan_type == "bot_service":
+        entitlements["subscription_initial_credit_cents"] = int(
+            (sub.get("metadata") or {}).get("initial_credit_cents", "500")
+        )
+    return entitlements
+
+
+async def _patch_via_admin_api(
+    email: str,
+    db_user_id: Optional[int],
+    plan_type: str,
+    max_bots: Optional[int],
+    data_patch: Dict[str, Any],
+) -> None:
+    """Write entitlements through the Admin API (upserting the user if needed)."""
+    # Resolve the Admin API user ID — cached/DB lookup first, upsert only for
+    # new users. bot_service also needs the current max_concurrent_bots.
+    from . import identity
+    user_id = db_user_id if db_user_id is not None else await identity.lookup_user_id(email)
+    current_max: Optional[int] = None
+    needs_current_max = max_bots is not None and plan_type == "bot_service"
+    if user_id is not None and needs_current_max:
+        if DATABASE_URL:
+            from .db import get_user_by_email
+            row = await get_user_by_email(email)
+            current_max = (row or {}).get("max_concurrent_bots")
+        if current_max is None:
+            user_id = None  # only the upsert response carries it without a DB
+    if user_id is None:
+        user_id, user_data = await identity.upsert_user(email)
+        current_max = user_data.get("max_concurrent_bots", 0)
+
+    # For bot_service, preserve current max_concurrent_bots if higher than default
+    if needs_current_max and (current_max or 0) > max_bots:
+        max_bots = current_max
+
+    # Build Admin API patch — only include max_bots for bot plans
+    patch: Dict[str, Any] = {"data": data_patch}
+    if max_bots is not None:
+        patch["max_concurrent_bots"] = max_bots
+
+    resp = await admin_request("PATCH", f"/admin/users/{user_id}", patch)
+    if resp.status_code == 404:
+        # Stale cached ID (user recreated) — re-upsert once and retry
+        identity.forget(email)
+        user_id, _ = await identity.upsert_user(email)
+        resp = await admin_request("PATCH", f"/admin/users/{user_id}", patch)
+    if resp.status_code not in (200, 201):
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Admin API patch failed: {resp.text}",
+        )
 
 
-async def _sync_entitlements(email: str, sub: Dict[str, Any]) -> None:
-    """Reconcile subscription → Admin API user patch.
-    Bot plans write to subscription_* fields. Addons write to tx_subscription_* fields.
+async def _sync_entitlements(email: str, sub: Dict[str, Any], db_user_id: Optional[int] = None) -> None:
+    """Reconcile subscription → user entitlements.
+    With DATABASE_URL (and ENTITLEMENT_WRITE_MODE=direct) this is one local
+    transaction; otherwise an Admin API patch. Bot plans write to subscription_* fields. Addons write to tx_subscription_* fields.
     They never overwrite each other.
     """
     entitlements = _compute_entitlements(sub)
@@ -151,90 +256,52 @@ async def _sync_entitlements(email: str, sub: Dict[str, Any]) -> None:
             except stripe.error.StripeError as e:
                 print(f"[WEBHOOK] WARNING: Could not check active subs: {e}")
 
-    # Upsert user (admin_request already has retry)
-    resp = await admin_request("POST", "/admin/users", {"email": email})
-    if resp.status_code not in (200, 201):
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Admin API user upsert failed: {resp.text}",
-        )
-    user_data = resp.json()
-    user_id = user_data.get("id") or (user_data.get("data") or {}).get("id")
-
-    # For bot_service, preserve current max_concurrent_bots if higher than default
-    if max_bots is not None and plan_type == "bot_service":
-        current_max = user_data.get("max_concurrent_bots", 0)
-        if current_max > max_bots:
-            max_bots = current_max
-
-    # Build Admin API patch — only include max_bots for bot plans
-    patch: Dict[str, Any] = {
-        "data": {
-            "updated_by_webhook": int(time.time()),
-            "stripe_customer_id": sub.get("customer"),
-            sub_id_field: sub.get("id"),
-            **entitlements,
-        },
+    data_patch: Dict[str, Any] = {
+        "updated_by_webhook": int(time.time()),
+        "stripe_customer_id": sub.get("customer"),
+        sub_id_field: sub.get("id"),
+        **entitlements,
     }
-    if max_bots is not None:
-        patch["max_concurrent_bots"] = max_bots
 
-    resp2 = await admin_request("PATCH", f"/admin/users/{user_id}", patch)
-    if resp2.status_code not in (200, 201):
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Admin API patch failed: {resp2.text}",
-        )
-
-    # Also write to DB via merge_user_data (atomic JSONB merge)
-    if DATABASE_URL:
-        from .db import merge_user_data
-        db_patch = {
-            "updated_by_webhook": int(time.time()),
-            "stripe_customer_id": sub.get("customer"),
-            sub_id_field: sub.get("id"),
-            **entitlements,
-        }
+    if not DATABASE_URL:
+        await _patch_via_admin_api(email, db_user_id, plan_type, max_bots, data_patch)
+    else:
+        db_patch = dict(data_patch)
 
         # Save customer's default payment method (needed for off-session topups)
         if sub.get("status") in ("active", "trialing"):
             cust_id = sub.get("customer")
             if cust_id:
+                known = await _lookup_by_customer(cust_id)
                 try:
-                    customer = await with_retry(
-                        stripe.Customer.retrieve, cust_id,
-                        label="stripe retrieve customer",
-                    )
-                    pm_id = (customer.get("invoice_settings") or {}).get("default_payment_method")
-                    if not pm_id:
-                        pm_id = customer.get("default_source")
-                    # Fallback: list attached cards
-                    if not pm_id:
-                        pms = await with_retry(
-                            stripe.PaymentMethod.list, customer=cust_id, type="card", limit=1,
-                            label="stripe list payment methods",
-                        )
-                        if pms.data:
-                            pm_id = pms.data[0].id
-                            # Set as default on Stripe customer
-                            try:
-                                await with_retry(
-                                    stripe.Customer.modify, cust_id,
-                                    invoice_settings={"default_payment_method": pm_id},
-                                    label="stripe set default pm",
-                                )
-                            except stripe.error.StripeError:
-                                pass
+                    pm_id = await resolve_default_payment_method(cust_id, (known or {}).get("data"))
                     if pm_id:
                         db_patch["stripe_payment_method_id"] = pm_id
                 except stripe.error.StripeError:
                     pass
 
-        await merge_user_data(email, db_patch)
+        # Direct mode: max_concurrent_bots + subscription fields in one local
+        # transaction. The Admin API is only used when that isn't possible
+        # (mode disabled, user row doesn't exist yet, or the write failed).
+        written = False
+        if ENTITLEMENT_WRITE_MODE == "direct":
+            from .db import apply_entitlements
+            try:
+                row = await apply_entitlements(
+                    db_patch, max_bots,
+                    preserve_higher=plan_type == "bot_service",
+                    user_id=db_user_id, email=email,
+                )
+                written = row is not None
+            except Exception as e:
+                print(f"[WEBHOOK] Direct entitlement write failed for {email}, using Admin API: {e}")
+        if not written:
+            await _patch_via_admin_api(email, db_user_id, plan_type, max_bots, data_patch)
+            await _merge_user(email, db_user_id, db_patch)
 
     # Apply welcome credit for new bot_service subscriptions
     if DATABASE_URL and plan_type == "bot_service" and sub.get("status") in ("active", "trialing"):
-        from .db import get_user_data, merge_user_data
+        from .db import get_user_data
         data = await get_user_data(email)
         if not data.get("bot_welcome_credit_given"):
             try:
@@ -245,9 +312,10 @@ async def _sync_entitlements(email: str, sub: Dict[str, Any]) -> None:
                     amount=-INITIAL_BOT_CREDIT_CENTS,
                     currency="usd",
                     description="Welcome credit — Pay-as-you-go ($5)",
+                    max_retries=0,  # a retried credit could be granted twice
                     label="stripe welcome credit",
                 )
-                await merge_user_data(email, {
+                await _merge_user(email, db_user_id, {
                     "bot_welcome_credit_given": True,
                     "bot_balance_cents": INITIAL_BOT_CREDIT_CENTS,
                 })
@@ -272,6 +340,11 @@ async def _sync_entitlements(email: str, sub: Dict[str, Any]) -> None:
 
 @router.post("/v1/stripe/webhook")
 async def stripe_webhook(request: Request):
+    with stripe_lane("webhook"):
+        return await _handle_webhook(request)
+
+
+async def _handle_webhook(request: Request):
     body = await request.body()
     signature = request.headers.get("stripe-signature")
     if not STRIPE_WEBHOOK_SECRET or not signature:
@@ -303,6 +376,9 @@ async def stripe_webhook(request: Request):
         "customer.subscription.deleted",
     }:
         sub = data_object
+        # Cached portal/checkout URLs were routed on the old subscription state
+        if sub.get("customer"):
+            sessions.invalidate(sub["customer"])
 
         # Skip "incomplete" status — transient state during checkout.
         # Stripe sends subscription.created (incomplete) + subscription.updated (active)
@@ -311,23 +387,12 @@ async def stripe_webhook(request: Request):
             print(f"[WEBHOOK] Skipping {event_type} — status is 'incomplete' (transient)")
             return {"received": True, "note": "skipped incomplete"}
 
-        email = _extract_email(sub)
-        if not email:
-            cust_id = sub.get("customer")
-            if cust_id:
-                try:
-                    customer = await with_retry(
-                        stripe.Customer.retrieve, cust_id,
-                        label="stripe retrieve customer for email",
-                    )
-                    email = customer.get("email")
-                except stripe.error.StripeError:
-                    email = None
+        email, db_user_id = await _resolve_user(sub)
         if not email:
             return {"received": True, "note": "No email to map user"}
 
         try:
-            await _sync_entitlements(email, sub)
+            await _sync_entitlements(email, sub, db_user_id)
             await _log_webhook_event(email, event_type, event_id, "ok")
         except Exception as e:
             await _log_webhook_event(email, event_type, event_id, "error", str(e))
@@ -337,6 +402,8 @@ async def stripe_webhook(request: Request):
     # Handle one-time topup checkout sessions (not subscriptions — those are handled by subscription.created)
     if event_type == "checkout.session.completed":
         session = data_object
+        if session.get("customer"):
+            sessions.invalidate(session["customer"])
         metadata = session.get("metadata") or {}
         topup_product = metadata.get("topup_product")
         if topup_product:
@@ -345,8 +412,14 @@ async def stripe_webhook(request: Request):
             topup_cents = int(metadata.get("topup_amount_cents", 0))
             if topup_email and topup_cents > 0:
                 if DATABASE_URL:
-                    from .db import get_user_data, merge_user_data
-                    data = await get_user_data(topup_email)
+                    from .db import get_user_data
+                    db_user = await _lookup_by_customer(session.get("customer"))
+                    if db_user:
+                        topup_user_id = db_user["id"]
+                        data = db_user.get("data") or {}
+                    else:
+                        topup_user_id = None
+                        data = await get_user_data(topup_email)
                     if topup_product == "bot":
                         field = "bot_balance_cents"
                         current = data.get(field, 0) or 0
@@ -361,25 +434,43 @@ async def stripe_webhook(request: Request):
                     cust_id = session.get("customer")
                     if cust_id:
                         try:
-                            customer = await with_retry(
-                                stripe.Customer.retrieve, cust_id,
-                                label="stripe retrieve customer for topup",
-                            )
-                            pm_id = (customer.get("invoice_settings") or {}).get("default_payment_method")
-                            if not pm_id:
-                                pm_id = customer.get("default_source")
+                            pm_id = await resolve_default_payment_method(cust_id, data)
                             if pm_id:
                                 patch["stripe_payment_method_id"] = pm_id
                         except stripe.error.StripeError:
                             pass
                         patch["stripe_customer_id"] = cust_id
-                    await merge_user_data(topup_email, patch)
+                    await _merge_user(topup_email, topup_user_id, patch)
                     print(f"[WEBHOOK] Topup {topup_product} for {topup_email}: +{topup_cents}c → {field}={new_balance}")
                     await _log_webhook_event(topup_email, event_type, event_id, "ok", f"topup {topup_product} +{topup_cents}c")
             return {"received": True}
         # Non-topup checkout sessions (subscriptions) — handled by subscription.created, skip here
         return {"received": True, "note": "checkout handled by subscription events"}
 
+    # Pending top-ups (TOPUP_CONFIRMATION_MODE=webhook) settle here
+    if event_type in {"payment_intent.succeeded", "payment_intent.payment_failed", "payment_intent.canceled"}:
+        if not DATABASE_URL:
+            return {"received": True, "ignored": event_type}
+        from .topups import handle_payment_intent_event
+        settled = await handle_payment_intent_event(event_type, data_object)
+        if settled:
+            await _log_webhook_event(settled["email"], event_type, event_id, "ok", f"topup {settled['idempotency_key']}")
+        return {"received": True}
+
+    # Keep the cached default payment method current
+    if event_type in {"payment_method.attached", "payment_method.detached", "customer.updated"}:
+        previous = (event.get("data") or {}).get("previous_attributes") or {}
+        user = await _lookup_by_customer(event_customer_id(event_type, data_object, previous))
+        if not user:
+            return {"received": True, "note": "customer not mapped to a user"}
+        data = user.get("data") or {}
+        patch = payment_method_patch(event_type, data_object, previous, data.get("stripe_payment_method_id"))
+        if patch:
+            await _merge_user(user["email"], user["id"], patch)
+            print(f"[WEBHOOK] Payment method for {user['email']} → {patch['stripe_payment_method_id']}")
+            await _log_webhook_event(user["email"], event_type, event_id, "ok")
+        return {"received": True}
+
     if event_type == "invoice.paid":
         invoice = data_object
         print(f"[WEBHOOK] Invoice paid: {invoice.get('id')} amount={invoice.get('amount_paid')}")
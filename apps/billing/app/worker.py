@@ -0,0 +1,75 @@
+"""
+Dedicated background-job worker.
+
+Runs only the scheduler (auto-topup, enforcement, monthly reset, ...) so
+job CPU and blocking Stripe calls don't compete with API request handling,
+and the two can be scaled independently:
+
+    python -m app.worker
+
+Pair with RUN_BACKGROUND_JOBS=false on the API process. If WORKER_HTTP_PORT
+is set, the worker also serves the /internal endpoints (job stats, manual
+runs) on that port.
+
+Replicas are safe: every job run first takes a lease row in Postgres
+(billing_job_leases), so a job that is already running elsewhere is
+skipped rather than run twice (auto-topup would otherwise double-charge).
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import signal
+
+from .config import DATABASE_URL
+
+
+async def _serve_internal(port: int) -> None:
+    import uvicorn
+    from fastapi import FastAPI
+
+    from .internal import router as internal_router
+
+    app = FastAPI(title="Billing Worker")
+    app.include_router(internal_router)
+
+    @app.get("/")
+    async def health():
+        return {"status": "ok", "service": "billing-worker"}
+
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=port, log_level="warning"))
+    await server.serve()
+
+
+async def main() -> None:
+    if not DATABASE_URL:
+        print("[WORKER] DATABASE_URL not configured — no background jobs to run")
+        return
+
+    from .db import ensure_schema
+    from .tasks import start_background_tasks, stop_background_tasks
+
+    await ensure_schema()
+    start_background_tasks()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    http_task = None
+    port = os.getenv("WORKER_HTTP_PORT")
+    if port:
+        http_task = asyncio.create_task(_serve_internal(int(port)))
+        print(f"[WORKER] Internal endpoints on :{port}")
+
+    print("[WORKER] Running — waiting for SIGTERM/SIGINT")
+    await stop.wait()
+    print("[WORKER] Shutting down")
+    if http_task:
+        http_task.cancel()
+    await stop_background_tasks()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
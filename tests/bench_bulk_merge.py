@@ -0,0 +1,88 @@
+"""
+Benchmark: N per-user JSONB patches applied serially vs. via merge_user_data_bulk.
+
+Needs a disposable Postgres — it inserts and deletes its own rows in
+public.users (creating a minimal table if none exists). Never point this at
+production.
+
+Run: BENCH_DATABASE_URL=postgresql://... python tests/bench_bulk_merge.py [N]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apps", "billing"))
+
+if not os.environ.get("BENCH_DATABASE_URL"):
+    sys.exit("BENCH_DATABASE_URL is required (use a throwaway database)")
+os.environ["DATABASE_URL"] = os.environ["BENCH_DATABASE_URL"]
+for var, val in {
+    "STRIPE_SECRET_KEY": "sk_test_bench",
+    "ADMIN_API_URL": "http://admin.bench",
+    "ADMIN_API_TOKEN": "bench",
+    "PORTAL_RETURN_URL": "http://bench/account",
+}.items():
+    os.environ.setdefault(var, val)
+
+from sqlalchemy import text  # noqa: E402
+
+from app.db import get_session, merge_user_data_by_id, merge_user_data_bulk  # noqa: E402
+
+EMAIL_DOMAIN = "bench-bulk-merge.invalid"
+
+
+async def _setup(n: int) -> list:
+    async with get_session() as db:
+        await db.execute(text("""
+            CREATE TABLE IF NOT EXISTS public.users (
+                id SERIAL PRIMARY KEY,
+                email TEXT UNIQUE NOT NULL,
+                data JSONB,
+                max_concurrent_bots INTEGER DEFAULT 0
+            )
+        """))
+        await db.execute(text("DELETE FROM public.users WHERE email LIKE :pat"), {"pat": f"%@{EMAIL_DOMAIN}"})
+        result = await db.execute(
+            text("""
+                INSERT INTO public.users (email, data)
+                SELECT 'u' || g || '@' || :domain, '{}'::jsonb FROM generate_series(1, :n) g
+                RETURNING id
+            """),
+            {"domain": EMAIL_DOMAIN, "n": n},
+        )
+        ids = [row[0] for row in result.all()]
+        await db.commit()
+    return ids
+
+
+async def _teardown() -> None:
+    async with get_session() as db:
+        await db.execute(text("DELETE FROM public.users WHERE email LIKE :pat"), {"pat": f"%@{EMAIL_DOMAIN}"})
+        await db.commit()
+
+
+async def main(n: int) -> None:
+    ids = await _setup(n)
+    patches = {user_id: {"bot_balance_cents": i, "bench_round": "serial"} for i, user_id in enumerate(ids)}
+
+    start = time.perf_counter()
+    for user_id, patch in patches.items():
+        await merge_user_data_by_id(user_id, patch)
+    serial = time.perf_counter() - start
+
+    for patch in patches.values():
+        patch["bench_round"] = "bulk"
+    start = time.perf_counter()
+    updated = await merge_user_data_bulk(patches)
+    bulk = time.perf_counter() - start
+
+    await _teardown()
+    print(f"patches:  {n}")
+    print(f"serial:   {serial:.2f}s ({n / serial:,.0f} rows/s)")
+    print(f"bulk:     {bulk:.2f}s ({len(updated) / bulk:,.0f} rows/s)")
+    print(f"speedup:  {serial / bulk:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000))
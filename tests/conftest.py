@@ -0,0 +1,12 @@
+"""Shared test setup: make the billing app importable without real credentials."""
+import os
+import sys
+
+# Support both local (apps/billing/app/) and Docker (/app/) import paths
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apps", "billing"))
+
+# config.py validates these on import — tests never talk to the real services
+os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_dummy")
+os.environ.setdefault("ADMIN_API_URL", "http://admin.test")
+os.environ.setdefault("ADMIN_API_TOKEN", "test-token")
+os.environ.setdefault("PORTAL_RETURN_URL", "http://webapp.test/account")
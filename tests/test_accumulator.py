@@ -0,0 +1,81 @@
+"""Tests for the write-behind balance accumulator."""
+from types import SimpleNamespace
+
+import pytest
+
+from app import db, hooks
+from app.accumulator import BalanceAccumulator
+
+
+@pytest.fixture
+def journal(monkeypatch):
+    state = SimpleNamespace(rows={}, applied=[], fail=False)
+
+    async def append(user_id, deltas):
+        journal_id = len(state.rows) + 1
+        state.rows[journal_id] = (user_id, deltas)
+        return journal_id
+
+    async def apply(ids, orphan_after=60.0):
+        if state.fail:
+            raise ConnectionError("db down")
+        state.applied.append(list(ids))
+        return [{"id": state.rows[i][0], "email": "a@example.com"} for i in ids]
+
+    monkeypatch.setattr(db, "journal_balance_deltas", append)
+    monkeypatch.setattr(db, "apply_balance_journal", apply)
+    return state
+
+
+@pytest.mark.asyncio
+async def test_debits_coalesce_into_one_flush_and_read_through(journal):
+    acc = BalanceAccumulator(interval=0.25)
+    for _ in range(3):
+        await acc.debit(1, "a@example.com", {"bot_balance_cents": -10, "bot_monthly_spent_cents": 10})
+    data = acc.overlay("a@example.com", {"bot_balance_cents": 100})
+    assert data == {"bot_balance_cents": 70, "bot_monthly_spent_cents": 30}
+
+    assert await acc.flush() == 3
+    assert journal.applied == [[1, 2, 3]]
+    assert acc.overlay("a@example.com", {"bot_balance_cents": 70}) == {"bot_balance_cents": 70}
+    assert await acc.flush() == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_debits_for_the_next_tick(journal):
+    acc = BalanceAccumulator(interval=0.25)
+    await acc.debit(1, "a@example.com", {"bot_balance_cents": -10})
+    journal.fail = True
+    assert await acc.flush() == 0
+    assert acc.overlay("a@example.com", {"bot_balance_cents": 100})["bot_balance_cents"] == 90
+    journal.fail = False
+    await acc.debit(1, "a@example.com", {"bot_balance_cents": -5})
+    assert await acc.flush() == 2
+    assert journal.applied == [[1, 2]]
+    assert acc.stats()["flush_errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_meeting_hook_journals_instead_of_rewriting_the_row(monkeypatch, journal):
+    acc = BalanceAccumulator(interval=0.25)
+
+    async def fake_user(email):
+        return {"id": 1, "email": email, "data": {"bot_balance_cents": 100}, "max_concurrent_bots": 1}
+
+    async def no_increment(user_id, increments):
+        raise AssertionError("write-behind must not update the user row")
+
+    async def no_customer(email):
+        return None
+
+    monkeypatch.setattr(hooks, "BALANCE_WRITE_BEHIND", True)
+    monkeypatch.setattr(hooks, "schema_ready", lambda: True)
+    monkeypatch.setattr(hooks, "accumulator", acc)
+    monkeypatch.setattr(hooks, "get_user_by_email", fake_user)
+    monkeypatch.setattr(hooks, "increment_user_data", no_increment)
+    monkeypatch.setattr(hooks, "find_customer_id", no_customer)
+
+    result = await hooks.handle_meeting_completed({"meeting": {"user_email": "a@example.com", "duration_seconds": 3600}})
+    assert result["balance_deducted"] is True
+    assert result["new_balance_cents"] == 70
+    assert journal.rows == {1: (1, {"bot_balance_cents": -30, "bot_monthly_spent_cents": 30})}
@@ -0,0 +1,113 @@
+"""Tests for the auto-topup pass and the cross-process job lock."""
+import asyncio
+import contextlib
+
+import pytest
+
+from app import tasks
+
+
+def _bot_row(user_id, balance=0):
+    return {
+        "id": user_id,
+        "email": f"user{user_id}@example.com",
+        "max_concurrent_bots": 1,
+        "data": {
+            "bot_topup_enabled": True,
+            "bot_balance_cents": balance,
+            "bot_topup_amount_cents": 500,
+            "stripe_customer_id": f"cus_{user_id}",
+            "stripe_payment_method_id": f"pm_{user_id}",
+        },
+    }
+
+
+@pytest.fixture
+def topup_env(monkeypatch):
+    events = []
+    rows = {tasks._Q_BOT_TOPUP: [_bot_row(1), _bot_row(2), _bot_row(3)], tasks._Q_TX_TOPUP: []}
+
+    @contextlib.asynccontextmanager
+    async def fake_session():
+        yield object()
+
+    async def fake_run_query(session, name, params=None):
+        return rows[name]
+
+    async def fake_increment(user_id, increments):
+        events.append(("credit", user_id, increments["bot_balance_cents"]))
+        return {"id": user_id, "data": {"bot_balance_cents": increments["bot_balance_cents"]}}
+
+    monkeypatch.setattr(tasks, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(tasks, "get_session", fake_session)
+    monkeypatch.setattr(tasks, "run_query", fake_run_query)
+    monkeypatch.setattr(tasks, "increment_user_data", fake_increment)
+    return events
+
+
+def test_each_charge_is_credited_before_the_next(monkeypatch, topup_env):
+    def fake_charge(**kwargs):
+        topup_env.append(("charge", kwargs["customer"]))
+        if kwargs["customer"] == "cus_2":
+            raise RuntimeError("card_declined")
+
+    monkeypatch.setattr(tasks.stripe.PaymentIntent, "create", fake_charge)
+    asyncio.run(tasks.auto_topup_pass())
+    assert topup_env == [
+        ("charge", "cus_1"), ("credit", 1, 500),
+        ("charge", "cus_2"),
+        ("charge", "cus_3"), ("credit", 3, 500),
+    ]
+
+
+def test_interrupted_pass_leaves_no_charged_user_uncredited(monkeypatch, topup_env):
+    def fake_charge(**kwargs):
+        topup_env.append(("charge", kwargs["customer"]))
+        if kwargs["customer"] == "cus_2":
+            raise KeyboardInterrupt  # stands in for the process dying mid-pass
+
+    monkeypatch.setattr(tasks.stripe.PaymentIntent, "create", fake_charge)
+    with pytest.raises(KeyboardInterrupt):
+        asyncio.run(tasks.auto_topup_pass())
+    charged = {e[1] for e in topup_env if e[0] == "charge" and e[1] != "cus_2"}
+    credited = {f"cus_{e[1]}" for e in topup_env if e[0] == "credit"}
+    assert charged == credited == {"cus_1"}
+
+
+@pytest.mark.asyncio
+async def test_job_lock_reports_jobs_held_elsewhere(monkeypatch):
+    leases = {"auto_topup": "other-host:1:abcd"}
+    runs = []
+
+    class _Session:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def commit(self):
+            pass
+
+    async def fake_run_query(session, name, params=None):
+        if name == tasks._Q_JOB_LEASE_ACQUIRE:
+            if params["name"] in leases:
+                return []
+            leases[params["name"]] = params["holder"]
+            return [{"name": params["name"]}]
+        if name == tasks._Q_JOB_LEASE_RELEASE and leases.get(params["name"]) == params["holder"]:
+            del leases[params["name"]]
+        return []
+
+    monkeypatch.setattr(tasks, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(tasks, "schema_ready", lambda: True)
+    monkeypatch.setattr(tasks, "get_session", _Session)
+    monkeypatch.setattr(tasks, "run_query", fake_run_query)
+
+    async with tasks._job_lock("auto_topup") as locked:
+        runs.append(("auto_topup", locked))
+    async with tasks._job_lock("enforce_dirty") as locked:
+        runs.append(("enforce_dirty", locked, "enforce_dirty" in leases))
+    assert runs == [("auto_topup", False), ("enforce_dirty", True, True)]
+    # Released on exit; the lease held elsewhere is untouched
+    assert leases == {"auto_topup": "other-host:1:abcd"}
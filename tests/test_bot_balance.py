@@ -0,0 +1,173 @@
+"""Tests for the legacy bot-balance endpoint served from local usage totals."""
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import db, main, tasks, usage
+
+
+def _no_stripe(*args, **kwargs):
+    raise AssertionError("Stripe must not be called on the bot-balance read path")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "DATABASE_URL", "postgresql://test")
+    for name in ("list", "retrieve"):
+        monkeypatch.setattr(main.stripe.Customer, name, _no_stripe)
+    monkeypatch.setattr(main.stripe.Subscription, "list", _no_stripe)
+    monkeypatch.setattr(main.stripe.SubscriptionItem, "list_usage_record_summaries", _no_stripe)
+    return TestClient(main.app)
+
+
+def _user(monkeypatch, data, usage_by_period):
+    async def fake_user(email):
+        return {"id": 1, "email": email, "data": data, "max_concurrent_bots": 1}
+
+    async def fake_usage(item_ids, period_start):
+        return {i: usage_by_period[(i, period_start)] for i in item_ids if (i, period_start) in usage_by_period}
+
+    monkeypatch.setattr(db, "get_user_by_email", fake_user)
+    monkeypatch.setattr(db, "get_item_usage_totals", fake_usage)
+
+
+def test_balance_served_from_local_totals(monkeypatch, client):
+    _user(monkeypatch, {
+        "stripe_subscription_id": "sub_1",
+        "subscription_tier": "bot_service",
+        "subscription_status": "active",
+        "subscription_current_period_start": 1700000000,
+        "subscription_initial_credit_cents": 500,
+        "subscription_item_ids": ["si_base", "si_metered"],
+    }, {("si_base", 1700000000): 3, ("si_metered", 1700000000): 20})
+    body = client.post("/v1/stripe/bot-balance", json={"email": "a@example.com"}).json()
+    assert body["has_subscription"] is True
+    assert body["usage_cents"] == 600
+    assert body["balance_cents"] == -100
+    assert body["balance_usd"] == "-$1.00"
+
+
+def test_subscriber_without_local_totals_is_read_from_stripe(monkeypatch, client):
+    _user(monkeypatch, {
+        "stripe_subscription_id": "sub_1",
+        "subscription_tier": "bot_service",
+        "subscription_status": "active",
+    }, {})
+    sub = _Sub(status="active", metadata={"tier": "bot_service", "initial_credit_cents": "500"},
+               items={"data": [SimpleNamespace(id="si_1")]})
+    customer = {"subscriptions": {"data": [sub]}}
+    monkeypatch.setattr(main.stripe.Customer, "list", lambda **kwargs: SimpleNamespace(data=[customer]))
+    monkeypatch.setattr(main.stripe.SubscriptionItem, "list_usage_record_summaries",
+                        lambda item_id, limit: SimpleNamespace(data=[SimpleNamespace(total_usage=10)]))
+    body = client.post("/v1/stripe/bot-balance", json={"email": "a@example.com"}).json()
+    assert body["usage_cents"] == 300
+    assert body["balance_cents"] == 200
+
+
+class _Sub(dict):
+    """Stripe subscription stand-in: attribute and item access."""
+
+    def __init__(self, status, metadata, items):
+        super().__init__(items=items)
+        self.status = status
+        self.metadata = metadata
+
+
+def test_no_payg_subscription(monkeypatch, client):
+    _user(monkeypatch, {"subscription_tier": "individual", "subscription_status": "active"}, {})
+    body = client.post("/v1/stripe/bot-balance", json={"email": "a@example.com"}).json()
+    assert body == {"balance_cents": 0, "initial_credit_cents": 0, "usage_cents": 0, "has_subscription": False}
+
+
+@pytest.mark.asyncio
+async def test_reported_usage_feeds_local_total(monkeypatch):
+    recorded = []
+
+    async def fake_add(item_id, period_start, subscription_id, customer_id, quantity):
+        recorded.append((item_id, period_start, subscription_id, quantity))
+
+    monkeypatch.setattr(usage, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(db, "add_usage_total", fake_add)
+    sub = {"id": "sub_1", "customer": "cus_1", "current_period_start": 1700000000}
+    await usage.record_usage_total(sub, {"id": "si_1"}, 45)
+    assert recorded == [("si_1", 1700000000, "sub_1", 45)]
+
+
+@pytest.mark.asyncio
+async def test_reconcile_overwrites_drifted_totals(monkeypatch, capsys):
+    """Runs the real set_usage_total against a fake session holding two local totals."""
+    totals = {("si_1", 1700000000): 40, ("si_2", 1700000000): 7}
+
+    @contextlib.asynccontextmanager
+    async def fake_session():
+        yield SimpleNamespace(commit=_noop)
+
+    async def fake_run_query(session, name, params=None):
+        if name == db._Q_SET_USAGE:
+            key = (params["item_id"], params["period_start"])
+            previous = totals.get(key)
+            totals[key] = params["total_usage"]
+            return [{"previous": previous}]
+        return [{"id": 1, "email": "a@example.com", "customer_id": "cus_1",
+                 "subscription_id": "sub_1", "item_ids": ["si_1", "si_2"]}]
+
+    def fake_summaries(item_id, limit):
+        usage_by_item = {"si_1": 42, "si_2": 7}
+        return SimpleNamespace(data=[{"total_usage": usage_by_item[item_id], "period": {"start": 1700000000}}])
+
+    monkeypatch.setattr(tasks, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(tasks, "schema_ready", lambda: True)
+    monkeypatch.setattr(tasks, "get_session", fake_session)
+    monkeypatch.setattr(tasks, "run_query", fake_run_query)
+    monkeypatch.setattr(db, "get_session", fake_session)
+    monkeypatch.setattr(db, "run_query", fake_run_query)
+    monkeypatch.setattr(tasks.stripe.SubscriptionItem, "list_usage_record_summaries", fake_summaries)
+    await tasks.reconcile_usage_totals()
+
+    assert totals == {("si_1", 1700000000): 42, ("si_2", 1700000000): 7}
+    out = capsys.readouterr().out
+    assert "si_1: local 40 → Stripe 42" in out
+    assert "si_2" not in out
+    assert "Checked 2 items, corrected 1" in out
+
+
+async def _noop():
+    pass
+
+
+@pytest.mark.asyncio
+async def test_reconcile_backfills_items_for_older_subscribers(monkeypatch):
+    merged, written = [], []
+
+    @contextlib.asynccontextmanager
+    async def fake_session():
+        yield object()
+
+    async def fake_run_query(session, name, params=None):
+        return [{"id": 1, "email": "a@example.com", "customer_id": "cus_1",
+                 "subscription_id": "sub_1", "item_ids": None}]
+
+    async def fake_merge_bulk(patches):
+        merged.append(patches)
+        return list(patches)
+
+    async def fake_set(item_id, period_start, subscription_id, customer_id, total):
+        written.append((item_id, total))
+        return None
+
+    sub = {"current_period_start": 1700000000, "items": {"data": [{"id": "si_1"}]}}
+    monkeypatch.setattr(tasks, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(tasks, "schema_ready", lambda: True)
+    monkeypatch.setattr(tasks, "get_session", fake_session)
+    monkeypatch.setattr(tasks, "run_query", fake_run_query)
+    monkeypatch.setattr(tasks, "merge_user_data_bulk", fake_merge_bulk)
+    monkeypatch.setattr(db, "set_usage_total", fake_set)
+    monkeypatch.setattr(tasks.stripe.Subscription, "retrieve", lambda sub_id: sub)
+    monkeypatch.setattr(tasks.stripe.SubscriptionItem, "list_usage_record_summaries",
+                        lambda item_id, limit: SimpleNamespace(data=[{"total_usage": 5, "period": {"start": 1700000000}}]))
+    await tasks.reconcile_usage_totals()
+
+    assert merged == [{1: {"subscription_item_ids": ["si_1"], "subscription_current_period_start": 1700000000}}]
+    assert written == [("si_1", 5)]
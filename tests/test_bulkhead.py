@@ -0,0 +1,100 @@
+"""Bulkhead tests, including a load test against local stand-ins.
+
+Stripe is stood in by a blocking SDK call that takes 300ms; the DB by an
+async lookup that takes 5ms. Saturating Stripe must not slow down the
+DB-only /v1/balance/check endpoint.
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from app import balance, bulkhead, circuit, ratelimit
+from app.bulkhead import Bulkhead, BulkheadFull
+
+
+@pytest.mark.asyncio
+async def test_slot_queues_then_rejects():
+    b = Bulkhead("test", max_concurrent=1, max_queue=1)
+    release = asyncio.Event()
+
+    async def hold():
+        async with b.slot():
+            await release.wait()
+
+    first = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    second = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    with pytest.raises(BulkheadFull):
+        async with b.slot():
+            pass
+    release.set()
+    await asyncio.gather(first, second)
+    snap = b.snapshot()
+    assert snap["completed"] == 2 and snap["rejected"] == 1 and snap["peak_queued"] == 1
+
+
+@pytest.fixture
+def stand_ins(monkeypatch):
+    monkeypatch.setattr(bulkhead, "bulkheads", {
+        "stripe": Bulkhead("stripe", max_concurrent=4, max_queue=8, threads=4),
+        "admin": Bulkhead("admin", max_concurrent=4, max_queue=8),
+    })
+    monkeypatch.setattr(circuit, "breakers", {n: circuit.CircuitBreaker(n) for n in circuit.UPSTREAMS})
+    monkeypatch.setattr(ratelimit, "stripe_limiter", ratelimit.TokenBucket(0, 1))  # disabled
+
+    def slow_customer_list(**kwargs):
+        time.sleep(0.3)  # blocking, like the real SDK
+        return SimpleNamespace(data=[])
+
+    async def fast_user_data(email):
+        await asyncio.sleep(0.005)
+        return {"bot_balance_cents": 100}
+
+    monkeypatch.setattr(balance.stripe.Customer, "list", slow_customer_list)
+    monkeypatch.setattr(balance, "get_user_data", fast_user_data)
+
+
+@pytest.mark.asyncio
+async def test_stripe_saturation_does_not_stall_db_endpoints(stand_ins):
+    from app.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://billing") as client:
+        async def stripe_call():
+            return await client.post("/v1/stripe/bot-balance", json={"email": "a@example.com"})
+
+        async def db_call():
+            start = time.perf_counter()
+            resp = await client.post("/v1/balance/check", json={"email": "a@example.com", "product": "bot"})
+            return resp, time.perf_counter() - start
+
+        stripe_tasks = [asyncio.create_task(stripe_call()) for _ in range(40)]
+        await asyncio.sleep(0.02)  # let the Stripe pool fill up
+        db_results = await asyncio.gather(*(db_call() for _ in range(20)))
+        stripe_results = await asyncio.gather(*stripe_tasks)
+
+    assert all(resp.status_code == 200 for resp, _ in db_results)
+    assert max(latency for _, latency in db_results) < 0.15
+
+    codes = [resp.status_code for resp in stripe_results]
+    assert codes.count(200) == 12  # 4 running + 8 queued
+    assert codes.count(503) == 28  # shed immediately instead of piling up
+    assert bulkhead.bulkheads["stripe"].snapshot()["peak_active"] == 4
+
+
+@pytest.mark.asyncio
+async def test_abandoned_thread_call_holds_its_slot_until_it_returns(stand_ins):
+    from app.deadline import DeadlineExceeded, deadline_scope
+    from app.retry import with_retry
+
+    stripe_bulkhead = bulkhead.bulkheads["stripe"]
+    with deadline_scope(0.05):
+        with pytest.raises(DeadlineExceeded):
+            await with_retry(balance.stripe.Customer.list, label="stripe list customers")
+    assert stripe_bulkhead.active == 1  # the SDK call is still running on its thread
+    await asyncio.sleep(0.4)
+    assert stripe_bulkhead.active == 0 and stripe_bulkhead.completed == 1
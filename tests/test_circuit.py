@@ -0,0 +1,131 @@
+"""Tests for circuit breakers, the retry budget and server retry hints."""
+import httpx
+import pytest
+import stripe
+
+from app import circuit
+from app.circuit import CircuitBreaker, CircuitOpenError, RetryBudget
+from app.retry import _server_retry_hint, with_retry
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_half_opens_and_closes():
+    clock = _Clock()
+    b = CircuitBreaker("stripe", failure_threshold=2, reset_timeout=30, clock=clock)
+    b.before_call(); b.record_failure()
+    b.before_call(); b.record_failure()
+    assert b.state == "open"
+    with pytest.raises(CircuitOpenError):
+        b.before_call()
+
+    clock.now += 31
+    b.before_call()  # probe
+    assert b.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        b.before_call()  # only one probe at a time
+    b.record_success()
+    assert b.state == "closed"
+    assert b.snapshot()["transitions"] == {"closed->open": 1, "open->half_open": 1, "half_open->closed": 1}
+
+
+def test_failed_probe_reopens():
+    clock = _Clock()
+    b = CircuitBreaker("admin", failure_threshold=1, reset_timeout=5, clock=clock)
+    b.before_call(); b.record_failure()
+    clock.now += 6
+    b.before_call(); b.record_failure()
+    assert b.state == "open" and b.retry_after() == 5
+
+
+def test_retry_budget_caps_retries():
+    clock = _Clock()
+    budget = RetryBudget(ratio=0.5, min_per_window=1, window=10, clock=clock)
+    for _ in range(4):
+        budget.record_call()
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+    clock.now += 11
+    assert budget.try_spend()  # window rolled over → back to the floor
+
+
+def _http_error(status, headers):
+    request = httpx.Request("GET", "http://admin.test/x")
+    return httpx.HTTPStatusError("err", request=request, response=httpx.Response(status, headers=headers, request=request))
+
+
+def test_server_retry_hints():
+    assert _server_retry_hint(_http_error(429, {"Retry-After": "3"})) == (None, 3.0)
+    err = stripe.error.APIError("conflict", http_status=409, headers={"Stripe-Should-Retry": "true"})
+    assert _server_retry_hint(err) == (True, None)
+    assert _server_retry_hint(ValueError("x")) == (None, None)
+
+
+@pytest.fixture
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(circuit, "breakers", {n: CircuitBreaker(n, failure_threshold=2) for n in circuit.UPSTREAMS})
+    monkeypatch.setattr(circuit, "retry_budget", RetryBudget(min_per_window=100))
+    return circuit.breakers
+
+
+@pytest.mark.asyncio
+async def test_open_breaker_fails_fast_without_calling(fresh_breakers):
+    calls = 0
+
+    async def down():
+        nonlocal calls
+        calls += 1
+        raise httpx.ConnectError("refused")
+
+    with pytest.raises(httpx.ConnectError):
+        await with_retry(down, max_retries=3, base_delay=0.001, label="admin GET /admin/users")
+    assert calls == 2  # breaker opened after the second failure
+    with pytest.raises(CircuitOpenError):
+        await with_retry(down, label="admin GET /admin/users")
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_client_errors_do_not_trip_breaker(fresh_breakers):
+    async def bad_request():
+        raise _http_error(400, {})
+
+    for _ in range(3):
+        with pytest.raises(httpx.HTTPStatusError):
+            await with_retry(bad_request, label="admin POST /admin/users")
+    assert fresh_breakers["admin"].state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_should_retry_false_wins_over_status(fresh_breakers):
+    calls = 0
+
+    async def declined():
+        nonlocal calls
+        calls += 1
+        raise stripe.error.APIError("boom", http_status=500, headers={"Stripe-Should-Retry": "false"})
+
+    with pytest.raises(stripe.error.APIError):
+        await with_retry(declined, base_delay=0.001, label="test")
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_exhausted_budget_stops_retries(monkeypatch, fresh_breakers):
+    monkeypatch.setattr(circuit, "retry_budget", RetryBudget(ratio=0, min_per_window=0))
+    calls = 0
+
+    async def flaky():
+        nonlocal calls
+        calls += 1
+        raise httpx.TimeoutException("timeout")
+
+    with pytest.raises(httpx.TimeoutException):
+        await with_retry(flaky, base_delay=0.001, label="test")
+    assert calls == 1
@@ -0,0 +1,70 @@
+"""Tests for the bulk JSONB patch helper (no database — session is faked)."""
+import json
+
+import pytest
+
+from app import db
+
+
+class _FakeResult:
+    returns_rows = True
+
+    def __init__(self, ids):
+        self._ids = ids
+
+    def mappings(self):
+        return self
+
+    def all(self):
+        return [{"id": i} for i in self._ids]
+
+
+class _FakeSession:
+    def __init__(self, known_ids):
+        self.known_ids = set(known_ids)
+        self.calls = []
+        self.commits = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt, params):
+        self.calls.append(params)
+        return _FakeResult([i for i in params.get("ids", []) if i in self.known_ids])
+
+    async def commit(self):
+        self.commits += 1
+
+
+def test_chunks_split_evenly():
+    items = [(i, {}) for i in range(5)]
+    assert [len(c) for c in db._chunks(items, 2)] == [2, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_bulk_merge_one_statement_per_chunk(monkeypatch):
+    session = _FakeSession(known_ids=range(10))
+    monkeypatch.setattr(db, "get_session", lambda: session)
+
+    patches = {i: {"bot_balance_cents": i * 10} for i in range(10)}
+    updated = await db.merge_user_data_bulk(patches, chunk_size=4)
+
+    merges = [c for c in session.calls if "patches" in c]
+    assert len(merges) == 3
+    assert session.commits == 1
+    assert sorted(updated) == list(range(10))
+    assert json.loads(merges[0]["patches"][1]) == {"bot_balance_cents": 10}
+
+
+@pytest.mark.asyncio
+async def test_bulk_merge_skips_unknown_and_empty(monkeypatch):
+    session = _FakeSession(known_ids=[1])
+    monkeypatch.setattr(db, "get_session", lambda: session)
+
+    assert await db.merge_user_data_bulk({}) == []
+    assert session.calls == []
+    assert await db.merge_user_data_bulk({1: {"a": 1}, 2: {"a": 2}}) == [1]
+
@@ -0,0 +1,27 @@
+"""Tests for connection-mode detection and the named query registry."""
+from app import db
+
+
+def test_connection_mode_detects_pgbouncer(monkeypatch):
+    monkeypatch.delenv("DB_CONNECTION_MODE", raising=False)
+    assert db._connection_mode("postgresql+asyncpg://u:p@db.internal:5432/vexa") == "direct"
+    assert db._connection_mode("postgresql+asyncpg://u:p@db.internal:6432/vexa") == "pgbouncer"
+    assert db._connection_mode("postgresql+asyncpg://u:p@pgbouncer:5432/vexa") == "pgbouncer"
+
+
+def test_connection_mode_override(monkeypatch):
+    monkeypatch.setenv("DB_CONNECTION_MODE", "pgbouncer")
+    assert db._connection_mode("postgresql+asyncpg://u:p@db.internal:5432/vexa") == "pgbouncer"
+
+
+def test_query_stats_histogram():
+    stats = db.QueryStats()
+    stats.observe(0.5, rows=1)
+    stats.observe(30, rows=2)
+    stats.observe(10_000, rows=0)
+    snap = stats.snapshot()
+    assert snap["calls"] == 3
+    assert snap["rows"] == 3
+    assert snap["histogram"]["le_1ms"] == 1
+    assert snap["histogram"]["le_50ms"] == 1
+    assert snap["histogram"]["gt_2500ms"] == 1
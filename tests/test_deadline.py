@@ -0,0 +1,84 @@
+"""Tests for request deadlines and how retries honor them."""
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app import deadline
+from app.deadline import DeadlineExceeded, deadline_scope, route_budget
+from app.retry import with_retry
+
+
+def test_route_budget_uses_tighter_of_header_and_default():
+    assert route_budget("/v1/balance/check", None) == 3.0
+    assert route_budget("/v1/balance/check", "500") == 0.5
+    assert route_budget("/v1/balance/check", "60000") == 3.0
+    assert route_budget("/v1/other", "garbage") == deadline.REQUEST_DEADLINE_SECONDS
+
+
+def test_nested_scope_only_tightens():
+    with deadline_scope(10):
+        with deadline_scope(60):
+            assert deadline.remaining() <= 10
+    assert deadline.remaining() is None
+
+
+@pytest.mark.asyncio
+async def test_retry_not_attempted_when_backoff_overruns_deadline():
+    calls = 0
+
+    async def flaky():
+        nonlocal calls
+        calls += 1
+        raise httpx.TimeoutException("timeout")
+
+    with deadline_scope(0.2):
+        with pytest.raises(DeadlineExceeded):
+            await with_retry(flaky, base_delay=1.0, label="test")
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_safe_call_is_clipped_to_budget():
+    async def hangs():
+        await asyncio.sleep(5)
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    with deadline_scope(0.1):
+        with pytest.raises(DeadlineExceeded):
+            await with_retry(hangs, label="test")
+    assert loop.time() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_single_shot_write_is_never_abandoned():
+    done = []
+
+    async def write():
+        await asyncio.sleep(0.15)
+        done.append(True)
+        return "written"
+
+    with deadline_scope(0.05):
+        assert await with_retry(write, max_retries=0, label="test") == "written"
+    assert done == [True]
+
+
+@pytest.mark.asyncio
+async def test_no_call_after_deadline():
+    calls = []
+    with deadline_scope(0):
+        with pytest.raises(DeadlineExceeded):
+            await with_retry(lambda: calls.append(1), label="test")
+    assert calls == []
+
+
+def test_expired_budget_rejected_with_504():
+    from app.main import app
+
+    client = TestClient(app)
+    assert client.get("/").status_code == 200
+    resp = client.get("/", headers={"X-Request-Timeout-Ms": "0"})
+    assert resp.status_code == 504
@@ -0,0 +1,59 @@
+"""Tests that read paths never create Stripe customers."""
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import context, main
+
+
+@pytest.fixture
+def stripe_calls(monkeypatch):
+    calls = []
+
+    def fake_list(**kwargs):
+        calls.append("Customer.list")
+        return SimpleNamespace(data=[])
+
+    def fake_create(**kwargs):
+        calls.append("Customer.create")
+        return SimpleNamespace(id="cus_new", email=kwargs["email"])
+
+    def fake_checkout(**kwargs):
+        calls.append(f"checkout.Session.create:{kwargs['customer']}")
+        return SimpleNamespace(url="https://checkout.stripe.com/c/1")
+
+    def unexpected(**kwargs):
+        raise AssertionError("no Stripe lookups expected without a customer")
+
+    monkeypatch.setattr(context.stripe.Customer, "list", fake_list)
+    monkeypatch.setattr(context.stripe.Customer, "create", fake_create)
+    monkeypatch.setattr(context.stripe.Subscription, "list", unexpected)
+    monkeypatch.setattr(context.stripe.PaymentMethod, "list", unexpected)
+    monkeypatch.setattr(context.stripe.checkout.Session, "create", fake_checkout)
+    return calls
+
+
+def test_pricing_redirect_creates_no_customer(stripe_calls):
+    client = TestClient(main.app)
+    resp = client.post("/v1/stripe/resolve-url", json={
+        "email": "visitor@example.com", "context": "pricing", "origin": "https://w",
+    })
+    assert resp.json() == {"url": "https://w/pricing"}
+    assert stripe_calls == ["Customer.list"]
+
+
+def test_portal_without_customer_goes_to_pricing(stripe_calls):
+    client = TestClient(main.app)
+    resp = client.post("/v1/portal/session", json={"email": "visitor@example.com"})
+    assert resp.json()["url"].endswith("/pricing")
+    assert "Customer.create" not in stripe_calls
+
+
+def test_checkout_creates_customer_on_demand(stripe_calls):
+    client = TestClient(main.app)
+    resp = client.post("/v1/stripe/resolve-url", json={
+        "email": "buyer@example.com", "context": "pricing", "plan_type": "bot_service",
+    })
+    assert resp.json() == {"url": "https://checkout.stripe.com/c/1"}
+    assert stripe_calls[-2:] == ["Customer.create", "checkout.Session.create:cus_new"]
@@ -0,0 +1,81 @@
+"""Tests for dirty-user marking on writes that can flip enforcement."""
+import pytest
+
+from app import db
+
+
+class _FakeResult:
+    returns_rows = True
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def mappings(self):
+        return self
+
+    def all(self):
+        return self._rows
+
+
+class _FakeSession:
+    """Records statements; every UPDATE matches the IDs it was given."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, stmt, params):
+        self.calls.append(params)
+        if "ids" in params:
+            return _FakeResult([{"id": i} for i in params["ids"]])
+        if "user_id" in params:
+            return _FakeResult([{"id": params["user_id"]}])
+        return _FakeResult([])
+
+    async def commit(self):
+        pass
+
+    def dirty_marks(self):
+        return [c["user_ids"] for c in self.calls if "user_ids" in c]
+
+
+@pytest.fixture
+def session(monkeypatch):
+    fake = _FakeSession()
+    monkeypatch.setattr(db, "get_session", lambda: fake)
+    monkeypatch.setattr(db, "_schema_ready", True)
+    return fake
+
+
+def test_touches_enforcement():
+    assert db._touches_enforcement({"bot_balance_cents": 0})
+    assert db._touches_enforcement({"subscription_status": "canceled", "x": 1})
+    assert not db._touches_enforcement({"tx_balance_minutes": 10})
+
+
+@pytest.mark.asyncio
+async def test_bulk_balance_writes_mark_users_dirty(session):
+    await db.merge_user_data_bulk({1: {"bot_balance_cents": 0}, 2: {"tx_balance_minutes": 5}})
+    assert session.dirty_marks() == [[1]]
+
+
+@pytest.mark.asyncio
+async def test_single_write_marks_dirty_only_when_relevant(session):
+    await db.merge_user_data_by_id(7, {"tx_balance_minutes": 5})
+    assert session.dirty_marks() == []
+    await db.merge_user_data_by_id(7, {"bot_topup_enabled": False})
+    assert session.dirty_marks() == [[7]]
+
+
+@pytest.mark.asyncio
+async def test_missing_schema_skips_aux_writes_but_commits_update(monkeypatch, session):
+    monkeypatch.setattr(db, "_schema_ready", False)
+    await db.merge_user_data_by_id(7, {"bot_balance_cents": 0, "stripe_customer_id": "cus_7"})
+    assert session.dirty_marks() == []
+    assert [c for c in session.calls if "customer_ids" in c] == []
+    assert session.calls == [{"user_id": 7, "patch": session.calls[0]["patch"]}]
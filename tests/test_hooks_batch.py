@@ -0,0 +1,102 @@
+"""Tests for the batch meeting-completed hook."""
+from types import SimpleNamespace
+
+import pytest
+import stripe
+from fastapi.testclient import TestClient
+
+from app import hooks, main
+
+HOUR = 3600
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    """Fake DB + Stripe; records bulk increments and usage records."""
+    state = SimpleNamespace(increments=[], usage=[], totals=[], balances={"a@example.com": 1000, "b@example.com": 50})
+
+    async def fake_increment(increments):
+        state.increments.append(increments)
+        rows = {}
+        for email, deltas in increments.items():
+            if email in state.balances:
+                state.balances[email] += deltas["bot_balance_cents"]
+                rows[email] = {"id": 1, "email": email, "max_concurrent_bots": 1, "data": {
+                    "bot_balance_cents": state.balances[email],
+                    "stripe_customer_id": f"cus_{email[0]}",
+                }}
+        return rows
+
+    def fake_subs(customer, **kwargs):
+        if customer != "cus_a":
+            return SimpleNamespace(data=[])
+        return SimpleNamespace(data=[{"id": "sub_a", "items": {"data": [{"id": "si_a", "price": {"id": "price_bot"}}]}}])
+
+    def fake_usage(item_id, **kwargs):
+        state.usage.append((item_id, kwargs["quantity"], kwargs["idempotency_key"]))
+
+    async def fake_total(sub, item, quantity):
+        state.totals.append((item["id"], quantity))
+
+    monkeypatch.setattr(hooks, "increment_user_data_bulk_by_email", fake_increment)
+    monkeypatch.setattr(hooks, "get_price_id", lambda tier: "price_bot")
+    monkeypatch.setattr(hooks, "record_usage_total", fake_total)
+    monkeypatch.setattr(stripe.Subscription, "list", fake_subs)
+    monkeypatch.setattr(stripe.SubscriptionItem, "create_usage_record", fake_usage)
+    state.post = lambda meetings: TestClient(main.app).post("/v1/hooks/meetings-completed", json={"meetings": meetings})
+    return state
+
+
+def test_one_transaction_and_one_usage_record_per_item(batch):
+    body = batch.post([
+        {"id": 1, "user_email": "a@example.com", "duration_seconds": HOUR, "transcription_enabled": True},
+        {"id": 2, "user_email": "b@example.com", "duration_seconds": HOUR},
+        {"id": 3, "user_email": "a@example.com", "duration_seconds": HOUR / 2},
+    ]).json()
+
+    assert batch.increments == [{
+        "a@example.com": {"bot_balance_cents": -55, "bot_monthly_spent_cents": 55},
+        "b@example.com": {"bot_balance_cents": -30, "bot_monthly_spent_cents": 30},
+    }]
+    assert [(item, quantity) for item, quantity, _ in batch.usage] == [("si_a", 90)]
+    assert batch.totals == [("si_a", 90)]
+
+    results = body["results"]
+    assert body["processed"] == 3
+    assert [r["meeting_id"] for r in results] == [1, 2, 3]
+    assert [r["total_cost_cents"] for r in results] == [40, 30, 15]
+    # Running balances, as if the meetings had been billed one at a time
+    assert [r["new_balance_cents"] for r in results] == [960, 20, 945]
+    assert [r["stripe_reported"] for r in results] == [True, False, True]
+    assert results[1]["stripe_reason"] == "no active bot_service subscription"
+
+
+def test_retried_batch_reuses_the_usage_idempotency_key(batch):
+    meetings = [
+        {"id": 7, "user_email": "a@example.com", "duration_seconds": 600},
+        {"id": 8, "user_email": "a@example.com", "duration_seconds": 600},
+    ]
+    batch.post(meetings)
+    batch.post(list(reversed(meetings)))
+    assert batch.usage[0][2] is not None
+    assert batch.usage[0][2] == batch.usage[1][2]
+
+
+def test_invalid_and_unknown_meetings_are_reported_per_item(batch):
+    body = batch.post([
+        {"id": 1, "user_email": "a@example.com", "duration_seconds": 0},
+        {"id": 2, "duration_seconds": 60},
+        {"id": 3, "user_email": "nobody@example.com", "duration_seconds": 60},
+    ]).json()
+    results = body["results"]
+    assert body["processed"] == 1 and body["skipped"] == 2
+    assert results[0]["skipped"] and results[1]["skipped"]
+    assert results[2]["balance_deducted"] is False
+    assert results[2]["balance_error"] == "user not found"
+
+
+def test_oversized_batch_is_rejected(monkeypatch, batch):
+    monkeypatch.setattr(hooks, "MAX_MEETINGS_PER_BATCH", 1)
+    resp = batch.post([{"id": i, "user_email": "a@example.com", "duration_seconds": 60} for i in range(2)])
+    assert resp.status_code == 413
+    assert batch.increments == []
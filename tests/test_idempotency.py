@@ -0,0 +1,111 @@
+"""Tests for Idempotency-Key replay of mutating requests."""
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from app import balance, idempotency, main
+from app.bulkhead import BulkheadFull
+
+DEDUCT = {"email": "a@example.com", "product": "bot", "amount": 30}
+
+
+@pytest.fixture
+def deducts(monkeypatch):
+    """Fresh store, in-memory balance; returns the list of writes made."""
+    writes = []
+    state = {"balance": 1000}
+
+    async def get_user_data(email):
+        await asyncio.sleep(0.05)
+        return {"bot_balance_cents": state["balance"]}
+
+    async def merge_user_data(email, patch):
+        writes.append(patch)
+        state["balance"] = patch["bot_balance_cents"]
+
+    monkeypatch.setattr(main, "idempotency", idempotency.IdempotencyStore(paths=["/v1/balance/deduct"]))
+    monkeypatch.setattr(idempotency, "DATABASE_URL", None)
+    monkeypatch.setattr(balance, "get_user_data", get_user_data)
+    monkeypatch.setattr(balance, "merge_user_data", merge_user_data)
+    return writes
+
+
+def _post(client, body, key="k1"):
+    return client.post("/v1/balance/deduct", json=body, headers={"Idempotency-Key": key} if key else {})
+
+
+def test_retry_replays_stored_response(deducts):
+    client = TestClient(main.app)
+    first = _post(client, DEDUCT)
+    second = _post(client, DEDUCT)
+
+    assert first.json() == second.json() == {"new_balance": 970, "product": "bot"}
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert len(deducts) == 1
+
+
+def test_requests_without_a_key_run_every_time(deducts):
+    client = TestClient(main.app)
+    _post(client, DEDUCT, key=None)
+    _post(client, DEDUCT, key=None)
+    assert len(deducts) == 2
+
+
+def test_key_reused_with_different_body_is_rejected(deducts):
+    client = TestClient(main.app)
+    _post(client, DEDUCT)
+    resp = _post(client, {**DEDUCT, "amount": 99})
+    assert resp.status_code == 422
+    assert len(deducts) == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicates_collapse_onto_one_execution(deducts):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = await asyncio.gather(*(
+            client.post("/v1/balance/deduct", json=DEDUCT, headers={"Idempotency-Key": "same"}) for _ in range(3)
+        ))
+    assert [r.json()["new_balance"] for r in responses] == [970, 970, 970]
+    assert len(deducts) == 1
+
+
+def test_server_errors_are_not_stored(monkeypatch, deducts):
+    async def saturated(email):
+        raise BulkheadFull("db")
+
+    monkeypatch.setattr(balance, "get_user_data", saturated)
+    client = TestClient(main.app)
+    assert _post(client, DEDUCT).status_code == 503
+    assert main.idempotency.stats()["entries"] == 0
+
+
+def test_response_stored_by_another_replica_is_replayed(monkeypatch, deducts):
+    rows = {}
+
+    async def claim(key, fingerprint, lease):
+        return rows.get("row")
+
+    monkeypatch.setattr(idempotency, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(idempotency.db, "schema_ready", lambda: True)
+    monkeypatch.setattr(idempotency.db, "claim_idempotency_key", claim)
+    client = TestClient(main.app)
+
+    rows["row"] = {"fingerprint": "x", "status_code": None}
+    resp = _post(client, DEDUCT)
+    assert resp.status_code == 409 and resp.headers["Retry-After"] == "1"
+
+    # Completed elsewhere: replayed without running the handler
+    body = httpx.Request("POST", "http://test", json=DEDUCT).read()
+    rows["row"] = {
+        "fingerprint": idempotency.fingerprint("POST", "/v1/balance/deduct", "", body),
+        "status_code": 200, "body": b'{"new_balance":1,"product":"bot"}',
+        "headers": {"content-type": "application/json"}, "expires_at": 9e9,
+    }
+    resp = client.post("/v1/balance/deduct", content=body, headers={"Idempotency-Key": "k1", "content-type": "application/json"})
+    assert resp.json() == {"new_balance": 1, "product": "bot"}
+    assert resp.headers["Idempotent-Replayed"] == "true"
+    assert deducts == []
@@ -0,0 +1,40 @@
+"""Tests for the email → Admin API user ID identity map."""
+import httpx
+import pytest
+
+from app import admin, identity
+
+
+@pytest.fixture(autouse=True)
+def _clean_cache():
+    identity._cache.clear()
+    yield
+    identity._cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_upsert_only_on_miss(monkeypatch):
+    calls = []
+
+    async def fake_admin_request(method, path, json_body=None):
+        calls.append((method, path))
+        return httpx.Response(201, json={"id": 42, "max_concurrent_bots": 3})
+
+    monkeypatch.setattr(admin, "admin_request", fake_admin_request)
+
+    assert await identity.lookup_user_id("a@example.com") is None
+    user_id, payload = await identity.upsert_user("a@example.com")
+    assert user_id == 42
+    assert payload["max_concurrent_bots"] == 3
+    assert await identity.lookup_user_id("a@example.com") == 42
+    assert calls == [("POST", "/admin/users")]
+
+
+def test_lru_evicts_oldest(monkeypatch):
+    monkeypatch.setattr(identity, "_MAX_ENTRIES", 2)
+    identity.remember("a@example.com", 1)
+    identity.remember("b@example.com", 2)
+    identity.remember("c@example.com", 3)
+    assert "a@example.com" not in identity._cache
+    identity.forget("b@example.com")
+    assert list(identity._cache) == ["c@example.com"]
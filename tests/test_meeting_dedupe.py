@@ -0,0 +1,160 @@
+"""Tests for meeting-ID dedupe in the meeting-completed hooks."""
+from types import SimpleNamespace
+
+import pytest
+import stripe
+from fastapi.testclient import TestClient
+
+from app import hooks, main
+
+
+@pytest.fixture
+def table(monkeypatch):
+    """In-memory billing_processed_meetings plus recorded balance writes and Stripe calls."""
+    state = SimpleNamespace(
+        rows={}, deductions=[], increments=[], stripe_calls=0, fail_balance=False, fail_stripe=False,
+    )
+
+    async def claim(claims, stale_after=0):
+        owned = {}
+        for key in claims:
+            row = state.rows.get(key)
+            if row is None:
+                state.rows[key] = {"result": None, "deducted": False, "in_flight": True, "completed": False}
+                owned[key] = None
+            elif not row["completed"] and not row["in_flight"]:
+                row["in_flight"] = True
+                owned[key] = row["result"] if row["deducted"] else None
+        return owned
+
+    async def results(keys):
+        return {key: state.rows[key]["result"] for key in keys if key in state.rows and state.rows[key]["completed"]}
+
+    async def save(results, completed):
+        for key, result in results.items():
+            state.rows[key] = {"result": result, "deducted": True, "in_flight": False, "completed": key in completed}
+
+    async def release(keys):
+        for key in keys:
+            if key in state.rows and not state.rows[key]["deducted"]:
+                del state.rows[key]
+
+    async def get_user(email):
+        return {"id": 1, "email": email, "data": {"bot_balance_cents": 1000}}
+
+    async def deduct(user_id, increments):
+        if state.fail_balance:
+            raise RuntimeError("db down")
+        state.deductions.append(increments)
+        return {"id": user_id, "data": {"bot_balance_cents": 1000 + increments["bot_balance_cents"]}}
+
+    async def increment(increments):
+        state.increments.append(increments)
+        return {email: {"id": 1, "email": email, "data": {"bot_balance_cents": 1000 + d["bot_balance_cents"]}}
+                for email, d in increments.items()}
+
+    def subs(**kwargs):
+        state.stripe_calls += 1
+        if state.fail_stripe:
+            raise RuntimeError("stripe down")
+        return SimpleNamespace(data=[])
+
+    async def no_customer(email, user_data=None):
+        return "cus_1"
+
+    monkeypatch.setattr(hooks, "schema_ready", lambda: True)
+    monkeypatch.setattr(hooks, "BALANCE_WRITE_BEHIND", False)
+    monkeypatch.setattr(hooks, "claim_meetings", claim)
+    monkeypatch.setattr(hooks, "processed_meeting_results", results)
+    monkeypatch.setattr(hooks, "save_meeting_results", save)
+    monkeypatch.setattr(hooks, "release_meetings", release)
+    monkeypatch.setattr(hooks, "get_user_by_email", get_user)
+    monkeypatch.setattr(hooks, "increment_user_data", deduct)
+    monkeypatch.setattr(hooks, "increment_user_data_bulk_by_email", increment)
+    monkeypatch.setattr(hooks, "find_customer_id", no_customer)
+    monkeypatch.setattr(stripe.Subscription, "list", subs)
+    client = TestClient(main.app)
+    state.single_response = lambda meeting: client.post("/v1/hooks/meeting-completed", json={"meeting": meeting})
+    state.single = lambda meeting: state.single_response(meeting).json()
+    state.batch_response = lambda meetings: client.post("/v1/hooks/meetings-completed", json={"meetings": meetings})
+    state.batch = lambda meetings: state.batch_response(meetings).json()
+    return state
+
+
+MEETING = {"id": 42, "user_email": "a@example.com", "duration_seconds": 3600}
+
+
+def test_duplicate_delivery_returns_stored_result(table):
+    first = table.single(MEETING)
+    second = table.single(MEETING)
+
+    assert first["balance_deducted"] is True and "duplicate" not in first
+    assert second == {**first, "duplicate": True}
+    assert len(table.deductions) == 1
+    assert table.stripe_calls == 1
+    assert table.rows["42"]["result"]["new_balance_cents"] == 970
+
+
+def test_failed_deduction_releases_the_claim(table):
+    table.fail_balance = True
+    assert table.single(MEETING)["balance_deducted"] is False
+    assert "42" not in table.rows
+
+    table.fail_balance = False
+    assert table.single(MEETING)["balance_deducted"] is True
+    assert len(table.deductions) == 1
+
+
+def test_in_flight_claim_is_retryable(table):
+    table.rows["42"] = {"result": None, "deducted": False, "in_flight": True, "completed": False}
+    resp = table.single_response(MEETING)
+    assert resp.status_code == 409 and resp.headers["Retry-After"]
+    assert table.deductions == [] and table.stripe_calls == 0
+
+
+def test_unreported_usage_is_retried_without_a_second_deduction(table):
+    table.fail_stripe = True
+    first = table.single(MEETING)
+    assert first["balance_deducted"] is True and first["stripe_reported"] is False
+    assert table.rows["42"]["completed"] is False
+
+    table.fail_stripe = False
+    second = table.single(MEETING)
+    assert "duplicate" not in second
+    assert second["new_balance_cents"] == 970 and second["stripe_reason"]
+    assert len(table.deductions) == 1
+    assert table.rows["42"]["completed"] is True
+    assert table.single(MEETING)["duplicate"] is True
+
+
+def test_batch_skips_meetings_billed_by_the_single_hook(table):
+    table.single(MEETING)
+    body = table.batch([MEETING, {**MEETING, "id": 43}, {**MEETING, "id": 43}])
+
+    assert body["processed"] == 1 and body["duplicates"] == 1 and body["skipped"] == 1 and body["in_progress"] == 0
+    assert body["results"][0]["duplicate"] is True
+    assert body["results"][2]["reason"] == "duplicate meeting in batch"
+    assert table.increments == [{"a@example.com": {"bot_balance_cents": -30, "bot_monthly_spent_cents": 30}}]
+    assert table.rows["43"]["result"]["balance_deducted"] is True
+
+
+def test_batch_with_an_in_flight_meeting_asks_for_a_resend(table):
+    table.rows["42"] = {"result": None, "deducted": False, "in_flight": True, "completed": False}
+    resp = table.batch_response([MEETING, {**MEETING, "id": 43}])
+    assert resp.status_code == 409
+    assert resp.json()["in_progress"] == 1
+    assert table.rows["43"]["completed"] is True
+
+
+def test_batch_budget_scales_with_users():
+    assert hooks._batch_budget(1000) > hooks._batch_budget(1) >= hooks.REQUEST_DEADLINE_SECONDS
+
+
+def test_batch_out_of_time_keeps_unreported_meetings_open(monkeypatch, table):
+    monkeypatch.setattr(hooks, "_batch_budget", lambda users: 0.0)
+    body = table.batch([MEETING])
+
+    assert body["results"][0]["balance_deducted"] is True
+    assert "deadline" in body["results"][0]["stripe_error"]
+    assert table.stripe_calls == 0
+    assert table.rows["42"]["deducted"] is True and table.rows["42"]["completed"] is False
@@ -0,0 +1,97 @@
+"""Tests for the request-scoped read memo."""
+import contextlib
+
+import pytest
+
+from app import db, memo, webhook
+from app.memo import memoized, request_memo
+
+
+@pytest.mark.asyncio
+async def test_repeat_reads_in_a_request_cost_nothing():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return {"id": "cus_1", "invoice_settings": {}}
+
+    with request_memo() as m:
+        first = await memoized("stripe_customer", "cus_1", fetch)
+        first["invoice_settings"]["x"] = 1  # callers can't corrupt the memo
+        second = await memoized("stripe_customer", "cus_1", fetch)
+    assert calls == [1]
+    assert second == {"id": "cus_1", "invoice_settings": {}}
+    assert m.saved_calls == 1
+
+    await memoized("stripe_customer", "cus_1", fetch)  # no request → no memo
+    assert calls == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_missing_values_are_not_memoized_and_writes_invalidate():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return None if len(calls) == 1 else {"v": len(calls)}
+
+    with request_memo():
+        assert await memoized("user", "a", fetch) is None
+        assert await memoized("user", "a", fetch) == {"v": 2}
+        memo.invalidate("user", "a")
+        assert await memoized("user", "a", fetch) == {"v": 3}
+        memo.put("user", "a", {"v": "written"})
+        assert await memoized("user", "a", fetch) == {"v": "written"}
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_user_write_then_read_uses_returned_row(monkeypatch):
+    queries = []
+
+    @contextlib.asynccontextmanager
+    async def fake_session():
+        class _S:
+            async def commit(self):
+                pass
+        yield _S()
+
+    async def fake_run_query(session, name, params=None):
+        queries.append(name)
+        return [{"id": 7, "email": "a@example.com", "data": {"bot_balance_cents": 5}, "max_concurrent_bots": 1}]
+
+    monkeypatch.setattr(db, "get_session", fake_session)
+    monkeypatch.setattr(db, "run_query", fake_run_query)
+    with request_memo():
+        await db.merge_user_data("a@example.com", {"bot_balance_cents": 5})
+        assert (await db.get_user_data("a@example.com")) == {"bot_balance_cents": 5}
+    assert queries == ["merge_user_data"]
+
+
+@pytest.mark.asyncio
+async def test_webhook_retrieves_customer_once(monkeypatch):
+    retrieves = []
+
+    def fake_retrieve(cust_id, **kwargs):
+        retrieves.append(cust_id)
+        return {"email": "a@example.com", "invoice_settings": {"default_payment_method": "pm_1"}}
+
+    async def no_index(cust_id):
+        return None
+
+    async def fake_apply(patch, max_bots, preserve_higher=False, user_id=None, email=None):
+        assert patch["stripe_payment_method_id"] == "pm_1"
+        return {"id": 1}
+
+    monkeypatch.setattr(webhook.stripe.Customer, "retrieve", fake_retrieve)
+    monkeypatch.setattr(webhook, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(webhook, "ENTITLEMENT_WRITE_MODE", "direct")
+    monkeypatch.setattr(db, "get_user_by_customer_id", no_index)
+    monkeypatch.setattr(db, "apply_entitlements", fake_apply)
+
+    sub = {"id": "sub_1", "customer": "cus_1", "status": "active", "items": {"data": []}, "metadata": {"tier": "individual"}}
+    with request_memo() as m:
+        email, user_id = await webhook._resolve_user(sub)
+        await webhook._sync_entitlements(email, sub, user_id)
+    assert retrieves == ["cus_1"]
+    assert m.hits["stripe_customer"] == 1
@@ -0,0 +1,57 @@
+"""Tests for the cached default-payment-method resolver."""
+from types import SimpleNamespace
+
+import pytest
+
+from app import payment_methods
+from app.payment_methods import payment_method_patch, resolve_default_payment_method
+
+
+@pytest.fixture
+def stripe_calls(monkeypatch):
+    calls = []
+
+    def retrieve(customer_id, **kwargs):
+        calls.append("Customer.retrieve")
+        return {"id": customer_id, "invoice_settings": {"default_payment_method": None}, "default_source": None}
+
+    def list_pms(**kwargs):
+        calls.append("PaymentMethod.list")
+        return SimpleNamespace(data=[SimpleNamespace(id="pm_card")])
+
+    def modify(customer_id, **kwargs):
+        calls.append(f"Customer.modify:{kwargs['invoice_settings']['default_payment_method']}")
+        return {"id": customer_id}
+
+    monkeypatch.setattr(payment_methods.stripe.Customer, "retrieve", retrieve)
+    monkeypatch.setattr(payment_methods.stripe.PaymentMethod, "list", list_pms)
+    monkeypatch.setattr(payment_methods.stripe.Customer, "modify", modify)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_cached_value_needs_no_stripe_calls(stripe_calls):
+    assert await resolve_default_payment_method("cus_1", {"stripe_payment_method_id": "pm_1"}) == "pm_1"
+    assert stripe_calls == []
+
+
+@pytest.mark.asyncio
+async def test_falls_back_to_latest_card_and_makes_it_default(stripe_calls):
+    assert await resolve_default_payment_method("cus_1", {}) == "pm_card"
+    assert stripe_calls == ["Customer.retrieve", "PaymentMethod.list", "Customer.modify:pm_card"]
+
+
+def test_webhook_patches():
+    card = {"id": "pm_2", "type": "card", "customer": "cus_1"}
+    assert payment_method_patch("payment_method.attached", card, {}, None) == {"stripe_payment_method_id": "pm_2"}
+    assert payment_method_patch("payment_method.attached", card, {}, "pm_1") is None
+    detached = {"id": "pm_1", "customer": None}
+    assert payment_method_patch("payment_method.detached", detached, {"customer": "cus_1"}, "pm_1") == {
+        "stripe_payment_method_id": None,
+    }
+    assert payment_method_patch("payment_method.detached", detached, {"customer": "cus_1"}, "pm_9") is None
+    customer = {"id": "cus_1", "invoice_settings": {"default_payment_method": "pm_3"}}
+    assert payment_method_patch("customer.updated", customer, {"invoice_settings": {}}, "pm_1") == {
+        "stripe_payment_method_id": "pm_3",
+    }
+    assert payment_method_patch("customer.updated", customer, {"email": "old@example.com"}, "pm_1") is None
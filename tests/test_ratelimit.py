@@ -0,0 +1,72 @@
+"""Tests for the Stripe token bucket and its priority lanes."""
+import asyncio
+
+import pytest
+
+from app.ratelimit import TokenBucket, current_lane, stripe_lane
+
+
+@pytest.mark.asyncio
+async def test_burst_then_throttle():
+    bucket = TokenBucket(rate=100, burst=3)
+    for _ in range(3):
+        assert await bucket.acquire("interactive") == 0.0
+    waited = await bucket.acquire("interactive")
+    assert waited > 0
+    stats = bucket.snapshot()["lanes"]["interactive"]
+    assert stats["acquired"] == 4
+    assert stats["throttled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_interactive_preempts_background():
+    bucket = TokenBucket(rate=50, burst=1)
+    await bucket.acquire("interactive")  # drain
+    order = []
+
+    async def take(lane, tag):
+        await bucket.acquire(lane)
+        order.append(tag)
+
+    background = [asyncio.create_task(take("background", f"bg{i}")) for i in range(3)]
+    await asyncio.sleep(0)
+    interactive = asyncio.create_task(take("interactive", "ui"))
+    await asyncio.gather(interactive, *background)
+    assert order[0] == "ui"
+
+
+@pytest.mark.asyncio
+async def test_background_leaves_reserve_for_interactive():
+    bucket = TokenBucket(rate=1, burst=10)
+    # background may only use 7 of 10 tokens immediately (30% reserve)
+    for _ in range(7):
+        assert await bucket.acquire("background") == 0.0
+    assert await bucket.acquire("interactive") == 0.0
+
+
+@pytest.mark.asyncio
+async def test_disabled_bucket_never_waits():
+    bucket = TokenBucket(rate=0, burst=0)
+    for _ in range(100):
+        assert await bucket.acquire("background") == 0.0
+
+
+def test_lane_context():
+    assert current_lane() == "interactive"
+    with stripe_lane("background"):
+        assert current_lane() == "background"
+    assert current_lane() == "interactive"
+    with pytest.raises(ValueError):
+        with stripe_lane("bogus"):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_lower_lanes_not_starved_by_tiny_bucket():
+    # burst=1 leaves no room for a reserve — lower lanes must still progress
+    bucket = TokenBucket(rate=100, burst=1)
+    await asyncio.wait_for(
+        asyncio.gather(*(bucket.acquire(lane) for lane in ("background", "webhook", "background"))),
+        timeout=2,
+    )
+    assert bucket.snapshot()["lanes"]["background"]["acquired"] == 2
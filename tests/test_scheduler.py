@@ -0,0 +1,161 @@
+"""Tests for the background job scheduler."""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from app.scheduler import CronSpec, Scheduler
+
+
+def _utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_cron_monthly():
+    spec = CronSpec("0 0 1 * *")
+    assert spec.next_after(_utc(2026, 1, 15, 12, 30)) == _utc(2026, 2, 1, 0, 0)
+    assert spec.next_after(_utc(2026, 12, 31, 23, 59)) == _utc(2027, 1, 1, 0, 0)
+
+
+def test_cron_steps_and_weekdays():
+    assert CronSpec("*/15 * * * *").next_after(_utc(2026, 3, 2, 10, 7)) == _utc(2026, 3, 2, 10, 15)
+    # 2026-03-02 is a Monday → next Sunday 09:00 is 2026-03-08
+    assert CronSpec("0 9 * * 0").next_after(_utc(2026, 3, 2, 10, 0)) == _utc(2026, 3, 8, 9, 0)
+
+
+def test_cron_rejects_bad_expressions():
+    with pytest.raises(ValueError):
+        CronSpec("* * *")
+    with pytest.raises(ValueError):
+        CronSpec("61 * * * *")
+
+
+def test_register_requires_one_schedule():
+    sched = Scheduler()
+
+    async def noop():
+        pass
+
+    with pytest.raises(ValueError):
+        sched.register("both", noop, interval=1, cron="* * * * *")
+    with pytest.raises(ValueError):
+        sched.register("neither", noop)
+
+
+@pytest.mark.asyncio
+async def test_run_now_records_outcomes():
+    sched = Scheduler()
+    calls = []
+
+    async def ok():
+        calls.append("ok")
+
+    async def boom():
+        raise RuntimeError("nope")
+
+    sched.register("ok", ok, interval=60)
+    sched.register("boom", boom, interval=60)
+
+    assert await sched.run_now("ok") == "ok"
+    assert await sched.run_now("boom") == "error"
+    stats = sched.stats()["jobs"]
+    assert stats["ok"]["runs"] == 1 and stats["ok"]["last_outcome"] == "ok"
+    assert stats["boom"]["failures"] == 1 and stats["boom"]["last_error"] == "nope"
+    assert calls == ["ok"]
+
+
+@pytest.mark.asyncio
+async def test_max_runtime_and_overlap_protection():
+    sched = Scheduler()
+    release = asyncio.Event()
+
+    async def slow():
+        await release.wait()
+
+    sched.register("slow", slow, interval=60, max_runtime=0.05)
+    assert await sched.run_now("slow") == "timeout"
+
+    sched.jobs["slow"].max_runtime = 5
+    first = asyncio.create_task(sched.run_now("slow"))
+    await asyncio.sleep(0)
+    assert await sched.run_now("slow") == "skipped"
+    release.set()
+    assert await first == "ok"
+    assert sched.jobs["slow"].skipped_overlaps == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_run_does_not_delay_schedule():
+    sched = Scheduler()
+    started = []
+
+    async def slow():
+        started.append(asyncio.get_running_loop().time())
+        await asyncio.sleep(0.25)
+
+    sched.register("slow", slow, interval=0.1, max_concurrency=3)
+    sched.start()
+    await asyncio.sleep(0.35)
+    await sched.stop()
+    # Fires every 0.1s even though each run takes 0.25s
+    assert len(started) >= 3
+
+
+@pytest.mark.asyncio
+async def test_non_cancellable_job_overruns_instead_of_being_cancelled():
+    sched = Scheduler()
+    finished = []
+
+    async def charge():
+        await asyncio.sleep(0.1)
+        finished.append(True)
+
+    sched.register("charge", charge, interval=60, max_runtime=0.02, cancellable=False)
+    assert await sched.run_now("charge") == "ok"
+    assert finished == [True]
+    assert sched.jobs["charge"].overruns == 1
+    assert sched.jobs["charge"].history[-1]["overran"] is True
+
+
+@pytest.mark.asyncio
+async def test_stop_waits_for_non_cancellable_runs():
+    sched = Scheduler()
+    events = []
+
+    async def charge():
+        events.append("charge-start")
+        await asyncio.sleep(0.1)
+        events.append("charge-done")
+
+    async def sweep():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            events.append("sweep-cancelled")
+            raise
+
+    sched.register("charge", charge, interval=60, cancellable=False)
+    sched.register("sweep", sweep, interval=60)
+    sched.start()
+    await asyncio.sleep(0.02)
+    await sched.stop()
+    assert sched.stopping
+    assert "charge-done" in events and "sweep-cancelled" in events
+
+
+def test_cron_jobs_cannot_be_run_by_hand(monkeypatch):
+    from fastapi.testclient import TestClient
+
+    from app import main, tasks
+
+    ran = []
+
+    async def fake_run_now(name):
+        ran.append(name)
+        return "ok"
+
+    monkeypatch.setattr(tasks.scheduler, "run_now", fake_run_now)
+    client = TestClient(main.app)
+    assert client.post("/internal/jobs/monthly_reset/run").status_code == 409
+    assert client.post("/internal/jobs/enforce_dirty/run").status_code == 200
+    assert ran == ["enforce_dirty"]
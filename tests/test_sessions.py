@@ -0,0 +1,93 @@
+"""Tests for reuse of portal and checkout sessions."""
+import asyncio
+
+import pytest
+
+from app.sessions import SessionCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_reuses_url_until_ttl_expires():
+    clock = FakeClock()
+    cache = SessionCache(ttl=60, clock=clock)
+    created = []
+
+    async def create():
+        created.append(1)
+        return f"https://billing.stripe.com/s/{len(created)}"
+
+    first = await cache.get_or_create("cus_1", "portal", ("https://w/account",), create)
+    assert await cache.get_or_create("cus_1", "portal", ("https://w/account",), create) == first
+    assert await cache.get_or_create("cus_1", "portal", ("https://w/other",), create) != first
+    clock.now = 61
+    assert await cache.get_or_create("cus_1", "portal", ("https://w/account",), create) != first
+    assert len(created) == 3
+
+
+@pytest.mark.asyncio
+async def test_concurrent_clicks_share_one_create():
+    cache = SessionCache(ttl=60)
+    created = []
+
+    async def create():
+        created.append(1)
+        await asyncio.sleep(0.01)
+        return "https://checkout.stripe.com/c/1"
+
+    urls = await asyncio.gather(*[
+        cache.get_or_create("cus_1", "new_checkout", ("bot_service",), create) for _ in range(5)
+    ])
+    assert set(urls) == {"https://checkout.stripe.com/c/1"}
+    assert len(created) == 1
+
+
+@pytest.mark.asyncio
+async def test_invalidation_drops_entries_and_inflight_creates():
+    cache = SessionCache(ttl=60)
+    release = asyncio.Event()
+
+    async def slow_create():
+        await release.wait()
+        return "stale"
+
+    async def fresh_create():
+        return "fresh"
+
+    pending = asyncio.ensure_future(cache.get_or_create("cus_1", "portal", (), slow_create))
+    await asyncio.sleep(0)
+    cache.invalidate("cus_1")
+    assert await cache.get_or_create("cus_1", "portal", (), fresh_create) == "fresh"
+    release.set()
+    assert await pending == "stale"
+    assert await cache.get_or_create("cus_1", "portal", (), slow_create) == "fresh"
+
+
+@pytest.mark.asyncio
+async def test_invalidation_history_is_bounded(monkeypatch):
+    from app import sessions
+
+    monkeypatch.setattr(sessions, "_MAX_ENTRIES", 2)
+    cache = SessionCache(ttl=60)
+    release = asyncio.Event()
+
+    async def slow_create():
+        await release.wait()
+        return "stale"
+
+    pending = asyncio.ensure_future(cache.get_or_create("cus_1", "portal", (), slow_create))
+    await asyncio.sleep(0)
+    for customer_id in ("cus_1", "cus_2", "cus_3"):
+        cache.invalidate(customer_id)
+    assert cache.stats()["invalidated_customers"] == 2
+    release.set()
+    await pending
+    # cus_1's generation was evicted, but the create that predates it still isn't cached
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,104 @@
+"""Tests for single-flight coalescing of identical concurrent lookups."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app import context
+from app.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_identical_calls_share_one_execution():
+    sf = SingleFlight()
+    calls = 0
+
+    async def lookup():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.02)
+        return {"id": 1, "data": {}}
+
+    results = await asyncio.gather(*(sf.do("user", "a@example.com", lookup) for _ in range(5)))
+    assert calls == 1
+    assert all(r == {"id": 1, "data": {}} for r in results)
+    results[1]["data"]["x"] = 1  # followers get their own copy
+    assert results[0]["data"] == {}
+
+    await sf.do("user", "a@example.com", lookup)  # nothing cached afterwards
+    assert calls == 2
+    assert sf.stats()["operations"]["user"] == {"calls": 6, "executions": 2, "coalesced": 4, "hit_rate": 0.667}
+
+
+@pytest.mark.asyncio
+async def test_different_keys_do_not_coalesce():
+    sf = SingleFlight()
+    calls = []
+
+    async def lookup(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+
+    await asyncio.gather(sf.do("user", "a", lambda: lookup("a")), sf.do("user", "b", lambda: lookup("b")))
+    assert sorted(calls) == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_errors_are_shared_and_leader_cancel_spares_followers():
+    sf = SingleFlight()
+    release = asyncio.Event()
+
+    async def slow():
+        await release.wait()
+        return "ok"
+
+    leader = asyncio.create_task(sf.do("op", 1, slow))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(sf.do("op", 1, slow))
+    await asyncio.sleep(0)
+    leader.cancel()
+    release.set()
+    assert await follower == "ok"
+
+    async def boom():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("stripe down")
+
+    results = await asyncio.gather(sf.do("op", 2, boom), sf.do("op", 2, boom), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_forget_starts_fresh_call_after_write():
+    sf = SingleFlight()
+    version = {"v": 1}
+
+    async def read():
+        seen = version["v"]
+        await asyncio.sleep(0.02)
+        return seen
+
+    stale = asyncio.create_task(sf.do("user", "a", read))
+    await asyncio.sleep(0.005)
+    version["v"] = 2
+    sf.forget("user", "a")
+    assert await sf.do("user", "a", read) == 2
+    assert await stale == 1
+
+
+@pytest.mark.asyncio
+async def test_ensure_customer_creates_only_one_customer(monkeypatch):
+    created = []
+
+    def fake_list(**kwargs):
+        return SimpleNamespace(data=[])
+
+    def fake_create(**kwargs):
+        created.append(kwargs["email"])
+        return SimpleNamespace(id="cus_new", email=kwargs["email"])
+
+    monkeypatch.setattr(context.stripe.Customer, "list", fake_list)
+    monkeypatch.setattr(context.stripe.Customer, "create", fake_create)
+    results = await asyncio.gather(*(context._ensure_customer("new@example.com") for _ in range(3)))
+    assert created == ["new@example.com"]
+    assert {r.id for r in results} == {"cus_new"}
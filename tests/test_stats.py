@@ -0,0 +1,55 @@
+"""Tests for the cached /v1/stats aggregate."""
+import httpx
+import pytest
+
+from app import admin, db
+
+
+@pytest.fixture(autouse=True)
+def reset_cache(monkeypatch):
+    monkeypatch.setattr(admin, "_stats_cache", None)
+    monkeypatch.setattr(admin, "_stats_refresh", None)
+
+
+@pytest.mark.asyncio
+async def test_admin_fallback_pages_through_all_users(monkeypatch):
+    monkeypatch.setattr(admin, "DATABASE_URL", "")
+    monkeypatch.setattr(admin, "_STATS_PAGE_SIZE", 2)
+    users = [{"max_concurrent_bots": n} for n in (0, 1, 2, 0, 3)]
+    paths = []
+
+    async def fake_admin_request(method, path, json_body=None):
+        paths.append(path)
+        skip = int(path.split("skip=")[1].split("&")[0])
+        return httpx.Response(200, json=users[skip:skip + 2])
+
+    monkeypatch.setattr(admin, "admin_request", fake_admin_request)
+    stats = await admin.current_stats()
+    assert stats == {"total_accounts": 3, "total_contracted_bots": 6}
+    assert len(paths) == 3
+
+
+@pytest.mark.asyncio
+async def test_sql_aggregate_cached_then_refreshed_in_background(monkeypatch):
+    monkeypatch.setattr(admin, "DATABASE_URL", "postgresql://test")
+    results = iter([
+        {"total_accounts": 1, "total_contracted_bots": 2},
+        {"total_accounts": 5, "total_contracted_bots": 9},
+    ])
+    calls = []
+
+    async def fake_account_stats():
+        calls.append(1)
+        return next(results)
+
+    monkeypatch.setattr(db, "account_stats", fake_account_stats)
+    first = await admin.current_stats()
+    assert await admin.current_stats() == first
+    assert len(calls) == 1
+
+    monkeypatch.setattr(admin, "STATS_CACHE_TTL_SECONDS", 0.0)
+    assert await admin.current_stats() == first  # stale value served immediately
+    await admin._stats_refresh
+    monkeypatch.setattr(admin, "STATS_CACHE_TTL_SECONDS", 60.0)
+    assert await admin.current_stats() == {"total_accounts": 5, "total_contracted_bots": 9}
+    assert len(calls) == 2
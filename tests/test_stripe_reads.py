@@ -0,0 +1,136 @@
+"""Stripe call counts per endpoint with expand=-based reads."""
+from types import SimpleNamespace
+
+import pytest
+import stripe
+from fastapi.testclient import TestClient
+
+from app import balance, checkout, main, usage
+from app.context import CustomerContext
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    """Replace Stripe methods with fakes that record (name, kwargs)."""
+    calls = []
+
+    def fake(name, result):
+        def call(*args, **kwargs):
+            calls.append((name, kwargs))
+            return result
+        return call
+
+    def install(resource, method, result):
+        monkeypatch.setattr(resource, method, fake(f"{resource.__name__}.{method}", result))
+
+    recorder = SimpleNamespace(calls=calls, install=install)
+    recorder.names = lambda: [name for name, _ in calls]
+    return recorder
+
+
+def test_manual_topup_reads_customer_and_payment_method_in_one_call(monkeypatch, recorder):
+    async def fake_user_data(email):
+        return {"stripe_customer_id": "cus_1"}
+
+    async def fake_merge(email, patch):
+        pass
+
+    monkeypatch.setattr(balance, "get_user_data", fake_user_data)
+    monkeypatch.setattr(balance, "merge_user_data", fake_merge)
+    recorder.install(stripe.Customer, "retrieve", {
+        "id": "cus_1",
+        "invoice_settings": {"default_payment_method": {"id": "pm_1", "object": "payment_method"}},
+        "default_source": None,
+    })
+    recorder.install(stripe.PaymentIntent, "create", SimpleNamespace(id="pi_1"))
+
+    resp = TestClient(main.app).post("/v1/balance/topup", json={"product": "bot", "email": "a@example.com"})
+    assert resp.status_code == 200
+    assert recorder.names() == ["Customer.retrieve", "PaymentIntent.create"]
+    assert recorder.calls[0][1]["expand"] == ["invoice_settings.default_payment_method", "default_source"]
+    assert recorder.calls[1][1]["payment_method"] == "pm_1"
+
+
+@pytest.mark.asyncio
+async def test_switch_reads_final_invoice_from_the_cancel(recorder):
+    recorder.install(stripe.Subscription, "create", SimpleNamespace(id="sub_new"))
+    recorder.install(stripe.Subscription, "cancel", SimpleNamespace(
+        latest_invoice=SimpleNamespace(total=-500, amount_due=0, ending_balance=0),
+    ))
+    ctx = CustomerContext(
+        user_id=1, customer_id="cus_1", email="a@example.com",
+        bot_sub=SimpleNamespace(id="sub_old"), bot_tier="individual",
+        has_payment_method=True, payment_method_id="pm_1", user_data={},
+        success_url="https://w/account", cancel_url="https://w/pricing",
+        return_url="https://w/account", pricing_url="https://w/pricing",
+    )
+    result = await checkout.switch(ctx, "bot_service")
+    assert result["url"] == "https://w/account?switched=bot_service&credit=5.00"
+    assert recorder.names() == ["Subscription.create", "Subscription.cancel"]
+    assert recorder.calls[1][1]["expand"] == ["latest_invoice"]
+
+
+def test_bot_balance_fallback_lists_customer_with_subscriptions(monkeypatch, recorder):
+    monkeypatch.setattr(main, "DATABASE_URL", "")
+    sub = stripe.StripeObject.construct_from({
+        "id": "sub_1", "status": "active", "metadata": {"tier": "bot_service"},
+        "items": {"data": [{"id": "si_1"}]},
+    }, "sk_test")
+    recorder.install(stripe.Customer, "list", SimpleNamespace(data=[{"id": "cus_1", "subscriptions": {"data": [sub]}}]))
+    recorder.install(stripe.SubscriptionItem, "list_usage_record_summaries", SimpleNamespace(
+        data=[SimpleNamespace(total_usage=10)],
+    ))
+
+    body = TestClient(main.app).post("/v1/stripe/bot-balance", json={"email": "a@example.com"}).json()
+    assert body["usage_cents"] == 300
+    assert recorder.names() == ["Customer.list", "SubscriptionItem.list_usage_record_summaries"]
+    assert recorder.calls[0][1]["expand"] == ["data.subscriptions"]
+
+
+def test_manual_topup_retry_with_same_key_charges_and_credits_once(monkeypatch):
+    data = {"stripe_customer_id": "cus_1", "stripe_payment_method_id": "pm_1", "bot_balance_cents": 100}
+    charges = []
+
+    async def fake_user_data(email):
+        return dict(data)
+
+    async def fake_merge(email, patch):
+        data.update(patch)
+
+    def fake_charge(**kwargs):
+        charges.append(kwargs["idempotency_key"])
+        return SimpleNamespace(id="pi_1")  # Stripe returns the same intent for a repeated key
+
+    monkeypatch.setattr(balance, "get_user_data", fake_user_data)
+    monkeypatch.setattr(balance, "merge_user_data", fake_merge)
+    monkeypatch.setattr(stripe.PaymentIntent, "create", fake_charge)
+    client = TestClient(main.app)
+    body = {"product": "bot", "email": "a@example.com", "amount_cents": 500, "idempotency_key": "click-1"}
+
+    first = client.post("/v1/balance/topup", json=body).json()
+    second = client.post("/v1/balance/topup", json=body).json()
+    assert charges == ["topup-manual-click-1", "topup-manual-click-1"]
+    assert first["new_balance"] == second["new_balance"] == 600
+    assert data["bot_balance_cents"] == 600
+
+
+def test_usage_report_without_a_key_is_not_retried(monkeypatch):
+    attempts = []
+
+    async def fake_customer(email, user_data=None):
+        return "cus_1"
+
+    def fake_usage_record(**kwargs):
+        attempts.append(kwargs.get("idempotency_key"))
+        raise stripe.error.APIConnectionError("connection reset")
+
+    item = {"id": "si_1", "price": {"id": usage.get_price_id("bot_service")}}
+    subs = SimpleNamespace(data=[{"id": "sub_1", "items": {"data": [item]}}])
+    monkeypatch.setattr(usage, "find_customer_id", fake_customer)
+    monkeypatch.setattr(stripe.Subscription, "list", lambda **kwargs: subs)
+    monkeypatch.setattr(stripe.SubscriptionItem, "create_usage_record", fake_usage_record)
+    client = TestClient(main.app, raise_server_exceptions=False)
+    body = {"email": "a@example.com", "plan_type": "bot_service", "quantity": 5}
+
+    assert client.post("/v1/usage", json=body).status_code >= 500
+    assert attempts == [None]
@@ -0,0 +1,135 @@
+"""Tests for pending top-ups confirmed by payment_intent webhooks."""
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+import stripe
+
+from app import db, tasks, topups
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """In-memory billing_pending_topups with the same claim-once semantics."""
+    state = SimpleNamespace(rows={}, credits=[], charges=[])
+
+    async def create(key, user_id, email, product, amount_cents, source, customer_id, payment_method_id):
+        row = dict(idempotency_key=key, user_id=user_id, email=email, product=product, amount_cents=amount_cents,
+                   source=source, customer_id=customer_id, payment_method_id=payment_method_id,
+                   payment_intent_id=None, status="pending", age_seconds=0)
+        state.rows[key] = row
+        return dict(row)
+
+    async def attach(key, payment_intent_id):
+        state.rows[key]["payment_intent_id"] = payment_intent_id
+
+    async def settle(key, status, credit_for=None, payment_intent_id=None, error=None):
+        row = state.rows[key]
+        if row["status"] != "pending":
+            return None
+        row["status"] = status
+        if credit_for:
+            state.credits.append((row["user_id"], credit_for(row)))
+        return dict(row)
+
+    async def stale(older_than, limit=100):
+        return [dict(r) for r in state.rows.values() if r["status"] == "pending"]
+
+    async def open_users():
+        return {(r["user_id"], r["product"]) for r in state.rows.values() if r["status"] == "pending"}
+
+    monkeypatch.setattr(db, "create_pending_topup", create)
+    monkeypatch.setattr(db, "attach_topup_intent", attach)
+    monkeypatch.setattr(db, "settle_pending_topup", settle)
+    monkeypatch.setattr(db, "stale_pending_topups", stale)
+    monkeypatch.setattr(db, "schema_ready", lambda: True)
+    monkeypatch.setattr(tasks, "open_topup_users", open_users)
+    return state
+
+
+def _charge(state, status):
+    def create(**kwargs):
+        state.charges.append(kwargs["idempotency_key"])
+        return SimpleNamespace(id="pi_1", status=status)
+    return create
+
+
+async def _call(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+
+async def _record(**overrides):
+    params = dict(user_id=1, email="a@example.com", product="bot", amount_cents=500, source="manual",
+                  customer_id="cus_1", payment_method_id="pm_1")
+    params.update(overrides)
+    return await topups.record_topup(**params)
+
+
+@pytest.mark.asyncio
+async def test_credited_once_by_webhook(monkeypatch, store):
+    monkeypatch.setattr(stripe.PaymentIntent, "create", _charge(store, "processing"))
+    row = await _record()
+    assert await topups.submit_topup(row) == "processing"
+    assert store.credits == []
+
+    intent = {"id": "pi_1", "metadata": {"topup_key": row["idempotency_key"]}}
+    assert await topups.handle_payment_intent_event("payment_intent.succeeded", intent)
+    assert await topups.handle_payment_intent_event("payment_intent.succeeded", intent) is None
+    assert store.credits == [(1, {"bot_balance_cents": 500})]
+    assert store.charges == [row["idempotency_key"]]
+
+
+@pytest.mark.asyncio
+async def test_failed_intent_is_not_credited(monkeypatch, store):
+    monkeypatch.setattr(stripe.PaymentIntent, "create", _charge(store, "processing"))
+    row = await _record(product="tx")
+    await topups.submit_topup(row)
+    intent = {"id": "pi_1", "metadata": {"topup_key": row["idempotency_key"]},
+              "last_payment_error": {"message": "insufficient funds"}}
+    await topups.handle_payment_intent_event("payment_intent.payment_failed", intent)
+    assert store.rows[row["idempotency_key"]]["status"] == "failed"
+    assert store.credits == []
+
+
+@pytest.mark.asyncio
+async def test_sweeper_resubmits_with_the_same_key(monkeypatch, store):
+    def unavailable(**kwargs):
+        raise stripe.error.APIConnectionError("network down")
+
+    monkeypatch.setattr(stripe.PaymentIntent, "create", unavailable)
+    monkeypatch.setattr(topups, "with_retry", lambda fn, *a, label=None, **kw: _call(fn, *a, **kw))
+    row = await _record()
+    assert await topups.submit_topup(row) is None
+
+    monkeypatch.setattr(stripe.PaymentIntent, "create", _charge(store, "succeeded"))
+    await topups.sweep_pending_topups()
+    assert store.charges == [row["idempotency_key"]]
+    assert store.credits == [(1, {"bot_balance_cents": 500})]
+
+
+@pytest.mark.asyncio
+async def test_auto_topup_skips_users_with_a_pending_topup(monkeypatch, store):
+    @contextlib.asynccontextmanager
+    async def fake_session():
+        yield object()
+
+    def bot_row(user_id):
+        return {"id": user_id, "email": f"u{user_id}@example.com", "max_concurrent_bots": 1, "data": {
+            "stripe_customer_id": f"cus_{user_id}", "stripe_payment_method_id": f"pm_{user_id}",
+        }}
+
+    async def fake_run_query(session, name, params=None):
+        return [bot_row(1), bot_row(2)] if name == tasks._Q_BOT_TOPUP else []
+
+    monkeypatch.setattr(tasks, "DATABASE_URL", "postgresql://test")
+    monkeypatch.setattr(tasks, "TOPUP_CONFIRMATION_MODE", "webhook")
+    monkeypatch.setattr(tasks, "get_session", fake_session)
+    monkeypatch.setattr(tasks, "run_query", fake_run_query)
+    monkeypatch.setattr(stripe.PaymentIntent, "create", _charge(store, "processing"))
+    await _record(user_id=2, source="auto")
+
+    await tasks.auto_topup_pass()
+    charged_users = {store.rows[key]["user_id"] for key in store.charges}
+    assert charged_users == {1}
+    await tasks.auto_topup_pass()  # user 1 is now pending too
+    assert len(store.charges) == 1
@@ -0,0 +1,116 @@
+"""Tests for webhook user resolution and entitlement writes (no DB, no Stripe)."""
+import pytest
+
+from app import db, webhook
+
+
+@pytest.fixture
+def stripe_calls(monkeypatch):
+    calls = []
+
+    def fake_retrieve(cust_id, **kwargs):
+        calls.append(("Customer.retrieve", cust_id))
+        return {"email": f"{cust_id}@stripe.test"}
+
+    monkeypatch.setattr(webhook.stripe.Customer, "retrieve", fake_retrieve)
+    monkeypatch.setattr(webhook, "DATABASE_URL", "postgresql://test")
+    return calls
+
+
+@pytest.fixture
+def customer_index(monkeypatch):
+    index = {"cus_known": {"id": 42, "email": "known@example.com", "data": {}}}
+
+    async def fake_lookup(cust_id):
+        return index.get(cust_id)
+
+    monkeypatch.setattr(db, "get_user_by_customer_id", fake_lookup)
+    return index
+
+
+# ── _resolve_user ────────────────────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_known_customer_resolves_from_index_without_stripe(stripe_calls, customer_index):
+    assert await webhook._resolve_user({"customer": "cus_known"}) == ("known@example.com", 42)
+    assert stripe_calls == []
+
+
+@pytest.mark.asyncio
+async def test_unknown_customer_uses_metadata_before_stripe(stripe_calls, customer_index):
+    obj = {"customer": "cus_new", "metadata": {"userEmail": "meta@example.com"}}
+    assert await webhook._resolve_user(obj) == ("meta@example.com", None)
+    assert stripe_calls == []
+
+
+@pytest.mark.asyncio
+async def test_unknown_customer_without_email_falls_back_to_stripe(stripe_calls, customer_index):
+    assert await webhook._resolve_user({"customer": "cus_new"}) == ("cus_new@stripe.test", None)
+    assert stripe_calls == [("Customer.retrieve", "cus_new")]
+
+
+@pytest.mark.asyncio
+async def test_index_failure_is_not_fatal(monkeypatch, stripe_calls):
+    async def broken_lookup(cust_id):
+        raise RuntimeError('relation "billing_customer_map" does not exist')
+
+    monkeypatch.setattr(db, "get_user_by_customer_id", broken_lookup)
+    assert await webhook._resolve_user({"customer": "cus_known"}) == ("cus_known@stripe.test", None)
+
+
+# ── _sync_entitlements ───────────────────────────────────────────────────────
+
+_PAST_DUE_SUB = {
+    "id": "sub_1",
+    "customer": "cus_known",
+    "status": "past_due",  # no payment-method or welcome-credit side calls
+    "items": {"data": []},
+    "metadata": {"tier": "individual"},
+}
+
+
+@pytest.fixture
+def writes(monkeypatch, stripe_calls):
+    log = []
+
+    async def fake_admin(email, user_id, plan_type, max_bots, data_patch):
+        log.append(("admin", email, max_bots))
+
+    async def fake_merge(email, user_id, patch):
+        log.append(("merge", email, user_id))
+
+    monkeypatch.setattr(webhook, "_patch_via_admin_api", fake_admin)
+    monkeypatch.setattr(webhook, "_merge_user", fake_merge)
+    monkeypatch.setattr(webhook, "ENTITLEMENT_WRITE_MODE", "direct")
+    return log
+
+
+@pytest.mark.asyncio
+async def test_direct_mode_writes_locally_without_admin_api(monkeypatch, writes):
+    async def fake_apply(patch, max_bots, preserve_higher=False, user_id=None, email=None):
+        writes.append(("direct", user_id, max_bots, patch["subscription_status"]))
+        return {"id": user_id, "max_concurrent_bots": max_bots}
+
+    monkeypatch.setattr(db, "apply_entitlements", fake_apply)
+    await webhook._sync_entitlements("known@example.com", _PAST_DUE_SUB, db_user_id=42)
+    assert writes == [("direct", 42, 0, "past_due")]
+
+
+@pytest.mark.asyncio
+async def test_missing_row_falls_back_to_admin_api(monkeypatch, writes):
+    async def fake_apply(*args, **kwargs):
+        return None  # user row doesn't exist yet
+
+    monkeypatch.setattr(db, "apply_entitlements", fake_apply)
+    await webhook._sync_entitlements("new@example.com", _PAST_DUE_SUB)
+    assert writes == [("admin", "new@example.com", 0), ("merge", "new@example.com", None)]
+
+
+@pytest.mark.asyncio
+async def test_failed_direct_write_falls_back_to_admin_api(monkeypatch, writes):
+    async def fake_apply(*args, **kwargs):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(db, "apply_entitlements", fake_apply)
+    await webhook._sync_entitlements("known@example.com", _PAST_DUE_SUB, db_user_id=42)
+    assert writes == [("admin", "known@example.com", 0), ("merge", "known@example.com", 42)]